@@ -1,13 +1,24 @@
+import asyncio
 import logging
-# from fastapi.concurrency import run_in_threadpool
-from typing import Annotated,List  # , Optional
+import os
+from fastapi.concurrency import run_in_threadpool
+from typing import Annotated,List, Optional
 import uvicorn
-from fastapi import BackgroundTasks, FastAPI, HTTPException,Depends
+from fastapi import BackgroundTasks, FastAPI, HTTPException,Depends, Query, Request
+from fastapi.responses import StreamingResponse
 from fastapi.security import OAuth2PasswordRequestForm
 from fastapi.middleware.cors import CORSMiddleware
 from install import (
     install_all_roles,
+    prepare_install_run,
+    role_engine,
+    role_hooks,
 )
+from install_events import broadcaster
+from port_probe import PORT_PROBE_TIMEOUT, probe_many
+from response_cache import response_cache
+from ssh_pool import pool as ssh_pool
+from vsphere import INVENTORY_KINDS, VSphereError
 from models import (
     # Client-specific service models removed:
     # AlfrescoModel, AuthModel, GCBOModel, GMAOModel,
@@ -20,6 +31,8 @@ from models import (
     FlowMatrixModel,
     GlobalRecap,
     HypervisorModel,
+    InstallRunDetailModel,
+    InstallRunModel,
     LdapModel,
     LdapPartialModel,
     MonitoringModel,
@@ -30,7 +43,9 @@ from models import (
     SMSProviderModel,
     SMTPServerModel,
     ServiceModel,
+    ServiceTestResultModel,
     TaskLogModel,
+    TaskLogPartialModel,
     VaultCredentialsModel,
     VirtualMachineModel,
     VMwareEsxiModel,
@@ -47,29 +62,37 @@ from repository import (
     # update_arcgis_provider, update_facebook, update_fcm, update_firebase_db,
     # update_google, update_payment_provider, update_publishing_provider,
     # update_server, update_signature
+    InstallRunConflict,
     add_database,
     add_flow_matrix,
     add_zone,
+    apply_scaffold,
     # populate_db_fake_data,
     add_ldap,
     add_nutanix_ahv_configuration,
     add_sms_provider,
     add_smtp_server,
     add_vmware_esxi_configuration,
-    delete_all_ansible_roles,
     delete_database,
     delete_hypervisor,
     delete_ldap,
     delete_nutanix_ahv_configuration,
     delete_sms_provider,
     delete_smtp_server,
+    delete_virtual_machine,
     delete_vmware_esxi_configuration,
+    fail_interrupted_install_runs,
     get_all_dns,
+    get_capacity_plan,
+    get_global_recap,
     get_ansible_roles,
+    get_install_run,
+    get_install_runs,
     get_databases,
     get_flow_matrix,
     get_hypervisor,
     get_hypervisor_list,
+    get_vmware_inventory,
     get_ldaps,
     get_monitoring_config,
     # get_products_to_install removed - no longer using product-based system
@@ -79,13 +102,16 @@ from repository import (
     get_sms_providers,
     get_smtp_servers,
     get_task_logs,
+    get_task_logs_since,
     get_vault_creds,
     get_virtual_machines,
     get_vms_by_group,
     get_zone_by_id,
+    get_zone_ip_pool_usage,
     get_zones,
     getConfiguration,
     get_session,
+    plan_scaffold,
     # prepare_install_products removed - no longer using product-based system
     # set_installed_products removed - no longer using product-based system
     # query_products removed - no longer using product-based system
@@ -94,7 +120,8 @@ from repository import (
     test_flows,
     test_key_pair_match,
     test_ldap,
-    test_services,
+    test_services_async,
+    get_service_endpoints,
     test_ssl_with_domain,
     test_vmware_esxi_configuration,
     update_current_step,
@@ -136,19 +163,71 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Load the role hooks at startup so the first install does not pay for it
+PRELOAD_ROLE_HOOKS = os.getenv("PRELOAD_ROLE_HOOKS", "true").lower() in ("1", "true", "yes")
+
+
+@app.on_event("startup")
+def preload_role_hooks():
+    if PRELOAD_ROLE_HOOKS:
+        loaded = role_hooks.preload()
+        logger.info(f"Preloaded {loaded} role hooks")
+
+
+@app.on_event("startup")
+def fail_interrupted_runs():
+    # Runs whose worker stopped would block /start, the runs of live
+    # workers keep their heartbeat and are left alone
+    interrupted = fail_interrupted_install_runs(Session)
+    if interrupted:
+        logger.info(f"Marked {interrupted} interrupted install run(s) as failed")
+
+
+@app.on_event("startup")
+def scaffold_test_vms():
+    # Creates the test VMs once, instead of on every GET /virtual-machines
+    scaffold_test_architecture(Session)
+
+
+@app.on_event("shutdown")
+def stop_role_engine():
+    role_engine.shutdown(wait=False)
+    ssh_pool.close_all()
+
 
 @app.get("/get_global_recap", response_model=List[GlobalRecap])
-def get_global_recap():
-    return [
-        GlobalRecap(zone="LAN Apps", total_cpu=144, total_memory=200, total_disk=1000),
-        GlobalRecap(zone="LAN Infra", total_cpu=144, total_memory=200, total_disk=1000),
-        GlobalRecap(zone="DMZ", total_cpu=144, total_memory=200, total_disk=1000),
-    ]
+def read_global_recap():
+    return get_global_recap(Session)
+
+
+@app.get("/capacity")
+def read_capacity_plan(users: Optional[int] = Query(default=None, ge=0)):
+    """
+    Sizing per VM type and totals per zone for users concurrent users
+    (default: the configured number).
+    """
+    return get_capacity_plan(Session, user_count=users)
+
 
 @app.post("/start", response_model=bool)
-async def start_install(background_tasks: BackgroundTasks):
-    delete_all_ansible_roles(Session)
-    background_tasks.add_task(install_all_roles, Session)
+async def start_install(
+    background_tasks: BackgroundTasks, force: bool = False, resume: bool = False
+):
+    """
+    Start an install run. Roles whose inputs did not change since their last
+    success are not run again, unless force is set. With resume, the latest
+    failed run continues from its failed roles. 409 while a run is running.
+    """
+    # A run whose worker stopped no longer blocks a new one
+    await run_in_threadpool(fail_interrupted_install_runs, Session)
+    try:
+        # The run and its roles exist before the first poll of /ansible_roles
+        prepared = await run_in_threadpool(
+            prepare_install_run, Session, resume, force
+        )
+    except InstallRunConflict as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    background_tasks.add_task(install_all_roles, Session, prepared=prepared)
     # install_all_roles(Session)
     return True
 
@@ -213,8 +292,22 @@ def test_crt(certificat: certificatModel):
 
 # Hypervisors
 @app.get("/hypervisors", response_model=List[HypervisorModel])
-def get_hypervisors():
-    return get_hypervisor_list(Session)
+def get_hypervisors(
+    request: Request,
+    type: Optional[str] = None,
+    is_connected: Optional[bool] = None,
+    limit: Optional[int] = Query(default=None, ge=1),
+    offset: int = Query(default=0, ge=0),
+):
+    return response_cache.respond(
+        request,
+        "hypervisors",
+        lambda: get_hypervisor_list(
+            Session, type=type, is_connected=is_connected, limit=limit, offset=offset
+        ),
+        List[HypervisorModel],
+        key=(type, is_connected, limit, offset),
+    )
 
 
 @app.get("/hypervisor/{id}")
@@ -237,6 +330,32 @@ def read_hypervisor(id: int, type: str):
     return VMwareEsxiModel.model_validate(hypervisor)
 
 
+@app.get("/hypervisor/{id}/inventory")
+def read_hypervisor_inventory(id: int, refresh: bool = False):
+    """
+    vCenter inventory of a VMware hypervisor: hosts, clusters, datastores,
+    datacenters and resource pools with their IDs. Served from a cache
+    refreshed in the background ("stale" is true while it is refreshed);
+    refresh=true fetches it from vCenter first.
+    """
+    try:
+        inventory = get_vmware_inventory(id, Session, refresh=refresh)
+    except VSphereError as e:
+        raise HTTPException(status_code=502, detail=f"vCenter indisponible : {e}")
+    if inventory is None:
+        raise HTTPException(status_code=404, detail="Hypervisor not found")
+    return inventory
+
+
+@app.get("/hypervisor/{id}/inventory/{kind}")
+def read_hypervisor_inventory_kind(id: int, kind: str, refresh: bool = False):
+    """One inventory list: host, cluster, datastore, datacenter or resource-pool."""
+    if kind not in INVENTORY_KINDS:
+        raise HTTPException(status_code=404, detail=f"Unknown inventory kind {kind}")
+    inventory = read_hypervisor_inventory(id, refresh)
+    return inventory["inventory"][kind]
+
+
 @app.delete("/hypervisor/{id}")
 def remove_hypervisor(id: int, type: str):
     """
@@ -254,11 +373,14 @@ def remove_hypervisor(id: int, type: str):
 
 # Configuration
 @app.get("/configuration", response_model=ConfigurationModel)
-def read_configuration():
-    config = getConfiguration(Session)
-    if not config:
-        raise HTTPException(status_code=404, detail="Configuration not found")
-    return config
+def read_configuration(request: Request):
+    def load():
+        config = getConfiguration(Session)
+        if not config:
+            raise HTTPException(status_code=404, detail="Configuration not found")
+        return config
+
+    return response_cache.respond(request, "configuration", load, ConfigurationModel)
 
 
 @app.put("/configuration/concurrent-users")
@@ -417,9 +539,20 @@ def test_database_item(database: DatabaseModel):
     )
 
 @app.post("/service-test", response_model=bool)
-def test_service(service: ServiceModel):
-    service_dict = service.dict()
-    return test_services(**service_dict, Session=Session)
+async def test_service(service: ServiceModel):
+    return await test_services_async(service.destination, service.port)
+
+
+@app.post("/service-test/batch", response_model=List[ServiceTestResultModel])
+async def test_all_services(
+    timeout: float = Query(PORT_PROBE_TIMEOUT, gt=0, le=60),
+):
+    """
+    Check every configured SMS, SMTP, LDAP and database endpoint at once.
+    Returns one result per endpoint with its latency (ms) when reachable.
+    """
+    endpoints = await run_in_threadpool(get_service_endpoints, Session)
+    return await probe_many(endpoints, timeout=timeout)
 
 # Monitoring
 @app.get("/monitoring", response_model=MonitoringModel)
@@ -474,8 +607,10 @@ def delete_ldap_item(
 
 # Zones
 @app.get("/zones", response_model=List[ZoneModel])
-def read_zones():
-    return get_zones(Session)
+def read_zones(request: Request):
+    return response_cache.respond(
+        request, "zones", lambda: get_zones(Session), List[ZoneModel]
+    )
 
 
 # @app.post("/zone", response_model=ZoneModel)
@@ -493,12 +628,15 @@ def update_zone_item(
     hypervisor_id: int,
     zone: ZoneModel,
 ):
-    return update_zone(
-        id,
-        **zone.model_dump(exclude={"id"}),
-        hypervisor_id=hypervisor_id,
-        Session=Session,
-    )
+    try:
+        return update_zone(
+            id,
+            **zone.model_dump(exclude={"id"}),
+            hypervisor_id=hypervisor_id,
+            Session=Session,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
 
 @app.get("/zones/{id}", response_model=ZoneModel)
@@ -517,12 +655,46 @@ def read_zone_by_id(id: int):
     return ZoneModel.model_validate(zone)
 
 
+@app.get("/zones/{id}/ip-pool")
+def read_zone_ip_pool(id: int):
+    """
+    Size, used and free addresses of the zone's IP pool.
+    """
+    try:
+        return get_zone_ip_pool_usage(id, Session)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+
 # Virtual Machines
 @app.get("/virtual-machines", response_model=List[VirtualMachineModel])
-def read_virtual_machines():
-    # Automatically create 3 test VMs if they don't exist
-    scaffold_test_architecture(Session)
-    return get_virtual_machines(Session)
+def read_virtual_machines(request: Request):
+    return response_cache.respond(
+        request,
+        "virtual_machines",
+        lambda: get_virtual_machines(Session),
+        List[VirtualMachineModel],
+    )
+
+
+@app.get("/scaffold/plan")
+def read_scaffold_plan(users: Optional[int] = Query(default=None, ge=0)):
+    """
+    VMs to add, resize and remove to match the capacity plan of users
+    concurrent users (default: the configured number). Changes nothing.
+    """
+    return plan_scaffold(Session, user_count=users)
+
+
+@app.post("/scaffold")
+def apply_scaffold_plan(users: Optional[int] = Query(default=None, ge=0)):
+    """
+    Apply the scaffold plan in one transaction and return it.
+    """
+    try:
+        return apply_scaffold(Session, user_count=users)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
 
 @app.put("/virtual-machine/{id}", response_model=VirtualMachineModel)
@@ -533,23 +705,174 @@ def update_virtual_machine_item(
     return update_virtual_machine(id, **vm.model_dump(exclude={"id"}),Session=Session)
 
 
+@app.delete("/virtual-machine/{id}")
+def delete_virtual_machine_item(id: int):
+    result = delete_virtual_machine(id, Session)
+    if result is None:
+        raise HTTPException(status_code=404, detail="Virtual machine not found")
+    return {"message": "Virtual machine deleted successfully"}
+
+
 # Playbooks and Task Logs
 @app.get("/ansible_roles", response_model=List[AnsibleRoleModel])
-def retreive_ansible_roles():
-    return get_ansible_roles(Session)
+def retreive_ansible_roles(
+    after_order: Optional[int] = None,
+    limit: Optional[int] = Query(default=None, ge=1),
+    run_id: Optional[int] = None,
+):
+    return get_ansible_roles(
+        Session, after_order=after_order, limit=limit, run_id=run_id
+    )
+
+
+@app.get("/install-runs", response_model=List[InstallRunModel])
+def read_install_runs(limit: Optional[int] = Query(default=None, ge=1)):
+    return get_install_runs(Session, limit=limit)
 
 
-@app.get("/task-logs/{runner_ident}", response_model=List[TaskLogModel])
+@app.get("/install-runs/{id}", response_model=InstallRunDetailModel)
+def read_install_run(id: int):
+    install_run = get_install_run(id, Session)
+    if install_run is None:
+        raise HTTPException(status_code=404, detail="Install run not found")
+    return install_run
+
+
+@app.get(
+    "/task-logs/{runner_ident}",
+    response_model=List[TaskLogPartialModel],
+    response_model_exclude_unset=True,
+)
 def obtain_task_logs(
     runner_ident: str,
+    after_id: Optional[int] = None,
+    limit: Optional[int] = Query(default=None, ge=1, le=5000),
+    event: Optional[str] = None,
+    fields: Optional[str] = None,
+):
+    """
+    Task logs of a runner, oldest first.
+    Clients poll with after_id set to the last id they received to get only
+    the new lines. fields is a comma separated list of columns to return
+    (id is always included), e.g. fields=id,task,event to skip stdout.
+    """
+    task_logs = get_task_logs(
+        runner_ident, Session, after_id=after_id, limit=limit, event=event
+    )
+    if not fields:
+        return task_logs
+
+    selected = {"id"} | {field.strip() for field in fields.split(",") if field.strip()}
+    unknown = selected - set(TaskLogModel.model_fields)
+    if unknown:
+        raise HTTPException(
+            status_code=400, detail=f"Unknown fields: {', '.join(sorted(unknown))}"
+        )
+    return [
+        {field: getattr(task_log, field) for field in selected}
+        for task_log in task_logs
+    ]
+
+
+# Maximum time (seconds) a stream waits for a notification before re-reading
+# the database; covers roles writing from another process.
+STREAM_POLL_INTERVAL = float(os.getenv("INSTALL_STREAM_POLL_INTERVAL", "2"))
+STREAM_BATCH_SIZE = 500
+
+
+def format_sse(event, data, event_id=None):
+    message = f"event: {event}\n"
+    if event_id is not None:
+        message += f"id: {event_id}\n"
+    return message + f"data: {data}\n\n"
+
+
+async def install_event_stream(request, runner_ident, after_id):
+    notification = broadcaster.subscribe()
+    role_states = {}
+    # Last task log id sent per runner, see get_task_logs_since
+    cursors = {}
+    try:
+        while not await request.is_disconnected():
+            notification.clear()
+
+            roles = await run_in_threadpool(get_ansible_roles, Session)
+            for role in roles:
+                state = (role.status, role.runner_ident, role.start_time, role.end_time)
+                if role_states.get(role.id) != state:
+                    role_states[role.id] = state
+                    yield format_sse(
+                        "role", AnsibleRoleModel.model_validate(role).model_dump_json()
+                    )
+
+            task_logs = await run_in_threadpool(
+                get_task_logs_since,
+                after_id,
+                Session,
+                runner_ident,
+                STREAM_BATCH_SIZE,
+                cursors,
+            )
+            for task_log in task_logs:
+                cursors[task_log.runner_ident] = task_log.id
+                yield format_sse(
+                    "task_log",
+                    TaskLogModel.model_validate(task_log).model_dump_json(),
+                    event_id=task_log.id,
+                )
+            if len(task_logs) == STREAM_BATCH_SIZE:
+                # More rows are waiting, do not sleep
+                continue
+
+            try:
+                await asyncio.wait_for(notification.wait(), STREAM_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                yield ": keep-alive\n\n"
+    finally:
+        broadcaster.unsubscribe(notification)
+
+
+@app.get("/install/stream")
+async def stream_install_events(
+    request: Request,
+    runner_ident: Optional[str] = None,
+    after_id: int = 0,
 ):
-    return get_task_logs(runner_ident, Session)
+    """
+    Server-Sent Events stream of install progress.
+    Sends a "role" event whenever an ansible role changes and a "task_log"
+    event for every new task log (of runner_ident when given). Task log
+    events carry their id, so a reconnecting client (Last-Event-ID header
+    or after_id parameter) only receives the logs it has not seen yet.
+    """
+    last_event_id = request.headers.get("last-event-id")
+    if last_event_id and last_event_id.isdigit():
+        after_id = max(after_id, int(last_event_id))
+    return StreamingResponse(
+        install_event_stream(request, runner_ident, after_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.get("/install/hooks")
+def read_role_hook_metrics():
+    """Role hook cache statistics and load time (seconds) of each hook."""
+    return role_hooks.metrics()
+
+
+@app.get("/install/engine")
+def read_role_engine_stats():
+    """Role execution engine gauges: active and queued roles, totals."""
+    return role_engine.stats()
 
 
 # DNS and Flow Matrix
 @app.get("/dns", response_model=List[DnsModel])
-def read_dns():
-    return get_all_dns(Session)
+def read_dns(request: Request):
+    return response_cache.respond(
+        request, "dns", lambda: get_all_dns(Session), List[DnsModel]
+    )
 
 
 @app.post("/add-flow", response_model=FlowMatrixModel)
@@ -560,8 +883,10 @@ def create_flow(flow: FlowMatrixModel):
 
 
 @app.get("/flow-matrix", response_model=List[FlowMatrixModel])
-def read_flow_matrix():
-    return get_flow_matrix(Session)
+def read_flow_matrix(request: Request):
+    return response_cache.respond(
+        request, "flow_matrix", lambda: get_flow_matrix(Session), List[FlowMatrixModel]
+    )
 
 
 # SMS Provider Endpoints
@@ -634,8 +959,19 @@ def remove_smtp_server(id: int):
 
 # Services Endpoints
 @app.get("/services", response_model=List[dict])
-def read_services():
-    return get_services(Session)
+def read_services(
+    request: Request,
+    type: Optional[str] = None,
+    limit: Optional[int] = Query(default=None, ge=1),
+    offset: int = Query(default=0, ge=0),
+):
+    return response_cache.respond(
+        request,
+        "services",
+        lambda: get_services(Session, type=type, limit=limit, offset=offset),
+        List[dict],
+        key=(type, limit, offset),
+    )
 
 
 @app.get("/services/{id}")
@@ -662,6 +998,19 @@ def read_vms_by_group(group: str):
 def testing_flows():
     return test_flows(Session)
 
+
+@app.get("/ssh-pool")
+def read_ssh_pool_stats():
+    """Shared SSH connection pool: key and connection cache hits/misses."""
+    return ssh_pool.get_stats()
+
+
+@app.get("/response-cache")
+def read_response_cache_stats():
+    """Read endpoint cache: hits, misses, 304 responses and invalidations."""
+    return response_cache.get_stats()
+
+
 @app.get("/vault-creds", response_model=List[VaultCredentialsModel])
 def read_vault_credentials():
     vault_creds = get_vault_creds(Session)
@@ -0,0 +1,219 @@
+"""_summary_
+Capacity planning.
+
+Sizes the platform for a number of concurrent users from the VMConfiguration
+tiers (100, 500, 1000, 10000 users...) seeded by seed_vm_configurations():
+between two tiers, node counts and node sizes are interpolated linearly and
+rounded up; past the last tier the node counts keep growing at the rate of
+the last two tiers. Totals are given per recap zone (LAN Apps, LAN Infra,
+DMZ), next to the totals of the VMs actually declared.
+
+Plans are cached by CapacityPlanner under the version stored in the
+configuration row (configurations.capacity_version), bumped by the
+repository writes of the users, VM configurations and VMs. Every API worker
+sees the writes of the others: reading the recap costs one query for the
+version until something changed. Entries also expire after
+CAPACITY_CACHE_TTL seconds, for writes made outside of the repository.
+"""
+
+import math
+import os
+import threading
+import time
+
+CAPACITY_CACHE_TTL = float(os.getenv("CAPACITY_CACHE_TTL", "60"))
+
+# Recap zone of a VM type or VM group, by prefix (case insensitive)
+ZONE_CATEGORIES = (
+    ("DMZ", ("RKEDMZ", "LBDMZ")),
+    ("LAN Apps", ("RKEAPPS", "LBLAN")),
+    ("LAN Infra", ("RKEMIDDLEWARE", "LBINTEGRATION", "VAULT", "GITOPS", "MONITORING")),
+)
+DEFAULT_CATEGORY = "LAN Infra"
+RECAP_ZONES = ("LAN Apps", "LAN Infra", "DMZ")
+
+SIZE_FIELDS = ("cpu_per_node", "ram_per_node", "os_disk_size", "data_disk_size")
+
+
+def zone_category(name):
+    name = (name or "").upper()
+    for category, prefixes in ZONE_CATEGORIES:
+        if name.startswith(prefixes):
+            return category
+    return DEFAULT_CATEGORY
+
+
+def _lerp(low, high, ratio):
+    return low + (high - low) * ratio
+
+
+def interpolate_tiers(tiers, user_count):
+    """
+    Sizing of each VM type for user_count.
+
+    tiers maps a user count to {vm_type: {node_count, cpu_per_node,
+    ram_per_node, os_disk_size, data_disk_size, roles}}. Below the first
+    tier the first tier is used. A VM type missing from one of the two
+    surrounding tiers has no node there: its node count is interpolated
+    against 0 and its nodes keep the size of the other tier.
+    """
+    if not tiers:
+        return {}
+    counts = sorted(tiers)
+    if user_count <= counts[0]:
+        return {vm_type: dict(row) for vm_type, row in tiers[counts[0]].items()}
+    if user_count >= counts[-1]:
+        if len(counts) == 1 or user_count == counts[-1]:
+            return {vm_type: dict(row) for vm_type, row in tiers[counts[-1]].items()}
+        low, high = counts[-2], counts[-1]
+        # Only node counts are extrapolated, nodes keep the last tier's size
+        extrapolate = True
+    else:
+        high = next(count for count in counts if count >= user_count)
+        low = counts[counts.index(high) - 1]
+        extrapolate = False
+
+    ratio = (user_count - low) / (high - low)
+    result = {}
+    vm_types = list(tiers[high])
+    vm_types += [vm_type for vm_type in tiers[low] if vm_type not in tiers[high]]
+    for vm_type in vm_types:
+        high_row = tiers[high].get(vm_type) or dict(tiers[low][vm_type], node_count=0)
+        low_row = tiers[low].get(vm_type) or dict(high_row, node_count=0)
+        row = dict(high_row)
+        row["node_count"] = max(
+            0, math.ceil(_lerp(low_row["node_count"], high_row["node_count"], ratio))
+        )
+        if row["node_count"] == 0 and vm_type not in tiers[high]:
+            # Phased out before user_count
+            continue
+        if not extrapolate:
+            for field in SIZE_FIELDS:
+                row[field] = math.ceil(
+                    _lerp(low_row[field] or 0, high_row[field] or 0, ratio)
+                )
+        result[vm_type] = row
+    return result
+
+
+def _empty_totals():
+    return {"nodes": 0, "cpu": 0, "memory_mb": 0, "disk": 0}
+
+
+def _to_recap(zone, totals):
+    return {
+        "zone": zone,
+        "total_cpu": totals["cpu"],
+        # RAM is sized in MB, the recap shows GB
+        "total_memory": math.ceil(totals["memory_mb"] / 1024),
+        "total_disk": totals["disk"],
+        "nodes": totals["nodes"],
+    }
+
+
+def planned_totals(sizing):
+    """Per recap zone totals of interpolate_tiers() output."""
+    totals = {zone: _empty_totals() for zone in RECAP_ZONES}
+    for vm_type, row in sizing.items():
+        nodes = row["node_count"]
+        zone = totals.setdefault(zone_category(vm_type), _empty_totals())
+        zone["nodes"] += nodes
+        zone["cpu"] += nodes * row["cpu_per_node"]
+        zone["memory_mb"] += nodes * row["ram_per_node"]
+        zone["disk"] += nodes * (row["os_disk_size"] + (row["data_disk_size"] or 0))
+    return [_to_recap(zone, zone_totals) for zone, zone_totals in totals.items()]
+
+
+def inventory_totals(vms):
+    """
+    Per recap zone totals of the declared VMs, dicts with group, nb_cpu,
+    ram, os_disk_size and data_disk_size.
+    """
+    totals = {zone: _empty_totals() for zone in RECAP_ZONES}
+    for vm in vms:
+        zone = totals.setdefault(zone_category(vm["group"]), _empty_totals())
+        zone["nodes"] += 1
+        zone["cpu"] += vm["nb_cpu"] or 0
+        zone["memory_mb"] += vm["ram"] or 0
+        zone["disk"] += (vm["os_disk_size"] or 0) + (vm["data_disk_size"] or 0)
+    return [_to_recap(zone, zone_totals) for zone, zone_totals in totals.items()]
+
+
+def build_plan(user_count, tiers, vms):
+    """
+    Capacity plan for user_count: the interpolated sizing of each VM type,
+    and per zone the planned totals (source "vm_configurations") or, when
+    no tier is seeded, the totals of the declared VMs (source "inventory").
+    """
+    sizing = interpolate_tiers(tiers, user_count)
+    inventory = inventory_totals(vms)
+    if sizing:
+        zones = planned_totals(sizing)
+        source = "vm_configurations"
+    else:
+        zones = [dict(zone) for zone in inventory]
+        source = "inventory"
+    actual = {zone["zone"]: zone for zone in inventory}
+    for zone in zones:
+        zone["actual"] = actual.get(zone["zone"])
+    return {
+        "user_count": user_count,
+        "source": source,
+        "tiers": sorted(tiers),
+        "vm_types": [
+            {"vm_type": vm_type, "zone": zone_category(vm_type), **row}
+            for vm_type, row in sorted(sizing.items())
+        ],
+        "zones": zones,
+    }
+
+
+class CapacityPlanner:
+    """Plans cached by (database version, user count)."""
+
+    def __init__(self, ttl=CAPACITY_CACHE_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self.version = 0
+        self._plans = {}
+        self.stats = {"hits": 0, "misses": 0}
+
+    def invalidate(self):
+        """Called by the writes the plans depend on, in this process."""
+        with self._lock:
+            self.version += 1
+            self._plans.clear()
+
+    def get(self, user_count, compute, db_version=None):
+        """
+        Cached plan of user_count (None: the configured number of users)
+        computed at db_version. compute() returns a fresh plan on a miss.
+        """
+        with self._lock:
+            version = self.version
+            entry = self._plans.get(user_count)
+            if (
+                entry is not None
+                and entry[0] == db_version
+                and entry[1] > time.monotonic()
+            ):
+                self.stats["hits"] += 1
+                return entry[2]
+            self.stats["misses"] += 1
+        plan = compute()
+        with self._lock:
+            # Not cached if a write happened while computing
+            if self.version == version:
+                self._plans[user_count] = (
+                    db_version,
+                    time.monotonic() + self.ttl,
+                    plan,
+                )
+        return plan
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self.stats, version=self.version, plans=len(self._plans))
+
+
+planner = CapacityPlanner()
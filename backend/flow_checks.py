@@ -0,0 +1,101 @@
+"""_summary_
+Flow matrix verification.
+
+A flow is open when its source host can reach destination:port. The check
+runs nc on the source host over SSH. Flows are grouped by source: one SSH
+connection per source runs every probe of that source in a single remote
+script (probes run in parallel on the host), and sources are checked
+concurrently by a bounded thread pool. Connections come from ssh_pool.
+"""
+
+import logging
+import os
+import shlex
+from concurrent.futures import ThreadPoolExecutor
+
+from ssh_pool import pool
+
+logger = logging.getLogger(__name__)
+
+# Number of source hosts checked at the same time
+FLOW_CHECK_WORKERS = int(os.getenv("FLOW_CHECK_WORKERS", "16"))
+# nc timeout (seconds) of each probe
+FLOW_CHECK_TIMEOUT = int(os.getenv("FLOW_CHECK_TIMEOUT", "5"))
+
+
+def normalize_destination(destination):
+    if destination.startswith("ldap://"):
+        return destination.split("ldap://")[1]
+    return destination
+
+
+def load_private_key(pkey_str, passphrase=None):
+    return pool.load_key(pkey_str, passphrase)
+
+
+def build_probe_script(flows, timeout=FLOW_CHECK_TIMEOUT):
+    """
+    Shell script probing every flow in the background and printing
+    "<flow id> <nc exit status>" for each of them.
+    """
+    lines = []
+    for flow in flows:
+        option = "-vzu" if flow.protocol == "udp" else "-vz"
+        destination = shlex.quote(normalize_destination(flow.destination))
+        lines.append(
+            f"(nc {option} -w {int(timeout)} {destination} {int(flow.port)} "
+            f">/dev/null 2>&1; echo \"{int(flow.id)} $?\") &"
+        )
+    lines.append("wait")
+    return "\n".join(lines) + "\n"
+
+
+def parse_probe_output(output):
+    """Map each flow id printed by the probe script to True when open."""
+    results = {}
+    for line in output.splitlines():
+        parts = line.split()
+        if len(parts) == 2 and parts[0].isdigit() and parts[1].isdigit():
+            results[int(parts[0])] = parts[1] == "0"
+    return results
+
+
+def check_source(source, flows, pkey, timeout=FLOW_CHECK_TIMEOUT):
+    """Probe the flows of one source host. Unreachable sources close every flow."""
+    results = {flow.id: False for flow in flows}
+    try:
+        _, output, _ = pool.exec_command(
+            source,
+            "sh -s",
+            pkey=pkey,
+            input=build_probe_script(flows, timeout),
+            # The probes run in parallel, the script lasts about one timeout
+            timeout=timeout + 60,
+        )
+        results.update(parse_probe_output(output))
+    except Exception as e:
+        logger.error(f"Flow check from {source} failed: {e}")
+    return results
+
+
+def run_flow_checks(flows, pkey, max_workers=FLOW_CHECK_WORKERS, check=check_source):
+    """
+    Check all flows and return {flow id: is_open}.
+    check(source, flows, pkey) is called once per source host.
+    """
+    by_source = {}
+    for flow in flows:
+        by_source.setdefault(flow.source, []).append(flow)
+    if not by_source:
+        return {}
+
+    results = {}
+    workers = max(1, min(max_workers, len(by_source)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(check, source, source_flows, pkey)
+            for source, source_flows in by_source.items()
+        ]
+        for future in futures:
+            results.update(future.result())
+    return results
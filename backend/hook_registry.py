@@ -0,0 +1,107 @@
+"""_summary_
+Cache of the role hook modules (prepare_inputs.py / post_install.py).
+
+install.py used to build a new importlib spec and execute the hook file
+for every call, re-running the imports of hvac, requests, repository...
+HookRegistry loads each file once and reuses the module until the file
+changes on disk (keyed by path and mtime).
+"""
+
+import importlib.util
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+HOOK_NAMES = ("prepare_inputs", "post_install")
+
+
+class HookRegistry:
+    """Load, cache and time the role hook modules found under roles_root."""
+
+    def __init__(self, roles_root):
+        self.roles_root = roles_root
+        self._lock = threading.Lock()
+        # path -> (mtime_ns, size, module)
+        self._modules = {}
+        self._load_times = {}
+        self.hits = 0
+        self.misses = 0
+
+    def hook_path(self, role_name, hook_name):
+        return os.path.join(self.roles_root, role_name, f"{hook_name}.py")
+
+    def discover(self):
+        """Return the (role_name, hook_name) pairs present on disk."""
+        hooks = []
+        if not os.path.isdir(self.roles_root):
+            return hooks
+        for role_name in sorted(os.listdir(self.roles_root)):
+            for hook_name in HOOK_NAMES:
+                if os.path.isfile(self.hook_path(role_name, hook_name)):
+                    hooks.append((role_name, hook_name))
+        return hooks
+
+    def get(self, role_name, hook_name):
+        """
+        Return the loaded hook module, or None when the role has no such file.
+        The file is executed again only if it changed since the last load.
+        """
+        path = self.hook_path(role_name, hook_name)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+
+        with self._lock:
+            cached = self._modules.get(path)
+            if cached and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+                self.hits += 1
+                return cached[2]
+
+            spec = importlib.util.spec_from_file_location(
+                f"{role_name}_{hook_name}", path
+            )
+            if spec is None or spec.loader is None:
+                raise ValueError(
+                    f"Could not load module spec for {hook_name} of role '{role_name}'"
+                )
+            start = time.perf_counter()
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+            elapsed = time.perf_counter() - start
+
+            self.misses += 1
+            self._modules[path] = (stat.st_mtime_ns, stat.st_size, module)
+            self._load_times[f"{role_name}/{hook_name}"] = elapsed
+            logger.info(f"Loaded {hook_name} of role {role_name} in {elapsed:.3f}s")
+            return module
+
+    def preload(self):
+        """Load every hook found on disk. Returns the number of hooks loaded."""
+        loaded = 0
+        for role_name, hook_name in self.discover():
+            try:
+                self.get(role_name, hook_name)
+                loaded += 1
+            except Exception as e:
+                # A broken hook only fails its own role, at install time
+                logger.error(f"Could not preload {hook_name} of role {role_name}: {e}")
+        return loaded
+
+    def clear(self):
+        with self._lock:
+            self._modules.clear()
+            self._load_times.clear()
+
+    def metrics(self):
+        with self._lock:
+            return {
+                "cached": len(self._modules),
+                "hits": self.hits,
+                "misses": self.misses,
+                "total_load_time": sum(self._load_times.values()),
+                "load_times": dict(self._load_times),
+            }
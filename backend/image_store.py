@@ -0,0 +1,152 @@
+"""_summary_
+Offline image store: the image bundles exported by tar_images.py and their
+manifest.
+
+manifest.json, next to the bundles, tracks every image by reference:
+
+    "images": {"redis:7": {"name": "redis", "tag": "7", "digest": "sha256:...",
+                           "image_id": "sha256:...", "size": ..., "roles": [...],
+                           "file": "install-a-0123456789ab.tar"}}
+    "bundles": {"install-a-0123456789ab.tar": {"role": ..., "images": [...],
+                                               "size": ..., "sha256": ...}}
+
+digest is the registry digest of the pulled tag, image_id the local image id.
+Loading and verification look images up in the manifest instead of parsing
+tar file names.
+"""
+
+import hashlib
+import json
+import os
+
+IMAGES_FOLDER = os.getenv("IMAGES_FOLDER", "/images")
+MANIFEST_FILE = "manifest.json"
+# Index written by earlier versions of tar_images.py
+LEGACY_INDEX_FILE = "images-index.json"
+
+
+def split_reference(image):
+    """(name, tag) of an image reference, tag is the digest of name@sha256:..."""
+    if "@" in image:
+        return tuple(image.split("@", 1))
+    name, _, tag = image.rpartition(":")
+    # The colon of a registry port is not a tag separator
+    if not name or "/" in tag:
+        return image, "latest"
+    return name, tag
+
+
+def empty_manifest():
+    return {"images": {}, "bundles": {}}
+
+
+def _from_legacy_index(index):
+    manifest = empty_manifest()
+    for image, entry in index.get("images", {}).items():
+        name, tag = split_reference(image)
+        manifest["images"][image] = {
+            "name": name,
+            "tag": tag,
+            "digest": None,
+            "image_id": entry["id"],
+            "size": None,
+            "roles": entry.get("roles", []),
+            "file": entry["bundle"],
+        }
+    for file, bundle in index.get("bundles", {}).items():
+        manifest["bundles"][file] = dict(bundle, sha256=None)
+    return manifest
+
+
+def load_manifest(folder=IMAGES_FOLDER):
+    path = os.path.join(folder, MANIFEST_FILE)
+    if os.path.exists(path):
+        with open(path, "r") as file:
+            manifest = json.load(file)
+        manifest.setdefault("images", {})
+        manifest.setdefault("bundles", {})
+        return manifest
+    legacy_path = os.path.join(folder, LEGACY_INDEX_FILE)
+    if os.path.exists(legacy_path):
+        with open(legacy_path, "r") as file:
+            return _from_legacy_index(json.load(file))
+    return empty_manifest()
+
+
+def save_manifest(folder, manifest):
+    path = os.path.join(folder, MANIFEST_FILE)
+    with open(path + ".tmp", "w") as file:
+        json.dump(manifest, file, indent=2, sort_keys=True)
+    os.replace(path + ".tmp", path)
+    legacy_path = os.path.join(folder, LEGACY_INDEX_FILE)
+    if os.path.exists(legacy_path):
+        os.remove(legacy_path)
+
+
+def file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            sha256.update(chunk)
+    return "sha256:" + sha256.hexdigest()
+
+
+def bundle_image_ids(manifest, images=None):
+    """
+    {bundle file: [image ids it holds]}, only the bundles holding one of
+    images when given.
+    """
+    entries = manifest["images"]
+    return {
+        file: sorted({entries[image]["image_id"] for image in bundle["images"]})
+        for file, bundle in manifest["bundles"].items()
+        if images is None or set(images) & set(bundle["images"])
+    }
+
+
+def legacy_tar_images(folder=IMAGES_FOLDER):
+    """
+    {tar file: image} of the per-image tars exported before the manifest,
+    named <role>_<image with / replaced by _>.tar.
+    """
+    if not os.path.isdir(folder):
+        return {}
+    return {
+        file: file[: -len(".tar")].split("_", 1)[-1].replace("_", "/")
+        for file in sorted(os.listdir(folder))
+        if file.endswith(".tar")
+    }
+
+
+def bundles_to_load(manifest, present_image_ids):
+    """Bundle files holding at least one image id not in present_image_ids."""
+    present = set(present_image_ids)
+    return sorted(
+        file
+        for file, image_ids in bundle_image_ids(manifest).items()
+        if not present.issuperset(image_ids)
+    )
+
+
+def verify(folder=IMAGES_FOLDER, manifest=None, deep=False):
+    """
+    Problems of the store: bundles missing or of another size than recorded,
+    with deep=True also checksum mismatches. An empty list means valid.
+    """
+    if manifest is None:
+        manifest = load_manifest(folder)
+    problems = []
+    for image, entry in sorted(manifest["images"].items()):
+        if entry["file"] not in manifest["bundles"]:
+            problems.append(f"{image}: bundle {entry['file']} is not in the manifest")
+    for file, bundle in sorted(manifest["bundles"].items()):
+        path = os.path.join(folder, file)
+        if not os.path.exists(path):
+            problems.append(f"{file}: missing")
+            continue
+        size = os.path.getsize(path)
+        if bundle.get("size") is not None and size != bundle["size"]:
+            problems.append(f"{file}: size {size}, expected {bundle['size']}")
+        elif deep and bundle.get("sha256") and file_sha256(path) != bundle["sha256"]:
+            problems.append(f"{file}: checksum mismatch")
+    return problems
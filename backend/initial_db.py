@@ -1,8 +1,11 @@
 import os
-from sqlalchemy import create_engine, inspect
+import threading
+
+from sqlalchemy import create_engine, event, inspect
 from sqlalchemy.orm import sessionmaker
 
 from models import (
+    Base,
     Configuration,
     Monitoring,
     Security,
@@ -17,22 +20,133 @@ import logging
 # ==========================================================================
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./sql_app.db")
 
+# Connection pool (PostgreSQL)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+# Time (ms) a SQLite connection waits for a lock before failing
+SQLITE_BUSY_TIMEOUT = int(os.getenv("SQLITE_BUSY_TIMEOUT", "30000"))
+
+_engines = {}
+_sessions = {}
+_engines_lock = threading.Lock()
+
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
 )
 logger = logging.getLogger(__name__)
 
 
+def upgrade_schema(Engine):
+    """
+    Bring an existing database up to date with models.py.
+    create_all() only creates missing tables, columns and indexes added to
+    existing tables afterwards are created here. Added columns must be
+    nullable.
+    """
+    create_tables(Engine)
+    inspector = inspect(Engine)
+    for table in Base.metadata.sorted_tables:
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            column_type = column.type.compile(dialect=Engine.dialect)
+            with Engine.begin() as connection:
+                connection.exec_driver_sql(
+                    f'ALTER TABLE {table.name} ADD COLUMN "{column.name}" {column_type}'
+                )
+            logger.info(f"Added column {table.name}.{column.name}")
+        if table.name == "install_runs":
+            # Runs left running by versions without run owners never end,
+            # they would break the unique index on the running run
+            with Engine.begin() as connection:
+                connection.exec_driver_sql(
+                    "UPDATE install_runs SET status = 'failed' "
+                    "WHERE status = 'running' AND owner IS NULL"
+                )
+        for index in table.indexes:
+            index.create(Engine, checkfirst=True)
+
+
+def get_database_uri(db_path=None):
+    db_uri = db_path if db_path else DATABASE_URL
+    if not db_uri.startswith("sqlite://") and not db_uri.startswith("postgresql://"):
+        db_uri = f"sqlite:///{db_uri}"
+    return db_uri
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL lets the API read while the installer threads write
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT}")
+    cursor.close()
+
+
+def _create_engine(db_uri):
+    if db_uri.startswith("sqlite://"):
+        Engine = create_engine(
+            db_uri,
+            connect_args={
+                "check_same_thread": False,
+                "timeout": SQLITE_BUSY_TIMEOUT / 1000,
+            },
+        )
+        # In-memory databases do not support WAL
+        if db_uri not in ("sqlite://", "sqlite:///:memory:"):
+            event.listen(Engine, "connect", _set_sqlite_pragmas)
+        return Engine
+
+    return create_engine(
+        db_uri,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=True,
+    )
+
+
+def get_engine(db_path=None):
+    """
+    Return the process-wide engine for db_path (DATABASE_URL by default).
+    The engine and its connection pool are created once per URL.
+    """
+    db_uri = get_database_uri(db_path)
+    with _engines_lock:
+        Engine = _engines.get(db_uri)
+        if Engine is None:
+            Engine = _create_engine(db_uri)
+            _engines[db_uri] = Engine
+    return Engine
+
+
+def dispose_engines():
+    """Close every pooled connection, e.g. in a forked child process."""
+    with _engines_lock:
+        for Engine in _engines.values():
+            Engine.dispose()
+        _engines.clear()
+        _sessions.clear()
+
+
 def initialize_database(db_path=None):
     """
     Initialize database with default configuration and VMs.
     MES-OMNI STYLE - Creates zones, security config, and VMs directly.
+
+    The database is checked once per process and URL, later calls return
+    the cached engine and sessionmaker.
     """
-    db_uri = db_path if db_path else DATABASE_URL
-    if not db_uri.startswith("sqlite:///") and not db_uri.startswith("postgresql://"):
-        db_uri = f"sqlite:///{db_uri}"
+    db_uri = get_database_uri(db_path)
+    with _engines_lock:
+        if db_uri in _sessions:
+            return _engines[db_uri], _sessions[db_uri]
 
-    Engine = create_engine(db_uri)
+    Engine = get_engine(db_uri)
 
     # Check if database already exists
     inspector = inspect(Engine)
@@ -104,6 +218,8 @@ def initialize_database(db_path=None):
             gateway="",            # FILL: e.g., "192.168.1.1"
             domain="",             # FILL: e.g., "local"
             vlan_name="",          # FILL: e.g., "VLAN_100"
+            ip_pool_start="",      # FILL: e.g., "192.168.1.10"
+            ip_pool_end="",        # FILL: e.g., "192.168.1.50"
         )
         session.add(zone1)
         session.commit()  # Commit zone first so we can reference it
@@ -213,8 +329,10 @@ def initialize_database(db_path=None):
         session.close()
     else:
         logger.info("Database already initialized")
+        upgrade_schema(Engine)
 
-    Session = sessionmaker(bind=Engine)
+    with _engines_lock:
+        Session = _sessions.setdefault(db_uri, sessionmaker(bind=Engine))
     return Engine, Session
 
 
@@ -4,21 +4,39 @@ Harmonisation Main installation script
 """
 
 import argparse
-import importlib.util
+import inspect
 import os
 import asyncio
+import shutil
+import tempfile
+from contextlib import asynccontextmanager, contextmanager
 import ansible_runner
-from concurrent.futures import ThreadPoolExecutor
 from repository import (
     add_ansible_role,
     add_task_logs,
-    delete_all_ansible_roles,
+    delete_role_results,
+    finish_install_run,
     get_monitoring_config,
     get_ansible_role_status,
+    get_ansible_roles,
     # get_products_to_install removed - no longer using product-based system
+    get_role_result,
     get_session,
+    heartbeat_install_run,
+    resume_install_run,
+    save_role_result,
+    set_ansible_role_fingerprint,
+    start_install_run,
+    unit_of_work,
     update_ansible_role,
+    update_ansible_role_status,
 )
+from hook_registry import HookRegistry
+from install_events import broadcaster
+from role_engine import RoleEngine
+from role_fingerprint import FINGERPRINT_MODE, FINGERPRINT_MODES, fingerprint
+from snapshot import DeploymentSnapshot, build_snapshot
+from task_log_sink import TaskLogSink
 
 
 BACKEND_ROOT = os.path.dirname(os.path.abspath(__file__))
@@ -33,9 +51,22 @@ else:
 
 print(f"[INFO] Using Ansible root path: {ANSIBLE_ROOT}")
 
+# prepare_inputs/post_install modules, loaded once and reused across runs
+role_hooks = HookRegistry(os.path.join(ANSIBLE_ROOT, "project", "roles"))
+
 
 PREPARE_SUFFIX = "-prepare-input"
-executor = ThreadPoolExecutor(120)
+# Maximum number of roles executed at the same time by install_all_roles
+MAX_PARALLEL_ROLES = int(os.getenv("INSTALL_MAX_PARALLEL_ROLES", "4"))
+# When true, no new role is started once a role failed (running ones finish).
+# When false, only the roles depending on the failed one are skipped.
+FAIL_FAST = os.getenv("INSTALL_FAIL_FAST", "true").lower() in ("1", "true", "yes")
+# Statuses of a role that let the roles depending on it start. "unchanged"
+# roles were not run again, their inputs match their last successful run.
+SATISFIED_STATUSES = ("successful", "unchanged")
+# Seconds between two heartbeats of a running install run, well below
+# INSTALL_RUN_STALE_AFTER
+HEARTBEAT_INTERVAL = float(os.getenv("INSTALL_HEARTBEAT_INTERVAL", "30"))
 
 
 # ====================================================================
@@ -77,6 +108,29 @@ noinf_roles = [
     "install-argocd",
 ]
 
+# ====================================================================
+# ROLE DEPENDENCY GRAPH
+# ====================================================================
+# A role is started as soon as every role it depends on has finished
+# successfully, so independent branches (e.g. vault / docker registry,
+# longhorn / argocd) run at the same time.
+# Dependencies that are not part of the current run are ignored.
+# A role missing from this registry depends on the role listed just
+# before it in the run (the previous sequential behaviour).
+# ====================================================================
+ROLE_DEPENDENCIES = {
+    "prepare-vms": [],
+    "install-vault": ["prepare-vms"],
+    "install-docker-registry": ["prepare-vms"],
+    "install-gogs": ["install-vault", "install-docker-registry"],
+    "install-rke2-apps": ["prepare-vms", "install-docker-registry"],
+    "install-longhorn": ["install-rke2-apps"],
+    "install-cert-manager": ["install-rke2-apps"],
+    "install-argocd": ["install-rke2-apps", "install-vault", "install-gogs"],
+    "install-monitoring": ["install-rke2-apps"],
+    "install-neuvector": ["install-rke2-apps"],
+}
+
 # Keep original lists commented for reference
 # wkube_roles = [
 #     "install-argocd",
@@ -111,30 +165,37 @@ noinf_roles = [
 # ] + nokube_roles
 
 
+def call_hook(hook, Session):
+    """
+    Call a prepare_inputs/post_install hook. Hooks declaring a snapshot
+    parameter also receive the deployment snapshot as snapshot=.
+    """
+    if isinstance(Session, DeploymentSnapshot):
+        if "snapshot" in inspect.signature(hook).parameters:
+            return hook(Session, snapshot=Session)
+    return hook(Session)
+
+
 def load_and_call_get_inputs(role_name, Session):
-    absolute_path = os.path.join(
-        ANSIBLE_ROOT, "project", "roles", role_name, "prepare_inputs.py"
-    )
-    if not os.path.exists(absolute_path):
+    absolute_path = role_hooks.hook_path(role_name, "prepare_inputs")
+    module = role_hooks.get(role_name, "prepare_inputs")
+    if module is None:
         raise ValueError(
             f"Prepare file for role '{role_name}' does not exist at {absolute_path}"
         )
 
-    spec = importlib.util.spec_from_file_location(
-        role_name + "_prepare_inputs", absolute_path
-    )
-    if spec is None or spec.loader is None:
-        raise ValueError(f"Could not load module spec for role '{role_name}'")
-
-    module = importlib.util.module_from_spec(spec)
-    spec.loader.exec_module(module)
-
     if not hasattr(module, "get_inputs"):
         raise AttributeError(
             f"Function 'get_inputs' not found in '{absolute_path}' for role '{role_name}'."
         )
 
-    result = module.get_inputs(Session)
+    if isinstance(Session, DeploymentSnapshot):
+        # The getters called by the hook answer from the snapshot
+        result = call_hook(module.get_inputs, Session)
+    else:
+        # The getters called by the hook share one session
+        with unit_of_work(Session) as uow:
+            result = module.get_inputs(uow)
     if result is None:
         raise ValueError(
             f"Function 'get_inputs' in '{absolute_path}' for role '{role_name}' returned None."
@@ -143,36 +204,97 @@ def load_and_call_get_inputs(role_name, Session):
     return result
 
 
+def load_fingerprint_state(role_name, Session):
+    """State outside of the inputs of a role, see role_fingerprint.py."""
+    module = role_hooks.get(role_name, "prepare_inputs")
+    if module is None or not hasattr(module, "fingerprint_state"):
+        return None
+    return call_hook(module.fingerprint_state, Session)
+
+
+def post_install_runs_when_unchanged(role_name):
+    module = role_hooks.get(role_name, "post_install")
+    return bool(getattr(module, "RUN_WHEN_UNCHANGED", False))
+
+
 def call_post_install(role_name, Session):
-    absolute_path = os.path.join(
-        ANSIBLE_ROOT, "project", "roles", role_name, "post_install.py"
-    )
-    if not os.path.exists(absolute_path):
+    absolute_path = role_hooks.hook_path(role_name, "post_install")
+    module = role_hooks.get(role_name, "post_install")
+    if module is None:
         print(f"Post Install file for role '{role_name}' does not exist, skipping.")
         return
 
-    spec = importlib.util.spec_from_file_location(
-        role_name + "_post_install", absolute_path
-    )
-    if spec is None or spec.loader is None:
-        raise ValueError(
-            f"Could not load module spec for post_install of role '{role_name}'"
-        )
-
-    module = importlib.util.module_from_spec(spec)
-    spec.loader.exec_module(module)
-
     if hasattr(module, "post_install"):
-        module.post_install(Session)
+        call_hook(module.post_install, Session)
     else:
         raise AttributeError(
             f"Function 'post_install' not found in '{absolute_path}' for role '{role_name}'."
         )
 
 
+def plan_role_run(role_name, extra_vars, inventory, Session, mode=None, state=None):
+    """_summary_
+    _description_
+    Fingerprint the inputs of a role and decide how to run it
+    Args:
+        role_name (string): role name
+        extra_vars (dict), inventory (dict): inputs returned by get_inputs
+        Session: database session factory
+        mode (string): skip, check or off (defaults to FINGERPRINT_MODE)
+        state: returned by the fingerprint_state hook of the role, if any
+    Returns:
+        tuple: (fingerprint, "run" | "check" | "skip")
+    """
+    if mode is None:
+        mode = FINGERPRINT_MODE
+    if mode not in FINGERPRINT_MODES:
+        raise ValueError(f"Unknown fingerprint mode '{mode}'")
+    role_path = os.path.join(ANSIBLE_ROOT, "project", "roles", role_name)
+    role_fingerprint = fingerprint(extra_vars, inventory, role_path, state=state)
+    if mode == "off":
+        return role_fingerprint, "run"
+    previous = get_role_result(role_name, Session)
+    if (
+        previous is None
+        or previous.status != "successful"
+        or previous.fingerprint != role_fingerprint
+    ):
+        return role_fingerprint, "run"
+    return role_fingerprint, "check" if mode == "check" else "skip"
+
+
+@contextmanager
+def role_data_dir(role_name):
+    """
+    Private data dir of one ansible_runner run, removed after the run.
+    ansible_runner writes the generated playbook (project/main.json), the
+    inventory and the env files into it, so roles running at the same time
+    cannot share ANSIBLE_ROOT: project/ links to the shared roles, env/
+    holds a copy of the shared env files.
+    """
+    path = tempfile.mkdtemp(prefix=f"ansible-{role_name}-")
+    try:
+        project = os.path.join(ANSIBLE_ROOT, "project")
+        os.mkdir(os.path.join(path, "project"))
+        for name in os.listdir(project):
+            if name != "main.json":
+                os.symlink(
+                    os.path.join(project, name), os.path.join(path, "project", name)
+                )
+        env = os.path.join(ANSIBLE_ROOT, "env")
+        os.mkdir(os.path.join(path, "env"))
+        if os.path.isdir(env):
+            for name in os.listdir(env):
+                # A command line left by an earlier run applies to no one else
+                if name != "cmdline" and os.path.isfile(os.path.join(env, name)):
+                    shutil.copy(os.path.join(env, name), os.path.join(path, "env"))
+        yield path
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+
 async def async_call_role(role_name, Session):
-    loop = asyncio.get_event_loop()
-    await loop.run_in_executor(executor, call_role, role_name, Session)
+    await role_engine.run(role_name, Session)
 
 
 def call_role(role_name, Session):
@@ -186,20 +308,60 @@ def call_role(role_name, Session):
     """
     print("call_role: " + role_name)
     extra_vars, inventory = load_and_call_get_inputs(role_name, Session)
-    private_data_dir = ANSIBLE_ROOT
+    role_fingerprint, run_mode = plan_role_run(
+        role_name,
+        extra_vars,
+        inventory,
+        Session,
+        state=load_fingerprint_state(role_name, Session),
+    )
+    set_ansible_role_fingerprint(role_name, role_fingerprint, Session)
+    if run_mode == "skip":
+        print(f"Role '{role_name}' inputs unchanged since its last success, skipping.")
+        if post_install_runs_when_unchanged(role_name):
+            # The hook checks by itself what is left to do
+            call_post_install(role_name, Session)
+        update_ansible_role_status(role_name, "unchanged", Session)
+        broadcaster.publish()
+        return
 
+    log_sink = TaskLogSink(Session)
     status_handler = create_status_handler(role_name, Session)
-    event_handler = create_event_handler(role_name, Session)
-    ansible_runner.run(
-        private_data_dir=private_data_dir,
-        role=role_name,
-        status_handler=status_handler,
-        event_handler=event_handler,
-        extravars=extra_vars,
-        inventory=inventory,
-        # cmdline="-vvv",
-    )
+    event_handler = create_event_handler(role_name, Session, log_sink)
+    try:
+        with role_data_dir(role_name) as private_data_dir:
+            ansible_runner.run(
+                private_data_dir=private_data_dir,
+                # Artifacts outlive the private data dir
+                artifact_dir=os.path.join(ANSIBLE_ROOT, "artifacts"),
+                role=role_name,
+                status_handler=status_handler,
+                event_handler=event_handler,
+                extravars=extra_vars,
+                inventory=inventory,
+                # cmdline="-vvv",
+                cmdline="--check" if run_mode == "check" else None,
+                # Inputs are passed as arguments, never written to env/
+                suppress_env_files=True,
+            )
+    finally:
+        # Every log of the role is stored before the role is reported done
+        log_sink.close()
+    if run_mode == "check":
+        # Dry run of an unchanged role, post_install already ran for it
+        if get_ansible_role_status(role_name, Session) == "successful":
+            update_ansible_role_status(role_name, "unchanged", Session)
+            broadcaster.publish()
+        return
     call_post_install(role_name, Session)
+    if get_ansible_role_status(role_name, Session) == "successful":
+        save_role_result(role_name, role_fingerprint, "successful", Session)
+
+
+# Runs the roles started by the scheduler, one worker per parallel role
+role_engine = RoleEngine(
+    call_role, int(os.getenv("INSTALL_ROLE_WORKERS", str(MAX_PARALLEL_ROLES)))
+)
 
 
 def check_monitoring_role_existence(Session):
@@ -212,15 +374,131 @@ def check_monitoring_role_existence(Session):
 # set_products_to_install function removed - no longer using product-based system
 
 
-async def install_all_roles(Session):
+def resolve_role_dependencies(roles):
     """_summary_
     _description_
-    Install all roles
+    Build the dependency graph restricted to the given roles
     Args:
-        status_handler (function): status handler
-        event_handler (function): event handler
+        roles (list): role names in their declaration order
+    Returns:
+        dict: role name -> list of role names it waits for
+    """
+    dependencies = {}
+    for index, role in enumerate(roles):
+        if role in ROLE_DEPENDENCIES:
+            dependencies[role] = [
+                dependency
+                for dependency in ROLE_DEPENDENCIES[role]
+                if dependency in roles and dependency != role
+            ]
+        else:
+            dependencies[role] = [roles[index - 1]] if index > 0 else []
+    return dependencies
+
+
+async def run_roles(roles, Session, max_parallel=None, fail_fast=None, done=None):
+    """_summary_
+    _description_
+    Run the given roles following ROLE_DEPENDENCIES: every role whose
+    prerequisites succeeded is started as soon as one of the max_parallel
+    slots is free. Roles that can no longer run are marked as skipped.
+    Args:
+        roles (list): role names in their declaration order
+        Session: database session factory
+        max_parallel (int): concurrency cap (defaults to MAX_PARALLEL_ROLES)
+        fail_fast (bool): stop starting roles after the first failure
+            (defaults to FAIL_FAST), otherwise continue unaffected branches
+        done (dict): role name -> status of the roles not to run again
+            (resumed install run)
+    Returns:
+        dict: role name -> final status
+    """
+    if max_parallel is None:
+        max_parallel = MAX_PARALLEL_ROLES
+    if fail_fast is None:
+        fail_fast = FAIL_FAST
+
+    dependencies = resolve_role_dependencies(roles)
+    max_parallel = max(1, max_parallel)
+    results = dict(done or {})
+    pending = [role for role in roles if role not in results]
+    running = {}
+    failed = False
+
+    async def run(role):
+        try:
+            await async_call_role(role, Session)
+            return get_ansible_role_status(role, Session)
+        except Exception as e:
+            print(f"Role '{role}' raised an error: {e}")
+            update_ansible_role_status(role, "failed", Session)
+            broadcaster.publish()
+            return "failed"
+
+    def skip(role):
+        print(f"Skipping role '{role}'")
+        pending.remove(role)
+        results[role] = "skipped"
+        update_ansible_role_status(role, "skipped", Session)
+        broadcaster.publish()
+
+    while pending or running:
+        # Start or skip roles until nothing changes
+        changed = True
+        while changed:
+            changed = False
+            for role in list(pending):
+                deps = dependencies[role]
+                if (failed and fail_fast) or any(
+                    dep in results and results[dep] not in SATISFIED_STATUSES
+                    for dep in deps
+                ):
+                    skip(role)
+                    changed = True
+                elif len(running) < max_parallel and all(
+                    results.get(dep) in SATISFIED_STATUSES for dep in deps
+                ):
+                    # Started only when a slot is free, so a failure still
+                    # skips the roles waiting for one
+                    pending.remove(role)
+                    running[role] = asyncio.ensure_future(run(role))
+                    changed = True
+
+        if not running:
+            # Remaining roles wait on each other (dependency cycle)
+            for role in list(pending):
+                skip(role)
+            break
+
+        done, _ = await asyncio.wait(
+            running.values(), return_when=asyncio.FIRST_COMPLETED
+        )
+        for role, task in list(running.items()):
+            if task in done:
+                del running[role]
+                results[role] = task.result()
+                if results[role] not in SATISFIED_STATUSES:
+                    failed = True
+
+    return results
+
+
+def prepare_install_run(Session, resume=False, force=False):
+    """_summary_
+    _description_
+    Create the install run and its roles. With resume, the latest run that
+    failed is continued instead: its satisfied roles are kept and every
+    other role gets a new attempt.
+    Args:
+        Session: database session factory
+        resume (bool): continue the latest failed run
+        force (bool): forget the fingerprints of the last successes, every
+            role runs again
+    Returns:
+        tuple: (run id, roles, role name -> status of the roles not to run)
+    Raises:
+        InstallRunConflict: another install run is running
     """
-    order = 1
     # noinf_roles = ["testrole"]  # , "testrolefailed", "testrole"]
 
     # Product-based role selection removed
@@ -230,16 +508,99 @@ async def install_all_roles(Session):
             noinf_roles.append("install-monitoring")
         if "install-neuvector" not in noinf_roles:
             noinf_roles.append("install-neuvector")
+    roles = list(noinf_roles)
+
+    install_run = resume_install_run(Session) if resume else None
+    done = {}
+    if install_run is None:
+        install_run = start_install_run(Session)
+    try:
+        # Only once the run is ours, the running run still needs them
+        if force:
+            delete_role_results(Session)
+        previous = {}
+        if install_run.resumes:
+            previous = {
+                role.role_name: role
+                for role in get_ansible_roles(Session, run_id=install_run.id)
+            }
+        for order, role in enumerate(roles, 1):
+            attempt = previous.get(role)
+            if attempt is not None and attempt.status in SATISFIED_STATUSES:
+                done[role] = attempt.status
+                continue
+            add_ansible_role(
+                role,
+                order,
+                Session,
+                run_id=install_run.id,
+                attempt=(attempt.attempt or 1) + 1 if attempt is not None else 1,
+            )
+    except Exception:
+        # Otherwise the run stays running and blocks every later /start
+        finish_install_run(install_run.id, "failed", Session)
+        raise
+    return install_run.id, roles, done
 
-    for role in noinf_roles:
-        add_ansible_role(role, order, Session)
-        order += 1
-    for role in noinf_roles:
-        await async_call_role(role, Session)
-        status = get_ansible_role_status(role, Session)
-        if status != "successful":
-            break
-        # call_role(role, Session)
+
+@asynccontextmanager
+async def install_run_heartbeat(run_id, Session, interval=None):
+    """
+    Beat the heartbeat of run_id while the block runs, other workers take
+    a run without heartbeat for the run of a stopped process.
+    """
+    if interval is None:
+        interval = HEARTBEAT_INTERVAL
+
+    async def beat():
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await asyncio.to_thread(heartbeat_install_run, run_id, Session)
+            except Exception as e:
+                print(f"Could not record the heartbeat of run {run_id}: {e}")
+
+    task = asyncio.ensure_future(beat())
+    try:
+        yield
+    finally:
+        task.cancel()
+
+
+async def install_all_roles(
+    Session, max_parallel=None, fail_fast=None, resume=False, prepared=None
+):
+    """_summary_
+    _description_
+    Install all roles
+    Args:
+        Session: database session factory
+        max_parallel (int): maximum number of roles running at the same time
+        fail_fast (bool): stop scheduling new roles after the first failure
+        resume (bool): continue the latest failed install run
+        prepared (tuple): result of prepare_install_run when already called
+    """
+    if prepared is None:
+        prepared = prepare_install_run(Session, resume=resume)
+    run_id, roles, done = prepared
+
+    try:
+        # Configuration read by the prepare_inputs hooks, loaded once for all roles
+        snapshot = build_snapshot(Session)
+        async with install_run_heartbeat(run_id, Session):
+            results = await run_roles(
+                roles,
+                snapshot,
+                max_parallel=max_parallel,
+                fail_fast=fail_fast,
+                done=done,
+            )
+    except Exception:
+        finish_install_run(run_id, "failed", Session)
+        raise
+    succeeded = all(status in SATISFIED_STATUSES for status in results.values())
+    finish_install_run(run_id, "successful" if succeeded else "failed", Session)
+    return results
 
 
 def create_status_handler(role_name, Session):
@@ -255,11 +616,29 @@ def create_status_handler(role_name, Session):
         # )
         # print("\n")
         update_ansible_role(role_name, data["runner_ident"], data["status"], Session)
+        broadcaster.publish()
 
     return my_status_handler
 
 
-def create_event_handler(role_name, Session):
+def create_event_handler(role_name, Session, log_sink=None):
+    """_summary_
+    _description_
+    Build the ansible_runner event handler storing task logs
+    Args:
+        role_name (string): role name
+        Session: database session factory
+        log_sink (TaskLogSink): batched writer, logs are written one by one
+            when not provided
+    """
+
+    def save_task_log(event, task, stdout, runner_ident):
+        if log_sink is not None:
+            log_sink.add(event, task, stdout, runner_ident)
+        else:
+            add_task_logs(event, task, stdout, runner_ident, Session)
+            broadcaster.publish()
+
     def my_event_handler(data):
         # Check if event_data exists and is a dictionary before accessing its keys
         if "event_data" in data and isinstance(data["event_data"], dict):
@@ -278,12 +657,11 @@ def create_event_handler(role_name, Session):
                 #     print("role: " + data["event_data"]["role"] + "\n")
                 print("task: " + data["event_data"]["task"] + "\n")
                 print("stdout: " + data["stdout"] + "\n")
-                add_task_logs(
+                save_task_log(
                     data["event"],
                     data["event_data"]["task"],
                     data["stdout"],
                     data["runner_ident"],
-                    Session,
                 )
         # Check for play recap event
         if data.get("event") == "playbook_on_stats":
@@ -292,12 +670,11 @@ def create_event_handler(role_name, Session):
             # print("runner_ident: " + data["runner_ident"] + "\n")
             # print("event: " + data["event"] + "\n")
             # print(data["stdout"] + "\n")
-            add_task_logs(
+            save_task_log(
                 data["event"],
                 "PLAY RECAP",
                 data["stdout"],
                 data["runner_ident"],
-                Session,
             )
 
     return my_event_handler
@@ -312,17 +689,45 @@ async def main():
         nargs="?",
         help="Role to install",
     )
+    parser.add_argument(
+        "--max-parallel",
+        type=int,
+        default=None,
+        help="Maximum number of roles running at the same time (with --role all)",
+    )
+    parser.add_argument(
+        "--continue-on-failure",
+        action="store_true",
+        help="Keep running roles that do not depend on a failed role",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue the latest failed install run (with --role all)",
+    )
     args = parser.parse_args()
     role = args.role
     DATABASE_URL = os.getenv("DATABASE_URL", "/home/devops/db/harmonisation_runner.db")
     _, Session = get_session(DATABASE_URL)
 
-    delete_all_ansible_roles(Session)
     if role == "all":
-        await install_all_roles(Session)
+        await install_all_roles(
+            Session,
+            max_parallel=args.max_parallel,
+            fail_fast=False if args.continue_on_failure else None,
+            resume=args.resume,
+        )
     else:
-        add_ansible_role(role, 1, Session)
-        call_role(role, Session)
+        install_run = start_install_run(Session)
+        add_ansible_role(role, 1, Session, run_id=install_run.id)
+        async with install_run_heartbeat(install_run.id, Session):
+            await asyncio.to_thread(call_role, role, Session)
+        status = get_ansible_role_status(role, Session)
+        finish_install_run(
+            install_run.id,
+            "successful" if status in SATISFIED_STATUSES else "failed",
+            Session,
+        )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,43 @@
+"""_summary_
+In-process notifications for install progress.
+
+The ansible_runner handlers (running in executor threads) call publish()
+after they store task logs or role statuses; streaming endpoints wait on
+the event returned by subscribe() and then read the delta from the database.
+"""
+
+import asyncio
+import threading
+
+
+class InstallEventBroadcaster:
+    """Wake up every subscribed asyncio consumer from any thread."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = {}
+
+    def subscribe(self):
+        """Register the running event loop and return the event to wait on."""
+        loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+        with self._lock:
+            self._subscribers[event] = loop
+        return event
+
+    def unsubscribe(self, event):
+        with self._lock:
+            self._subscribers.pop(event, None)
+
+    def publish(self):
+        with self._lock:
+            subscribers = list(self._subscribers.items())
+        for event, loop in subscribers:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                # Event loop already closed
+                self.unsubscribe(event)
+
+
+broadcaster = InstallEventBroadcaster()
@@ -0,0 +1,163 @@
+"""_summary_
+Bitmap IP pools.
+
+A zone's pool (ip_pool_start..ip_pool_end) is kept as one bit per address,
+set when the address is used: a /16 pool takes 8 KiB. Allocation finds the
+lowest free addresses by skipping full bytes, instead of converting and
+comparing every address of the pool.
+
+Addresses are handled as integers here (see network_math). repository.py
+builds a zone's pool from the addresses of its VMs on every allocation, so
+addresses freed by any path or process are free again at once. zone_pools
+keeps the addresses handed out but not yet stored on a VM, so they are not
+handed out twice.
+"""
+
+import threading
+
+
+class IpPool:
+    """Used/free state of the addresses start..end (integers, inclusive)."""
+
+    def __init__(self, start, end):
+        if end < start:
+            raise ValueError("IP pool end is lower than its start")
+        self.start = start
+        self.end = end
+        self.size = end - start + 1
+        self._bits = bytearray((self.size + 7) // 8)
+        # Bits past the end of the pool are marked used once and for all
+        for offset in range(self.size, len(self._bits) * 8):
+            self._bits[offset >> 3] |= 1 << (offset & 7)
+        self.used = 0
+        # No free address below this byte
+        self._hint = 0
+
+    def __contains__(self, address):
+        return self.start <= address <= self.end
+
+    def is_used(self, address):
+        offset = address - self.start
+        return bool(self._bits[offset >> 3] & (1 << (offset & 7)))
+
+    def mark(self, address):
+        """Mark address used. Addresses outside the pool are ignored."""
+        if address not in self:
+            return False
+        offset = address - self.start
+        mask = 1 << (offset & 7)
+        if self._bits[offset >> 3] & mask:
+            return False
+        self._bits[offset >> 3] |= mask
+        self.used += 1
+        return True
+
+    def mark_many(self, addresses):
+        for address in addresses:
+            self.mark(address)
+
+    def release(self, address):
+        """Mark address free again."""
+        if address not in self:
+            return False
+        offset = address - self.start
+        mask = 1 << (offset & 7)
+        if not self._bits[offset >> 3] & mask:
+            return False
+        self._bits[offset >> 3] &= ~mask
+        self.used -= 1
+        self._hint = min(self._hint, offset >> 3)
+        return True
+
+    def _free_offsets(self, count):
+        offsets = []
+        bits = self._bits
+        index = self._hint
+        length = len(bits)
+        while index < length and len(offsets) < count:
+            byte = bits[index]
+            if byte != 0xFF:
+                for bit in range(8):
+                    if not byte & (1 << bit):
+                        offsets.append((index << 3) + bit)
+                        if len(offsets) == count:
+                            break
+            elif not offsets:
+                self._hint = index + 1
+            index += 1
+        return offsets
+
+    def peek(self, count=1):
+        """The lowest count free addresses, without marking them used."""
+        return [self.start + offset for offset in self._free_offsets(count)]
+
+    def allocate(self, count=1):
+        """
+        Mark the lowest count free addresses used and return them.
+        Raises ValueError (and marks nothing) when fewer are free.
+        """
+        if count > self.size - self.used:
+            raise ValueError(
+                f"Only {self.size - self.used} free addresses, {count} requested"
+            )
+        addresses = self.peek(count)
+        for address in addresses:
+            self.mark(address)
+        return addresses
+
+    def utilization(self):
+        return {
+            "size": self.size,
+            "used": self.used,
+            "free": self.size - self.used,
+            "utilization": round(100.0 * self.used / self.size, 2),
+        }
+
+
+class ZonePools:
+    """
+    Addresses reserved (handed out, not stored on a VM yet) per zone, and
+    one lock per zone serializing its allocations in this process.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # zone_id -> (start, end, reserved addresses)
+        self._reserved = {}
+        self._zone_locks = {}
+
+    def lock(self, zone_id):
+        with self._lock:
+            return self._zone_locks.setdefault(zone_id, threading.Lock())
+
+    def reserved(self, zone_id, start, end, stored=()):
+        """
+        Reserved addresses of zone_id, minus the stored ones (now on a VM).
+        Reservations are dropped when the pool range changed.
+        """
+        with self._lock:
+            entry = self._reserved.get(zone_id)
+            if entry is None or entry[0] != start or entry[1] != end:
+                entry = self._reserved[zone_id] = (start, end, set())
+            entry[2].difference_update(stored)
+            return set(entry[2])
+
+    def reserve(self, zone_id, start, end, addresses):
+        with self._lock:
+            entry = self._reserved.get(zone_id)
+            if entry is None or entry[0] != start or entry[1] != end:
+                entry = self._reserved[zone_id] = (start, end, set())
+            entry[2].update(addresses)
+
+    def release(self, zone_id, addresses):
+        with self._lock:
+            entry = self._reserved.get(zone_id)
+            if entry is not None:
+                entry[2].difference_update(addresses)
+
+    def forget(self, zone_id):
+        with self._lock:
+            self._reserved.pop(zone_id, None)
+
+
+zone_pools = ZonePools()
@@ -7,12 +7,14 @@ from sqlalchemy import (
     Integer,
     ForeignKey,
     DateTime,
+    Index,
+    text,
 )
 from datetime import datetime
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import List, Optional, Union
 
 
 Base = declarative_base()
@@ -90,6 +92,18 @@ class ServiceModel(BaseModel):
     port: Optional[str] = None
 
 
+class ServiceTestResultModel(BaseModel):
+    kind: str
+    id: int
+    name: str
+    host: str
+    port: Optional[Union[int, str]] = None
+    protocol: str
+    is_open: bool
+    latency_ms: Optional[float] = None
+    error: Optional[str] = None
+
+
 class Security(Base):
     __tablename__ = "security"
     id = Column(Integer, primary_key=True)
@@ -104,6 +118,8 @@ class Security(Base):
     base_domain = Column(String, nullable=False)
     env_prefix = Column(String, nullable=False)
     pem_certificate = Column(Text, nullable=False)
+    # Root password of the VMs, encrypted, generated by the first install
+    root_password = Column(String, nullable=True)
     configuration_id = Column(Integer, ForeignKey("configurations.id"))
     configuration = relationship("Configuration", back_populates="security")
 
@@ -544,6 +560,36 @@ class VaultModel(BaseModel):
     token: str
 
 
+class InstallRun(Base):
+    """One /start call, grouping the attempts of its roles."""
+
+    __tablename__ = "install_runs"
+    # At most one running run, across every API worker
+    __table_args__ = (
+        Index(
+            "ux_install_runs_running",
+            "status",
+            unique=True,
+            sqlite_where=text("status = 'running'"),
+            postgresql_where=text("status = 'running'"),
+        ),
+    )
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    status = Column(String, nullable=False)
+    started_at = Column(DateTime, nullable=False)
+    finished_at = Column(DateTime)
+    # Number of times the run was resumed after a failure
+    resumes = Column(Integer, nullable=False, default=0)
+    # host:pid of the process running the roles, alive while heartbeat_at
+    # keeps moving
+    owner = Column(String)
+    heartbeat_at = Column(DateTime)
+
+    ansible_roles = relationship(
+        "AnsibleRole", back_populates="install_run", order_by="AnsibleRole.id"
+    )
+
+
 class AnsibleRole(Base):
     __tablename__ = "ansible_roles"
     id = Column(Integer, primary_key=True, autoincrement=True)
@@ -554,8 +600,29 @@ class AnsibleRole(Base):
     # start_time = Column(DateTime, default=datetime.now())
     start_time = Column(DateTime, nullable=False)
     end_time = Column(DateTime)
+    # Hash of the role inputs (role_fingerprint.py)
+    fingerprint = Column(String, nullable=True)
+    run_id = Column(Integer, ForeignKey("install_runs.id"), nullable=True)
+    # 1 for the first run of the role in its install run, +1 per resume
+    attempt = Column(Integer, nullable=True, default=1)
 
     task_logs = relationship("TaskLog", back_populates="ansible_role")
+    install_run = relationship("InstallRun", back_populates="ansible_roles")
+
+    __table_args__ = (
+        Index("ix_ansible_roles_run_id_role_name", "run_id", "role_name"),
+    )
+
+
+class RoleResult(Base):
+    """Fingerprint of the last successful run of a role, kept across installs."""
+
+    __tablename__ = "role_results"
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    role_name = Column(String, nullable=False, unique=True)
+    fingerprint = Column(String, nullable=False)
+    status = Column(String, nullable=False)
+    finished_at = Column(DateTime, nullable=False)
 
 
 class VMConfiguration(Base):
@@ -579,11 +646,29 @@ class AnsibleRoleModel(BaseModel):
     status: str
     start_time: datetime
     end_time: Optional[datetime]
+    fingerprint: Optional[str] = None
+    run_id: Optional[int] = None
+    attempt: Optional[int] = None
+
+    class Config:
+        from_attributes = True
+
+
+class InstallRunModel(BaseModel):
+    id: int
+    status: str
+    started_at: datetime
+    finished_at: Optional[datetime]
+    resumes: int
 
     class Config:
         from_attributes = True
 
 
+class InstallRunDetailModel(InstallRunModel):
+    ansible_roles: List[AnsibleRoleModel] = []
+
+
 class VMConfigurationModel(BaseModel):
     id: int
     user_count: int
@@ -609,6 +694,9 @@ class TaskLog(Base):
     runner_ident = Column(String, ForeignKey("ansible_roles.runner_ident"))
     ansible_role = relationship("AnsibleRole", back_populates="task_logs")
 
+    # Cursor pagination: WHERE runner_ident = ? AND id > ? ORDER BY id
+    __table_args__ = (Index("ix_task_logs_runner_ident_id", "runner_ident", "id"),)
+
 
 class TaskLogModel(BaseModel):
     id: int
@@ -621,10 +709,23 @@ class TaskLogModel(BaseModel):
         from_attributes = True
 
 
+class TaskLogPartialModel(BaseModel):
+    id: Optional[int] = None
+    event: Optional[str] = None
+    task: Optional[str] = None
+    runner_ident: Optional[str] = None
+    stdout: Optional[str] = None
+
+    class Config:
+        from_attributes = True
+
+
 class Configuration(Base):
     __tablename__ = "configurations"
     id = Column(Integer, primary_key=True)
     number_concurrent_users = Column(Integer, nullable=False)
+    # Bumped by the writes the capacity plans depend on, seen by every worker
+    capacity_version = Column(Integer, nullable=True)
     monitoring = relationship(
         "Monitoring", uselist=False, back_populates="configuration"
     )
@@ -0,0 +1,153 @@
+"""_summary_
+IPv4 arithmetic.
+
+Addresses are converted to 32-bit integers once: incrementing, range and
+CIDR membership are then a couple of integer operations instead of octet
+loops. Parsed strings are cached, so checking many addresses against the
+same pool bounds or network does not parse the bounds again.
+
+The batch helpers take many addresses at once (array('I'), or a NumPy
+uint32 array when NumPy is installed) to validate a whole scaffold.
+"""
+
+import ipaddress
+from array import array
+from functools import lru_cache
+
+try:
+    import numpy as np
+except ImportError:  # optional, the batch helpers fall back to array('I')
+    np = None
+
+MAX_IP = 0xFFFFFFFF
+
+
+@lru_cache(maxsize=4096)
+def ip_to_int(ip):
+    """
+    Convert IP address string to 32-bit integer for numeric comparison.
+    Example: "192.168.1.1" -> 3232235777
+    Raises ValueError for an invalid address.
+    """
+    return int(ipaddress.IPv4Address(ip))
+
+
+def int_to_ip(num):
+    """
+    Convert 32-bit integer back to IP address string.
+    Example: 3232235777 -> "192.168.1.1"
+    """
+    return str(ipaddress.IPv4Address(num & MAX_IP))
+
+
+def increment_ip(ip, n=1):
+    """ip + n, wrapping around after 255.255.255.255."""
+    return int_to_ip(ip_to_int(ip) + n)
+
+
+def is_ip_in_pool(ip, pool_start, pool_end):
+    """True if ip is in [pool_start, pool_end]."""
+    return ip_to_int(pool_start) <= ip_to_int(ip) <= ip_to_int(pool_end)
+
+
+@lru_cache(maxsize=1024)
+def parse_network(sub_network, network_mask):
+    """
+    (network address, netmask) as integers of sub_network/network_mask.
+    network_mask is a prefix length (24) or a dotted mask (255.255.255.0).
+    Raises ValueError when sub_network has host bits set.
+    """
+    network = ipaddress.IPv4Network(f"{sub_network}/{network_mask}")
+    return int(network.network_address), int(network.netmask)
+
+
+def is_ip_in_network(ip, sub_network, network_mask):
+    network, netmask = parse_network(sub_network, network_mask)
+    return ip_to_int(ip) & netmask == network
+
+
+def validate_zone_network(
+    sub_network, network_mask, gateway, ip_pool_start=None, ip_pool_end=None
+):
+    """
+    Check that a zone's network is consistent: sub_network/network_mask is
+    a valid network, and the gateway and IP pool are host addresses of it.
+    Empty values are not checked (not filled in yet). Raises ValueError.
+    """
+    if not sub_network:
+        return
+    try:
+        network, netmask = parse_network(sub_network, network_mask)
+    except ValueError as e:
+        raise ValueError(f"Invalid network {sub_network}/{network_mask}: {e}")
+    broadcast = network | (~netmask & MAX_IP)
+
+    def host_address(label, ip):
+        try:
+            address = ip_to_int(ip)
+        except ValueError:
+            raise ValueError(f"{label} {ip} is not a valid address")
+        if address & netmask != network:
+            raise ValueError(f"{label} {ip} is not in {sub_network}/{network_mask}")
+        # /31 and /32 have no network or broadcast address
+        if broadcast - network > 1 and address in (network, broadcast):
+            raise ValueError(f"{label} {ip} is not a host address")
+        return address
+
+    if gateway:
+        host_address("Gateway", gateway)
+    start = host_address("IP pool start", ip_pool_start) if ip_pool_start else None
+    end = host_address("IP pool end", ip_pool_end) if ip_pool_end else None
+    if start is not None and end is not None and end < start:
+        raise ValueError(f"IP pool end {ip_pool_end} is lower than its start")
+
+
+def to_array(ips):
+    """Addresses (strings) as a uint32 array, NumPy when available."""
+    addresses = array("I", (ip_to_int(ip) for ip in ips))
+    if np is not None:
+        return np.frombuffer(addresses, dtype=np.uint32)
+    return addresses
+
+
+def batch_in_range(addresses, start, end):
+    """Membership of each address (to_array()) in [start, end] (strings)."""
+    low, high = ip_to_int(start), ip_to_int(end)
+    if np is not None and isinstance(addresses, np.ndarray):
+        return (addresses >= low) & (addresses <= high)
+    return [low <= address <= high for address in addresses]
+
+
+def batch_in_network(addresses, sub_network, network_mask):
+    """Membership of each address (to_array()) in sub_network/network_mask."""
+    network, netmask = parse_network(sub_network, network_mask)
+    if np is not None and isinstance(addresses, np.ndarray):
+        return (addresses & np.uint32(netmask)) == np.uint32(network)
+    return [address & netmask == network for address in addresses]
+
+
+def addresses_outside(ips, sub_network, network_mask, pool_start=None, pool_end=None):
+    """
+    The ips (strings) that are invalid, outside sub_network/network_mask or,
+    when given, outside the pool [pool_start, pool_end]. Checks all the
+    addresses of a scaffold in one pass.
+    """
+    invalid = []
+    valid = []
+    for ip in ips:
+        try:
+            ip_to_int(ip)
+            valid.append(ip)
+        except ValueError:
+            invalid.append(ip)
+    if not valid:
+        return invalid
+    addresses = to_array(valid)
+    inside = batch_in_network(addresses, sub_network, network_mask)
+    if pool_start and pool_end:
+        in_pool = batch_in_range(addresses, pool_start, pool_end)
+        if np is not None and isinstance(addresses, np.ndarray):
+            inside = inside & in_pool
+        else:
+            inside = [a and b for a, b in zip(inside, in_pool)]
+    return invalid + [ip for ip, ok in zip(valid, inside) if not ok]
@@ -0,0 +1,117 @@
+"""_summary_
+In-process TCP/UDP port checks.
+
+Replaces the `nc -vz` subprocess of the service checks: probes run on the
+asyncio event loop, so many endpoints are checked concurrently without
+forking a process or holding a worker thread per check. The probes are
+coroutines, awaited by async callers (test_services_async, the
+/service-test endpoints) on their own loop.
+"""
+
+import asyncio
+import os
+import time
+
+# Seconds before a probe gives up
+PORT_PROBE_TIMEOUT = float(os.getenv("PORT_PROBE_TIMEOUT", "5"))
+# Probes running at the same time in probe_many()
+PORT_PROBE_CONCURRENCY = int(os.getenv("PORT_PROBE_CONCURRENCY", "64"))
+
+
+class _UDPProbeProtocol(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.done = asyncio.get_running_loop().create_future()
+
+    def datagram_received(self, data, addr):
+        if not self.done.done():
+            self.done.set_result(True)
+
+    def error_received(self, exc):
+        # ICMP port unreachable
+        if not self.done.done():
+            self.done.set_exception(exc)
+
+
+async def probe_tcp(host, port, timeout=PORT_PROBE_TIMEOUT):
+    """Open (and close) a TCP connection to host:port."""
+    reader, writer = await asyncio.wait_for(
+        asyncio.open_connection(host, int(port)), timeout
+    )
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except OSError:
+        pass
+
+
+async def probe_udp(host, port, timeout=PORT_PROBE_TIMEOUT):
+    """
+    Send a one-byte datagram to host:port. Like `nc -vzu`, the port counts as
+    open unless the host answers with port unreachable: a timeout without
+    an answer is not an error.
+    """
+    loop = asyncio.get_running_loop()
+    transport, protocol = await loop.create_datagram_endpoint(
+        _UDPProbeProtocol, remote_addr=(host, int(port))
+    )
+    try:
+        transport.sendto(b"\0")
+        try:
+            await asyncio.wait_for(asyncio.shield(protocol.done), timeout)
+        except asyncio.TimeoutError:
+            protocol.done.cancel()
+    finally:
+        transport.close()
+
+
+async def probe(host, port, protocol="tcp", timeout=PORT_PROBE_TIMEOUT):
+    """
+    Check host:port and return a dict with host, port, protocol, is_open,
+    latency_ms (None when closed) and error.
+    """
+    result = {
+        "host": host,
+        "port": port,
+        "protocol": protocol,
+        "is_open": False,
+        "latency_ms": None,
+        "error": None,
+    }
+    start = time.perf_counter()
+    try:
+        port = result["port"] = int(port)
+        if protocol == "udp":
+            await probe_udp(host, port, timeout)
+        else:
+            await probe_tcp(host, port, timeout)
+    except asyncio.TimeoutError:
+        result["error"] = f"Timeout after {timeout}s"
+    except (OSError, ValueError) as e:
+        result["error"] = str(e) or e.__class__.__name__
+    else:
+        result["is_open"] = True
+        result["latency_ms"] = round((time.perf_counter() - start) * 1000, 2)
+    return result
+
+
+async def probe_many(
+    targets, timeout=PORT_PROBE_TIMEOUT, concurrency=PORT_PROBE_CONCURRENCY
+):
+    """
+    Probe every target (dicts with host, port and optional protocol)
+    concurrently. Results are the targets updated with the probe fields,
+    in the same order.
+    """
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def run(target):
+        async with semaphore:
+            result = await probe(
+                target["host"],
+                target["port"],
+                target.get("protocol", "tcp"),
+                timeout,
+            )
+        return {**target, **result}
+
+    return await asyncio.gather(*(run(target) for target in targets))
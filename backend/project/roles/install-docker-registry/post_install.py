@@ -1,5 +1,18 @@
 import tempfile
-from repository import get_security
+from repository import get_security, get_virtual_machines
+from image_store import IMAGES_FOLDER, load_manifest
+from registry_seed import (
+    REGISTRY_PASSWORD,
+    REGISTRY_PORT,
+    REGISTRY_SEED_MODE,
+    REGISTRY_USER,
+    RegistryClient,
+    seed,
+)
+
+# seed() only pushes the images missing from the registry, it also runs when
+# the role is skipped to restore images removed from the registry
+RUN_WHEN_UNCHANGED = True
 
 
 def post_install(Session):
@@ -12,4 +25,28 @@ def post_install(Session):
     # Write the SSH key to a temporary file
     with tempfile.NamedTemporaryFile(delete=False, mode="w") as key_file:
         key_file.write(ssh_key_string)
-        key_file_path = key_file.name
\ No newline at end of file
+        key_file_path = key_file.name
+
+    if REGISTRY_SEED_MODE != "stream":
+        return
+    registry_ips = [
+        vm.ip
+        for vm in get_virtual_machines(Session)
+        if 'docker-registry' in vm.roles.lower()
+    ]
+    if not registry_ips:
+        print("No docker-registry VM, the registry is not seeded.")
+        return
+    # Only the images missing from the registry are streamed from /images
+    client = RegistryClient(
+        f"https://{registry_ips[0]}:{REGISTRY_PORT}", REGISTRY_USER, REGISTRY_PASSWORD
+    )
+    result = seed(client, load_manifest(), IMAGES_FOLDER)
+    print(
+        f"Registry seeded: {len(result['pushed'])} image(s) pushed, "
+        f"{result['layers']} layer(s) uploaded, {result['present']} already present."
+    )
+    if result["failed"]:
+        raise RuntimeError(
+            "Could not push to the registry: " + ", ".join(sorted(result["failed"]))
+        )
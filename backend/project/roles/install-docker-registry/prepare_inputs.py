@@ -1,5 +1,23 @@
+import os
 import tempfile, hvac
 from repository import get_security, get_vault_token
+from image_store import (
+    IMAGES_FOLDER,
+    LEGACY_INDEX_FILE,
+    MANIFEST_FILE,
+    bundle_image_ids,
+    file_sha256,
+    legacy_tar_images,
+    load_manifest,
+)
+from registry_seed import (
+    REGISTRY_PASSWORD,
+    REGISTRY_PORT,
+    REGISTRY_SEED_MODE,
+    REGISTRY_USER,
+    RegistryClient,
+    missing_images,
+)
 from repository import (
     get_virtual_machines,
     get_vms_by_group
@@ -7,6 +25,16 @@ from repository import (
 
 
 
+def fingerprint_state(Session):
+    # In stream mode post_install pushes the images of /images, a new
+    # manifest means the role has to run again
+    for name in (MANIFEST_FILE, LEGACY_INDEX_FILE):
+        path = os.path.join(IMAGES_FOLDER, name)
+        if os.path.isfile(path):
+            return {name: file_sha256(path)}
+    return None
+
+
 def get_inputs(Session):
     security = get_security(Session)
     if security is None:
@@ -60,10 +88,12 @@ def get_inputs(Session):
     }
 
     # Categorize VMs into groups based on their 'group' attribute
+    registry_ip = None
 
     for vm_name, details in vm_dict.items():
         if 'docker-registry' in details['roles'].lower():
             registry_hostname_string = details['name']
+            registry_ip = details['IP']
             inventory['registry']['hosts'][details['name']] = {
                 'ansible_host': details['IP'],
                 'ansible_user': 'devops'
@@ -89,8 +119,8 @@ def get_inputs(Session):
     # if not client.is_authenticated():
     #     raise Exception("Vault authentication failed.")
 
-    username = "devops"
-    password = "devops"
+    username = REGISTRY_USER
+    password = REGISTRY_PASSWORD
 
     # try:
     #     secret_response = client.secrets.kv.v2.read_secret_version(
@@ -117,6 +147,33 @@ def get_inputs(Session):
     "private_key":private_key,
     "certificate": certificate}
 
+    # Images and bundles of the offline image store (tar_images.py) missing
+    # from the registry, streamed by post_install unless seeded with docker
+    image_manifest = load_manifest(IMAGES_FOLDER)
+    seed_mode = REGISTRY_SEED_MODE
+    images = []
+    bundles = {}
+    if not image_manifest["images"]:
+        # No manifest: fresh install or per-image tars of older exports,
+        # every tar found is loaded and pushed with docker
+        seed_mode = "docker"
+        legacy_tars = legacy_tar_images(IMAGES_FOLDER)
+        images = sorted(set(legacy_tars.values()))
+        bundles = {file: [] for file in legacy_tars}
+    elif seed_mode == "docker":
+        if registry_ip is None:
+            raise ValueError(
+                "No VM with the docker-registry role, cannot seed the registry"
+            )
+        client = RegistryClient(
+            f"https://{registry_ip}:{REGISTRY_PORT}", username, password
+        )
+        images = missing_images(client, image_manifest)
+        bundles = bundle_image_ids(image_manifest, images)
+    extra_vars["registry_seed_mode"] = seed_mode
+    extra_vars["registry_images"] = images
+    extra_vars["registry_image_bundles"] = bundles
+
 
 
     return extra_vars, inventory
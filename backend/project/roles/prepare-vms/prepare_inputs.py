@@ -1,21 +1,14 @@
 import tempfile
-import secrets
-import string
 from repository import get_security
 import tempfile
 from repository import (
+    get_root_password,
     get_security,
     get_virtual_machines,
 )
+from ssh_pool import key_file
 
 
-def generate_password(length=16):
-    # Define the character set for the password
-    characters = string.ascii_letters + string.digits
-    # Generate a secure random password
-    password = "".join(secrets.choice(characters) for _ in range(length))
-    return password
-
 def get_inputs(Session):
     security = get_security(Session)
     all_VMs = get_virtual_machines(Session)
@@ -61,15 +54,12 @@ def get_inputs(Session):
             else:
                 f.write(vm_info["IP"] + " " + vm_info["name"] + "." + domain + "" "\n")
 
-    # Write the SSH key to a temporary file
-    with tempfile.NamedTemporaryFile(delete=False, mode="w") as public_key_file:
-        public_key_file.write(ssh_public_key_string)
-        public_key_file_path = public_key_file.name
-    with tempfile.NamedTemporaryFile(delete=False, mode="w") as private_key_file:
-        private_key_file.write(ssh_private_key_string)
-        private_key_file_path = private_key_file.name
+    # Write the SSH keys to files (reused while the keys do not change)
+    public_key_file_path = key_file(ssh_public_key_string)
+    private_key_file_path = key_file(ssh_private_key_string)
 
-    root_password = generate_password(16)
+    # Stored on the first run, a new password would change the fingerprint
+    root_password = get_root_password(Session)
     # print(private_key_file_path)
 
     # Variables to pass to Jinja2 templates
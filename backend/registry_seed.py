@@ -0,0 +1,276 @@
+"""_summary_
+Seeds the private Docker registry with the images of the offline image store
+(image_store.py), transferring only what the registry is missing.
+
+An image is present when the registry manifest of its tag points to a config
+blob whose digest is the image id recorded in the manifest. Missing images
+are streamed from their `docker save` bundle straight into the registry v2
+API: the config blob and each layer blob the registry does not have yet
+(layers already pushed for another repository are mounted instead), then an
+OCI image manifest. Nothing goes through docker load on the registry host.
+
+Layers are pushed as stored in the bundles, uncompressed, their digests are
+the diff ids of the image config. REGISTRY_SEED_MODE=docker keeps the
+docker load/tag/push path of the install-docker-registry role instead.
+"""
+
+import json
+import os
+import tarfile
+from urllib.parse import urljoin
+
+import requests
+import urllib3
+
+from image_store import split_reference
+
+REGISTRY_SEED_MODE = os.getenv("REGISTRY_SEED_MODE", "stream")
+REGISTRY_PORT = 8443
+REGISTRY_USER = os.getenv("REGISTRY_USER", "devops")
+REGISTRY_PASSWORD = os.getenv("REGISTRY_PASSWORD", "devops")
+
+MANIFEST_TYPES = (
+    "application/vnd.oci.image.manifest.v1+json",
+    "application/vnd.docker.distribution.manifest.v2+json",
+)
+OCI_MANIFEST = "application/vnd.oci.image.manifest.v1+json"
+OCI_CONFIG = "application/vnd.oci.image.config.v1+json"
+OCI_LAYER = "application/vnd.oci.image.layer.v1.tar"
+
+
+class RegistryClient:
+    """Minimal client of the registry v2 API."""
+
+    def __init__(self, url, username=None, password=None, verify=False, http=None):
+        self.url = url.rstrip("/")
+        self.auth = (username, password) if username else None
+        self.verify = verify
+        self.http = http or requests.Session()
+        if not verify:
+            urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+    def _request(self, method, path, **kwargs):
+        url = path if path.startswith("http") else self.url + path
+        return self.http.request(
+            method, url, auth=self.auth, verify=self.verify, timeout=60, **kwargs
+        )
+
+    def ping(self):
+        try:
+            return self._request("GET", "/v2/").status_code == 200
+        except requests.RequestException:
+            return False
+
+    def catalog(self):
+        repositories = set()
+        params = {"n": 1000}
+        while True:
+            response = self._request("GET", "/v2/_catalog", params=params)
+            response.raise_for_status()
+            page = response.json().get("repositories") or []
+            repositories.update(page)
+            if "next" not in response.headers.get("Link", "") or not page:
+                return repositories
+            params = {"n": 1000, "last": page[-1]}
+
+    def tags(self, repository):
+        response = self._request("GET", f"/v2/{repository}/tags/list")
+        if response.status_code == 404:
+            return set()
+        response.raise_for_status()
+        return set(response.json().get("tags") or [])
+
+    def config_digest(self, repository, tag):
+        """Config blob digest (image id) of repository:tag, None if not an image."""
+        response = self._request(
+            "GET",
+            f"/v2/{repository}/manifests/{tag}",
+            headers={"Accept": ", ".join(MANIFEST_TYPES)},
+        )
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return response.json().get("config", {}).get("digest")
+
+    def blob_exists(self, repository, digest):
+        response = self._request("HEAD", f"/v2/{repository}/blobs/{digest}")
+        return response.status_code == 200
+
+    def _start_upload(self, repository, params=None):
+        response = self._request(
+            "POST", f"/v2/{repository}/blobs/uploads/", params=params or {}
+        )
+        response.raise_for_status()
+        return response
+
+    def mount_blob(self, repository, digest, from_repository):
+        response = self._start_upload(
+            repository, {"mount": digest, "from": from_repository}
+        )
+        # 202 means the registry started a regular upload instead
+        return response.status_code == 201
+
+    def upload_blob(self, repository, digest, data, size):
+        """Monolithic upload of data (bytes or a file object read as a stream)."""
+        location = self._start_upload(repository).headers["Location"]
+        location = urljoin(self.url + "/", location)
+        separator = "&" if "?" in location else "?"
+        response = self._request(
+            "PUT",
+            f"{location}{separator}digest={digest}",
+            data=data,
+            headers={
+                "Content-Type": "application/octet-stream",
+                "Content-Length": str(size),
+            },
+        )
+        response.raise_for_status()
+
+    def put_manifest(self, repository, tag, manifest, media_type=OCI_MANIFEST):
+        response = self._request(
+            "PUT",
+            f"/v2/{repository}/manifests/{tag}",
+            data=json.dumps(manifest).encode(),
+            headers={"Content-Type": media_type},
+        )
+        response.raise_for_status()
+
+
+def missing_images(client, image_manifest):
+    """
+    References of the manifest images not in the registry, all of them when
+    the registry cannot be reached.
+    """
+    images = sorted(image_manifest["images"])
+    if not client.ping():
+        return images
+    repositories = client.catalog()
+    tags = {}
+    missing = []
+    for image in images:
+        repository, tag = split_reference(image)
+        if repository not in repositories:
+            missing.append(image)
+            continue
+        if repository not in tags:
+            tags[repository] = client.tags(repository)
+        entry = image_manifest["images"][image]
+        if tag not in tags[repository] or (
+            client.config_digest(repository, tag) != entry["image_id"]
+        ):
+            missing.append(image)
+    return missing
+
+
+def _bundle_entry(bundle, image):
+    """Entry of image in the manifest.json of a docker save bundle."""
+    saved = json.load(bundle.extractfile("manifest.json"))
+    for entry in saved:
+        if image in (entry.get("RepoTags") or []):
+            return entry
+    raise ValueError(f"{image} is not in the bundle")
+
+
+def _layer_member(bundle, name):
+    # Newer docker save bundles link the legacy layer paths to their blobs
+    member = bundle.getmember(name)
+    while member.issym() or member.islnk():
+        target = member.linkname
+        if member.issym():
+            target = os.path.normpath(os.path.join(os.path.dirname(name), target))
+        name = target
+        member = bundle.getmember(name)
+    return member
+
+
+def push_image(client, bundle_path, image, image_id, mounts=None):
+    """
+    Streams image from its bundle into the registry. mounts maps the layer
+    digests already pushed to their repository, updated with the new ones.
+
+    Returns the number of layers uploaded.
+    """
+    mounts = {} if mounts is None else mounts
+    repository, tag = split_reference(image)
+    uploaded = 0
+    with tarfile.open(bundle_path, "r") as bundle:
+        entry = _bundle_entry(bundle, image)
+        config = bundle.extractfile(entry["Config"]).read()
+        diff_ids = json.loads(config)["rootfs"]["diff_ids"]
+        if len(diff_ids) != len(entry["Layers"]):
+            raise ValueError(f"{image}: layers do not match the image config")
+
+        if not client.blob_exists(repository, image_id):
+            client.upload_blob(repository, image_id, config, len(config))
+        layers = []
+        for digest, name in zip(diff_ids, entry["Layers"]):
+            member = _layer_member(bundle, name)
+            layers.append(
+                {"mediaType": OCI_LAYER, "digest": digest, "size": member.size}
+            )
+            if client.blob_exists(repository, digest):
+                continue
+            source = mounts.get(digest)
+            if source and client.mount_blob(repository, digest, source):
+                continue
+            client.upload_blob(
+                repository, digest, bundle.extractfile(member), member.size
+            )
+            uploaded += 1
+            mounts[digest] = repository
+        for layer in layers:
+            mounts.setdefault(layer["digest"], repository)
+
+    client.put_manifest(
+        repository,
+        tag,
+        {
+            "schemaVersion": 2,
+            "mediaType": OCI_MANIFEST,
+            "config": {
+                "mediaType": OCI_CONFIG,
+                "digest": image_id,
+                "size": len(config),
+            },
+            "layers": layers,
+        },
+    )
+    return uploaded
+
+
+def seed(client, image_manifest, folder, images=None):
+    """
+    Pushes the images missing from the registry (or the given images).
+    Returns {"pushed": [...], "layers": n, "present": n, "failed": {image: error}}.
+    """
+    if images is None:
+        images = missing_images(client, image_manifest)
+    result = {
+        "pushed": [],
+        "layers": 0,
+        "present": len(image_manifest["images"]) - len(images),
+        "failed": {},
+    }
+    mounts = {}
+    for image in images:
+        entry = image_manifest["images"][image]
+        print(f"Pushing image '{image}' from '{entry['file']}'")
+        try:
+            result["layers"] += push_image(
+                client,
+                os.path.join(folder, entry["file"]),
+                image,
+                entry["image_id"],
+                mounts,
+            )
+            result["pushed"].append(image)
+        except (
+            OSError,
+            KeyError,
+            ValueError,
+            tarfile.TarError,
+            requests.RequestException,
+        ) as e:
+            print(f"Failed to push {image}: {e}")
+            result["failed"][image] = str(e)
+    return result
@@ -4,13 +4,21 @@ import socket
 import subprocess
 import datetime
 import re
+import secrets
+import string
+import threading
+from contextlib import contextmanager
 from sqlalchemy import (
     create_engine,
+    func,
+    literal,
+    or_,
+    select,
+    union_all,
 )
-from sqlalchemy.orm import sessionmaker, joinedload
-import requests
-from paramiko import RSAKey, ssh_exception, client, AutoAddPolicy
-from io import StringIO
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import sessionmaker, joinedload, selectinload
+from paramiko import ssh_exception
 
 
 import psycopg2
@@ -29,10 +37,12 @@ from models import (
     Database,
     Dns,
     FlowMatrix,
+    InstallRun,
     Ldap,
     Monitoring,
     NutanixAHV,
     # Product removed - no longer using product-based system
+    RoleResult,
     Security,
     SMSProvider,
     SMTPServer,
@@ -43,6 +53,31 @@ from models import (
     VaultCredentials,
     VMConfiguration,
 )
+from capacity import build_plan, planner as capacity_planner
+from flow_checks import load_private_key, run_flow_checks
+from ip_allocator import IpPool, zone_pools
+from network_math import (
+    addresses_outside,
+    increment_ip,
+    int_to_ip,
+    ip_to_int,
+    is_ip_in_pool,
+    validate_zone_network,
+)
+from port_probe import probe
+from response_cache import invalidates, response_cache
+from scaffolding import desired_vms, diff as diff_vms
+from snapshot import DeploymentSnapshot
+from ssh_pool import pool as ssh_pool
+from vsphere import (
+    VSPHERE_TIMEOUT,
+    VSphereAuthError,
+    VSphereClient,
+    VSphereError,
+    fetch_inventory,
+    inventory_cache,
+    resolve_inventory_ids,
+)
 import logging
 
 # TODO to be placed somewhere safer (ex: env variable)
@@ -60,12 +95,83 @@ def database_exists(db_path):
     return os.path.exists(db_path)
 
 
-def get_session():
+def get_session(db_path=None):
     """
     Get database session. Calls initialize_database() to ensure tables and VMs exist.
+    The engine and sessionmaker are cached per database URL.
     """
     from initial_db import initialize_database
-    return initialize_database()
+    return initialize_database(db_path)
+
+
+class _SharedSession:
+    """
+    Session handed to repository functions inside unit_of_work().
+    commit() only flushes and close() does nothing, the unit of work
+    commits and closes the real session.
+    """
+
+    def __init__(self, session):
+        self._session = session
+
+    def __getattr__(self, name):
+        return getattr(self._session, name)
+
+    def commit(self):
+        self._session.flush()
+
+    def close(self):
+        pass
+
+
+class UnitOfWork:
+    """
+    Session factory returning the same session on every call. The response
+    cache resources written through it are invalidated after the commit.
+    """
+
+    def __init__(self, session):
+        self.session = session
+        self._shared = _SharedSession(session)
+        self.invalidated = set()
+
+    def __call__(self):
+        return self._shared
+
+    def defer_invalidation(self, *resources):
+        self.invalidated.update(resources)
+
+
+@contextmanager
+def unit_of_work(Session):
+    """
+    Run several repository calls in one session and one transaction.
+
+        with unit_of_work(Session) as uow:
+            vms = get_vms_by_group("vault", uow)
+            update_status_vm(vms[0].id, "created", uow)
+
+    uow is passed to repository functions in place of Session. The
+    transaction is committed when the block exits and rolled back if it
+    raises. Nested unit_of_work() calls join the outer one.
+    """
+    if isinstance(Session, UnitOfWork):
+        yield Session
+        return
+
+    # Objects returned by the getters stay readable after the commit
+    session = Session(expire_on_commit=False)
+    uow = UnitOfWork(session)
+    try:
+        yield uow
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+        if uow.invalidated:
+            response_cache.invalidate(*sorted(uow.invalidated))
 
 
 def encrypt_password(plain_password: str):
@@ -85,6 +191,7 @@ def decrypt_password(encrypted_password: str):
 
 
 # Application CRUD functions
+@invalidates("configuration")
 def add_application(url, category, name, configuration_id, Session):
     """Add a new application"""
     if Session is None:
@@ -148,6 +255,7 @@ def get_applications_by_category(category, Session):
 
 # get_applications_by_product removed - no longer using product-based system
 
+@invalidates("configuration")
 def update_application(id, url, category, name, Session):
     """Update an existing application"""
     if Session is None:
@@ -171,6 +279,7 @@ def update_application(id, url, category, name, Session):
     return application
 
 
+@invalidates("configuration")
 def delete_application(id, Session):
     """Delete an application"""
     if Session is None:
@@ -187,6 +296,7 @@ def delete_application(id, Session):
     session.close()
 
 
+@invalidates("configuration")
 def delete_applications_by_configuration(configuration_id, Session):
     """Delete all applications for a configuration"""
     if Session is None:
@@ -200,13 +310,40 @@ def delete_applications_by_configuration(configuration_id, Session):
     session.close()
 
 
+# Relationships serialized by ConfigurationModel. One-to-one relations are
+# joined, collections are loaded by one SELECT ... IN query each.
+CONFIGURATION_LOAD_OPTIONS = (
+    joinedload(Configuration.security),
+    joinedload(Configuration.monitoring),
+    selectinload(Configuration.vmwares),
+    selectinload(Configuration.nutanixs),
+    selectinload(Configuration.databases),
+    selectinload(Configuration.ldaps),
+    selectinload(Configuration.sms_providers),
+    selectinload(Configuration.smtp_servers),
+)
+
+
 def getConfiguration(Session):
+    """
+    Configuration 1 with every relationship of ConfigurationModel loaded,
+    in 1 + 6 queries whatever the number of rows. The session is closed,
+    the object can be serialized without going back to the database.
+    """
     if Session is None:
         print("Session is not initialized")
         return None
     session = Session()
-    # Get configuration with id 1
-    configuration = session.query(Configuration).get(1)
+    try:
+        # Get configuration with id 1
+        configuration = (
+            session.query(Configuration)
+            .options(*CONFIGURATION_LOAD_OPTIONS)
+            .filter(Configuration.id == 1)
+            .first()
+        )
+    finally:
+        session.close()
     return configuration
 
 
@@ -220,6 +357,7 @@ def getAllConfiguration(Session):
     return configuration
 
 
+@invalidates("configuration")
 def update_number_concurent_users(number, Session):
     if Session is None:
         print("Session is not initialized")
@@ -231,11 +369,14 @@ def update_number_concurent_users(number, Session):
         session.close()
         return
     configuration.number_concurrent_users = number
+    bump_capacity_version(session)
     session.commit()
     session.close()
+    capacity_planner.invalidate()
     return configuration
 
 
+@invalidates("configuration")
 def update_current_step(number, Session):
     if Session is None:
         print("Session is not initialized")
@@ -253,6 +394,7 @@ def update_current_step(number, Session):
 
 
 # function that add a new VMware Esxi configuration
+@invalidates("hypervisors", "configuration")
 def add_vmware_esxi_configuration(
     alias,
     login,
@@ -301,9 +443,130 @@ def add_vmware_esxi_configuration(
     session.commit()
     session.refresh(vmware)
     session.close()
+    # Fill the inventory cache and the IDs the UI did not provide
+    _warm_vmware_inventory(vmware.id, api_url, login, password, api_timeout, Session)
     return vmware
 
 
+def _vmware_client(api_url, login, password, api_timeout=None):
+    timeout = api_timeout or VSPHERE_TIMEOUT
+    return VSphereClient(api_url, login, password, timeout=timeout)
+
+
+def _fetch_vmware_inventory(client):
+    """(inventory, errors) of a vCenter, None when it cannot be reached."""
+    try:
+        return fetch_inventory(client)
+    except Exception as e:
+        print(f"Error: vCenter inventory unavailable: {e}")
+        return None
+
+
+def _warm_vmware_inventory(id, api_url, login, password, api_timeout, Session):
+    """
+    Fetch the vCenter inventory of a saved hypervisor from a background
+    thread, so saving does not wait for vCenter. Returns the thread.
+    """
+    thread = threading.Thread(
+        target=_load_vmware_inventory,
+        args=(id, api_url, login, password, api_timeout, Session),
+        name=f"vsphere-inventory-{id}",
+        daemon=True,
+    )
+    thread.start()
+    return thread
+
+
+@invalidates("hypervisors", "configuration")
+def _load_vmware_inventory(id, api_url, login, password, api_timeout, Session):
+    """
+    Put the inventory of a hypervisor in inventory_cache and fill the IDs
+    it left empty. Dropped when the hypervisor was deleted or moved to
+    another vCenter during the fetch.
+    """
+    inventory = _fetch_vmware_inventory(
+        _vmware_client(api_url, login, password, api_timeout)
+    )
+    if inventory is None:
+        return
+    session = Session()
+    vmware = session.get(VMwareEsxi, id)
+    if vmware is None or (vmware.api_url, vmware.login) != (api_url, login):
+        session.close()
+        return
+    ids = _fill_vmware_ids(
+        inventory[0],
+        {
+            "datacenter_id": vmware.datacenter_id,
+            "target_id": vmware.target_id,
+            "datastore_id": vmware.datastore_id,
+            "pool_ressource_id": vmware.pool_ressource_id,
+        },
+        vmware.datacenter_name,
+        vmware.target_name,
+        vmware.target_type,
+        vmware.datastore_name,
+        vmware.pool_ressource_name,
+    )
+    for name, value in ids.items():
+        setattr(vmware, name, value)
+    session.commit()
+    session.close()
+    inventory_cache.put(id, *inventory)
+
+
+def _fill_vmware_ids(
+    inventory,
+    ids,
+    datacenter_name,
+    target_name,
+    target_type,
+    datastore_name,
+    pool_ressource_name,
+):
+    """Replace the empty IDs of ids with the ones found in the inventory."""
+    resolved = resolve_inventory_ids(
+        inventory,
+        datacenter_name,
+        target_name,
+        target_type,
+        datastore_name,
+        pool_ressource_name,
+    )
+    filled = dict(ids)
+    for name, value in ids.items():
+        if not value and resolved[name]:
+            filled[name] = resolved[name]
+    return filled
+
+
+def get_vmware_inventory(id, Session, refresh=False):
+    """
+    Cached vCenter inventory (hosts, clusters, datastores, datacenters,
+    resource pools) of a VMware hypervisor. None if the hypervisor does not
+    exist. Raises VSphereError when vCenter cannot be reached and nothing
+    is cached.
+    """
+    if Session is None:
+        print("Session is not initialized")
+        return None
+    session = Session()
+    vmware = session.query(VMwareEsxi).get(id)
+    session.close()
+    if vmware is None:
+        return None
+
+    api_url, login, api_timeout = vmware.api_url, vmware.login, vmware.api_timeout
+    password = decrypt_password(vmware.password)
+
+    def client_factory():
+        return _vmware_client(api_url, login, password, api_timeout)
+
+    if refresh:
+        inventory_cache.refresh(id, client_factory)
+    return inventory_cache.get(id, client_factory)
+
+
 def test_ldap(ldap_url, ldap_port, bind_dn, bind_credentials):
     def decode(str):
         return base64.b64decode(str).decode("utf-8")
@@ -358,119 +621,31 @@ def test_vmware_esxi_configuration(
             errors.append(error)
             return errors
 
-        sessionRequest = requests.post(
-            f"https://{api_url}/rest/com/vmware/cis/session",
-            auth=(login, password),
-            verify=False,
-        )
-        if sessionRequest.status_code != 200:
-            if sessionRequest.status_code == 401:
-                error = "Informations d’identification non valides"
-                errors.append(error)
-            else:
-                error = "Service indisponible"
-                errors.append(error)
-
-        elif sessionRequest.status_code == 200:
-            session_id = sessionRequest.json()["value"]
-            headers = {"vmware-api-session-id": session_id}
-            if target_type == "host":
-                hostsRequest = requests.get(
-                    f"https://{api_url}/rest/vcenter/host",
-                    headers=headers,
-                    verify=False,
-                )
-
-                if hostsRequest.status_code == 200:
-                    hostsList = hostsRequest.json()["value"]
-                    hosts = list(
-                        filter(
-                            lambda x: x["name"] == target_name.split("/")[1], hostsList
-                        )
-                    )
-
-                    if len(hosts) == 0:
-                        error = "Host introuvable"
-                        errors.append(error)
-                else:
-                    error = "Host Service indisponible"
-                    errors.append(error)
-
-            elif target_type == "cluster":
-                clustersRequest = requests.get(
-                    f"https://{api_url}/rest/vcenter/cluster",
-                    headers=headers,
-                    verify=False,
-                )
-
-                if clustersRequest.status_code == 200:
-                    clustersList = clustersRequest.json()["value"]
-                    clusters = list(
-                        filter(lambda x: x["name"] == target_name, clustersList)
-                    )
-                    if len(clusters) == 0:
-                        error = "Cluster introuvable"
-                        errors.append(error)
-                else:
-                    error = "Cluster Service indisponible"
-                    errors.append(error)
-
-            datastoresRequest = requests.get(
-                f"https://{api_url}/rest/vcenter/datastore",
-                headers=headers,
-                verify=False,
-            )
-
-            if datastoresRequest.status_code == 200:
-                datastoresList = datastoresRequest.json()["value"]
-                datastores = list(
-                    filter(lambda x: x["name"] == datastore_name, datastoresList)
-                )
-                if len(datastores) == 0:
-                    error = "Datastore introuvable"
-                    errors.append(error)
-            else:
-                error = "Datastore Service indisponible"
-                errors.append(error)
-
-            datacentersRequest = requests.get(
-                f"https://{api_url}/rest/vcenter/datacenter",
-                headers=headers,
-                verify=False,
-            )
-
-            if datacentersRequest.status_code == 200:
-                datacentersList = datacentersRequest.json()["value"]
-                datacenters = list(
-                    filter(lambda x: x["name"] == datacenter_name, datacentersList)
-                )
-
-                if len(datacenters) == 0:
-                    error = "Datacenter introuvable"
-                    errors.append(error)
-            else:
-                error = "Datacenter Service indisponible"
-                errors.append(error)
-
-            poolsRequest = requests.get(
-                f"https://{api_url}/rest/vcenter/resource-pool",
-                headers=headers,
-                verify=False,
-            )
-            print("testing pool")
+        vcenter = VSphereClient(api_url, login, password)
+        try:
+            vcenter.token()
+        except VSphereAuthError:
+            errors.append("Informations d’identification non valides")
+            return errors
+        except VSphereError:
+            errors.append("Service indisponible")
+            return errors
 
-            if poolsRequest.status_code == 200:
-                poolsList = poolsRequest.json()["value"]
-                pools = list(
-                    filter(lambda x: x["name"] == pool_ressource_name, poolsList)
-                )
-
-                if len(pools) == 0:
-                    error = "Resource pool introuvable"
-                    errors.append(error)
-            else:
-                error = "Resource pool Service indisponible"
-                errors.append(error)
+        checks = []
+        if target_type == "host":
+            checks.append(("host", target_name.split("/")[1], "Host"))
+        elif target_type == "cluster":
+            checks.append(("cluster", target_name, "Cluster"))
+        checks.append(("datastore", datastore_name, "Datastore"))
+        checks.append(("datacenter", datacenter_name, "Datacenter"))
+        checks.append(("resource-pool", pool_ressource_name, "Resource pool"))
+
+        results = vcenter.find_many([(kind, name) for kind, name, _ in checks])
+        for (kind, name, label), found in zip(checks, results):
+            if isinstance(found, Exception):
+                errors.append(f"{label} Service indisponible")
+            elif len(found) == 0:
+                errors.append(f"{label} introuvable")
 
         return errors
     except Exception as e:
@@ -481,9 +656,7 @@ def test_vmware_esxi_configuration(
 
 def test_key_pair_match(private_key_str, public_key_str, private_key_pwd):
     try:
-        private_key = RSAKey.from_private_key(
-            StringIO(private_key_str), private_key_pwd
-        )
+        private_key = ssh_pool.load_key(private_key_str, private_key_pwd)
 
         extracted_public_key = private_key.get_base64()
 
@@ -537,6 +710,7 @@ def test_ssl_with_domain(domain, certificate):
         return False
 
 
+@invalidates("hypervisors", "configuration")
 def update_vmware_esxi_configuration(
     id: int,
     alias: str,
@@ -577,12 +751,17 @@ def update_vmware_esxi_configuration(
     vmware.datastore_id = datastore_id
     vmware.pool_ressource_name = pool_ressource_name
     vmware.pool_ressource_id = pool_ressource_id
+
     session.commit()
     session.refresh(vmware)
     session.close()
+    # The vCenter or the credentials may have changed
+    inventory_cache.invalidate(id)
+    _warm_vmware_inventory(id, api_url, login, password, api_timeout, Session)
     return vmware
 
 
+@invalidates("hypervisors", "configuration")
 def delete_vmware_esxi_configuration(id, Session):
     if Session is None:
         print("Session is not initialized")
@@ -596,8 +775,10 @@ def delete_vmware_esxi_configuration(id, Session):
     session.delete(vmware)
     session.commit()
     session.close()
+    inventory_cache.invalidate(id)
 
 
+@invalidates("hypervisors", "configuration")
 def add_nutanix_ahv_configuration(
     alias, login, password, host, port, allow_unverified_ssl, is_connected, Session
 ):
@@ -641,6 +822,7 @@ def add_nutanix_ahv_configuration(
     return nutanix
 
 
+@invalidates("hypervisors", "configuration")
 def update_nutanix_ahv_configuration(
     id, alias, login, password, host, port, allow_unverified_ssl, Session
 ):
@@ -665,6 +847,7 @@ def update_nutanix_ahv_configuration(
     return nutanix
 
 
+@invalidates("hypervisors", "configuration")
 def delete_nutanix_ahv_configuration(id, Session):
     if Session is None:
         print("Session is not initialized")
@@ -680,32 +863,49 @@ def delete_nutanix_ahv_configuration(id, Session):
     session.close()
 
 
-def get_hypervisor_list(Session):
+def _page(query, limit=None, offset=0):
+    if offset:
+        query = query.offset(offset)
+    if limit is not None:
+        query = query.limit(limit)
+    return query
+
+
+def get_hypervisor_list(Session, type=None, is_connected=None, limit=None, offset=0):
+    """
+    id, alias, type ("vmware" or "nutanix") and is_connected of the
+    hypervisors, read with one UNION ALL of column-only selects (no
+    credentials loaded). Optionally filtered by type and is_connected and
+    paged with limit/offset.
+    """
     if Session is None:
         print("Session is not initialized")
         return []
+    listing = union_all(
+        select(
+            VMwareEsxi.id,
+            VMwareEsxi.alias,
+            literal("vmware").label("type"),
+            VMwareEsxi.is_connected,
+        ),
+        select(
+            NutanixAHV.id,
+            NutanixAHV.alias,
+            literal("nutanix").label("type"),
+            NutanixAHV.is_connected,
+        ),
+    ).subquery()
     session = Session()
-    result = []
-    vmwares = session.query(VMwareEsxi).all()
-    for vmware in vmwares:
-        result.append(
-            {
-                "id": vmware.id,
-                "alias": vmware.alias,
-                "type": "vmware",
-                "is_connected": vmware.is_connected,
-            }
-        )
-    nutanixs = session.query(NutanixAHV).all()
-    for nutanix in nutanixs:
-        result.append(
-            {
-                "id": nutanix.id,
-                "alias": nutanix.alias,
-                "type": "nutanix",
-                "is_connected": nutanix.is_connected,
-            }
-        )
+    query = session.query(
+        listing.c.id, listing.c.alias, listing.c.type, listing.c.is_connected
+    )
+    if type is not None:
+        query = query.filter(listing.c.type == type)
+    if is_connected is not None:
+        query = query.filter(listing.c.is_connected == is_connected)
+    # VMware first, as before
+    query = query.order_by(listing.c.type.desc(), listing.c.id)
+    result = [row._asdict() for row in _page(query, limit, offset)]
     session.close()
     return result
 
@@ -724,6 +924,7 @@ def get_hypervisor(id, type, Session):
     return hypervisor
 
 
+@invalidates("hypervisors", "configuration")
 def delete_hypervisor(id, type, Session):
     if Session is None:
         print("Session is not initialized")
@@ -741,18 +942,23 @@ def delete_hypervisor(id, type, Session):
     session.delete(hypervisor)
     session.commit()
     session.close()
+    if type == "vmware":
+        inventory_cache.invalidate(id)
 
 
 def get_databases(Session):
     if Session is None:
         print("Session is not initialized")
         return []
+    if isinstance(Session, DeploymentSnapshot):
+        return list(Session.databases)
     session = Session()
     databases = session.query(Database).all()
     session.close()
     return databases
 
 
+@invalidates("services", "configuration")
 def add_database(
     name, type, alias, host, port, login, password, Session, servername=None
 ):
@@ -784,6 +990,7 @@ def add_database(
     return database
 
 
+@invalidates("services", "configuration")
 def update_database(
     id, name, type, alias, host, port, login, password, Session, servername=None
 ):
@@ -811,6 +1018,7 @@ def update_database(
     return database
 
 
+@invalidates("services", "configuration")
 def delete_database(id, Session):
     if Session is None:
         print("Session is not initialized")
@@ -927,23 +1135,63 @@ def url_parser(url):
     return host, port
 
 
-def test_services(destination, Session, port=None):
+def service_target(destination, port=None):
+    """Host and port checked for a service destination (URL or host[:port])."""
     if not port:
-        print(destination, port)
-        try:
-            host, port1 = url_parser(destination)
-            return test_service_port(host, port1)
-        except Exception as e:
-            print(f"An error occurred: {e}")
-            return False
-    else:
-        return test_service_port(destination, port)
+        return url_parser(destination)
+    return destination, port
+
+
+async def test_services_async(destination, port=None):
+    try:
+        host, port = service_target(destination, port)
+    except Exception as e:
+        print(f"An error occurred: {e}")
+        return False
+    result = await probe(host, port)
+    if result["error"]:
+        print(f"Error: {result['error']}")
+    return result["is_open"]
+
+
+def get_service_endpoints(Session):
+    """
+    Every external endpoint of the configuration (SMS providers, SMTP
+    servers, LDAPs, databases) as dicts with kind, id, name, host, port.
+    """
+    endpoints = []
+
+    def add_endpoint(kind, id, name, host, port):
+        endpoints.append(
+            {"kind": kind, "id": id, "name": name, "host": host, "port": port}
+        )
+
+    with unit_of_work(Session) as uow:
+        for provider in get_sms_providers(uow):
+            try:
+                host, port = url_parser(provider.url)
+            except Exception as e:
+                print(f"An error occurred: {e}")
+                continue
+            add_endpoint("sms", provider.id, provider.url, host, port)
+        for server in get_smtp_servers(uow):
+            add_endpoint("smtp", server.id, server.host, server.host, server.port)
+        for ldap in get_ldaps(uow):
+            host = ldap.ldap_url.split("://")[-1].split("/")[0].split(":")[0]
+            add_endpoint("ldap", ldap.id, ldap.ldap_url, host, ldap.ldap_port)
+        for database in get_databases(uow):
+            add_endpoint(
+                "database", database.id, database.alias, database.host, database.port
+            )
+    return endpoints
 
 
 def get_monitoring_config(Session):
     if Session is None:
         print("Session is not initialized")
         return None
+    if isinstance(Session, DeploymentSnapshot):
+        return Session.monitoring
     session = Session()
     monitoring = session.query(Monitoring).get(1)
     session.close()
@@ -953,6 +1201,7 @@ def get_monitoring_config(Session):
     return monitoring
 
 
+@invalidates("configuration")
 def update_monitoring_config(
     deploy_embeded_monitoring_stack,
     logs_retention_period,
@@ -985,12 +1234,15 @@ def get_ldaps(Session):
     if Session is None:
         print("Session is not initialized")
         return []
+    if isinstance(Session, DeploymentSnapshot):
+        return list(Session.ldaps)
     session = Session()
     ldaps = session.query(Ldap).all()
     session.close()
     return ldaps
 
 
+@invalidates("services", "configuration")
 def add_ldap(
     ldap_type,
     ldap_url,
@@ -1029,6 +1281,7 @@ def add_ldap(
     return ldap
 
 
+@invalidates("services", "configuration")
 def update_ldap(
     id,
     ldap_type,
@@ -1064,6 +1317,7 @@ def update_ldap(
     return ldap
 
 
+@invalidates("services", "configuration")
 def delete_ldap(id, Session):
     if Session is None:
         print("Session is not initialized")
@@ -1083,6 +1337,8 @@ def get_security(Session):
     if Session is None:
         print("Session is not initialized")
         return None
+    if isinstance(Session, DeploymentSnapshot):
+        return Session.security
     session = Session()
     security = session.query(Security).get(1)
     session.close()
@@ -1092,6 +1348,34 @@ def get_security(Session):
     return security
 
 
+def get_root_password(Session, length=16):
+    """
+    Root password of the VMs. Generated and stored (encrypted) on the first
+    call, the same password is returned afterwards so the inputs of
+    prepare-vms do not change from one run to the next.
+    """
+    if Session is None:
+        print("Session is not initialized")
+        return None
+    session = Session()
+    characters = string.ascii_letters + string.digits
+    generated = "".join(secrets.choice(characters) for _ in range(length))
+    # Only the first of concurrent callers stores its password
+    session.query(Security).filter(
+        Security.id == 1, Security.root_password.is_(None)
+    ).update(
+        {"root_password": encrypt_password(generated)}, synchronize_session=False
+    )
+    session.commit()
+    stored = session.query(Security.root_password).filter(Security.id == 1).scalar()
+    session.close()
+    if stored is None:
+        print("Security configuration not found")
+        return None
+    return decrypt_password(stored)
+
+
+@invalidates("configuration")
 def update_security(
     use_proxy,
     porxy_host,
@@ -1152,6 +1436,7 @@ def get_zone_by_id(id, Session):
     return zone
 
 
+@invalidates("zones")
 def add_zone(
     name,
     sub_network,
@@ -1169,6 +1454,9 @@ def add_zone(
     if Session is None:
         print("Session is not initialized")
         return
+    validate_zone_network(
+        sub_network, network_mask, gateway, ip_pool_start, ip_pool_end
+    )
     session = Session()
     zone = None
 
@@ -1219,6 +1507,7 @@ def add_zone(
     return zone
 
 
+@invalidates("zones")
 def update_zone(
     id,
     name,
@@ -1237,6 +1526,9 @@ def update_zone(
     if Session is None:
         print("Session is not initialized")
         return
+    validate_zone_network(
+        sub_network, network_mask, gateway, ip_pool_start, ip_pool_end
+    )
     session = Session()
     zone = None  # Initialize zone to None
     try:
@@ -1276,6 +1568,8 @@ def update_zone(
 
         # Commit the changes
         session.commit()
+        # The pool range may have changed
+        zone_pools.forget(id)
 
         # Refresh the object to ensure it's up-to-date
         session.refresh(zone)
@@ -1299,12 +1593,15 @@ def get_sms_providers(Session):
     if Session is None:
         print("Session is not initialized")
         return []
+    if isinstance(Session, DeploymentSnapshot):
+        return list(Session.sms_providers)
     session = Session()
     sms_providers = session.query(SMSProvider).all()
     session.close()
     return sms_providers
 
 
+@invalidates("services", "configuration")
 def add_sms_provider(url, login, password, binder, Session):
     if Session is None:
         print("Session is not initialized")
@@ -1366,6 +1663,7 @@ def add_vault_token(token, Session):
     return token_payload
 
 
+@invalidates("services", "configuration")
 def update_sms_provider(id, url, login, password, binder, Session):
     if Session is None:
         print("Session is not initialized")
@@ -1387,6 +1685,7 @@ def update_sms_provider(id, url, login, password, binder, Session):
     return sms_provider
 
 
+@invalidates("services", "configuration")
 def delete_sms_provider(id, Session):
     if Session is None:
         print("Session is not initialized")
@@ -1407,12 +1706,15 @@ def get_smtp_servers(Session):
     if Session is None:
         print("Session is not initialized")
         return []
+    if isinstance(Session, DeploymentSnapshot):
+        return list(Session.smtp_servers)
     session = Session()
     smtp_servers = session.query(SMTPServer).all()
     session.close()
     return smtp_servers
 
 
+@invalidates("services", "configuration")
 def add_smtp_server(host, port, login, password, mail_from, use_tls_ssl, Session):
     if Session is None:
         print("Session is not initialized")
@@ -1439,6 +1741,7 @@ def add_smtp_server(host, port, login, password, mail_from, use_tls_ssl, Session
     return smtp_server
 
 
+@invalidates("services", "configuration")
 def update_smtp_provider(
     id, host, login, password, mail_from, use_tls_ssl, port, Session
 ):
@@ -1463,6 +1766,7 @@ def update_smtp_provider(
     return smtp_provider
 
 
+@invalidates("services", "configuration")
 def delete_smtp_server(id, Session):
     if Session is None:
         print("Session is not initialized")
@@ -1490,40 +1794,41 @@ def delete_smtp_server(id, Session):
 # These only handled client-specific services (Alfresco, Auth, GCBO, GMAO, Firebase, etc.)
 
 
-def get_services(Session):
-    """Get all generic services (SMS, SMTP, LDAP, Database)"""
+def get_services(Session, type=None, limit=None, offset=0):
+    """
+    Get all generic services (SMS, SMTP, LDAP, Database) as (id, type)
+    pairs, read with one UNION ALL of column-only selects. Optionally
+    filtered by type and paged with limit/offset.
+    """
     if Session is None:
         print("Session is not initialized")
         return []
-    session = Session()
-    result = []
-    
     # Generic services only - client-specific services removed
-    # get all sms providers
-    sms_providers = session.query(SMSProvider).all()
-    for sms_provider in sms_providers:
-        result.append({"id": sms_provider.id, "type": "sms_provider"})
-    
-    # get all smtp servers
-    smtp_servers = session.query(SMTPServer).all()
-    for smtp_server in smtp_servers:
-        result.append({"id": smtp_server.id, "type": "smtp_server"})
-    
-    # get all ldap providers
-    ldap_providers = session.query(Ldap).all()
-    for ldap_provider in ldap_providers:
-        result.append(
-            {
-                "id": ldap_provider.id,
-                "type": ldap_provider.ldap_type,
-            }
-        )
-    
-    # get all databases
-    databases = session.query(Database).all()
-    for database in databases:
-        result.append({"id": database.id, "type": "database"})
-    
+    # The rank keeps the previous order: SMS, SMTP, LDAP then databases
+    listing = union_all(
+        select(
+            SMSProvider.id,
+            literal("sms_provider").label("type"),
+            literal(0).label("rank"),
+        ),
+        select(
+            SMTPServer.id,
+            literal("smtp_server").label("type"),
+            literal(1).label("rank"),
+        ),
+        select(Ldap.id, Ldap.ldap_type.label("type"), literal(2).label("rank")),
+        select(
+            Database.id,
+            literal("database").label("type"),
+            literal(3).label("rank"),
+        ),
+    ).subquery()
+    session = Session()
+    query = session.query(listing.c.id, listing.c.type)
+    if type is not None:
+        query = query.filter(listing.c.type == type)
+    query = query.order_by(listing.c.rank, listing.c.id)
+    result = [row._asdict() for row in _page(query, limit, offset)]
     session.close()
     return result
 
@@ -1562,12 +1867,15 @@ def get_virtual_machines(Session):
     if Session is None:
         print("Session is not initialized")
         return []
+    if isinstance(Session, DeploymentSnapshot):
+        return list(Session.virtual_machines)
     session = Session()
     virtual_machines = session.query(VirtualMachine).all()
     session.close()
     return virtual_machines
 
 
+@invalidates("virtual_machines")
 def add_virtual_machine(
     hostname,
     roles,
@@ -1601,11 +1909,14 @@ def add_virtual_machine(
         zone=zone,
     )
     zone.virtual_machines.append(virtual_machine)
+    bump_capacity_version(session)
     session.commit()
     session.close()
+    capacity_planner.invalidate()
     return virtual_machine
 
 
+@invalidates("virtual_machines")
 def update_virtual_machine(
     id,
     hostname,
@@ -1629,6 +1940,7 @@ def update_virtual_machine(
         print("Virtual Machine not found")
         session.close()
         return
+    previous_zone_id, previous_ip = virtual_machine.zone_id, virtual_machine.ip
     virtual_machine.hostname = hostname
     virtual_machine.roles = roles
     virtual_machine.group = group
@@ -1644,7 +1956,11 @@ def update_virtual_machine(
         session.close()
         return
     virtual_machine.zone = zone
+    bump_capacity_version(session)
     session.commit()
+    if (previous_zone_id, previous_ip) != (zone_id, ip):
+        release_ips(previous_zone_id, [previous_ip])
+    capacity_planner.invalidate()
     session.refresh(virtual_machine)
     if group == "LBLAN":
         update_dns_related_ip(ip, Session)
@@ -1654,6 +1970,29 @@ def update_virtual_machine(
     return virtual_machine
 
 
+@invalidates("virtual_machines")
+def delete_virtual_machine(id, Session):
+    if Session is None:
+        print("Session is not initialized")
+        return
+    session = Session()
+    virtual_machine = session.query(VirtualMachine).get(id)
+    if virtual_machine is None:
+        print("Virtual Machine not found")
+        session.close()
+        return
+    zone_id, ip = virtual_machine.zone_id, virtual_machine.ip
+    session.delete(virtual_machine)
+    bump_capacity_version(session)
+    session.commit()
+    session.close()
+    # The address can be allocated again
+    release_ips(zone_id, [ip])
+    capacity_planner.invalidate()
+    return virtual_machine
+
+
+@invalidates("virtual_machines")
 def update_status_vm(id, status, Session):
     if Session is None:
         print("Session is not initialized")
@@ -1686,6 +2025,8 @@ def get_vms_by_group(group, Session):
     if Session is None:
         print("Session is not initialized")
         return []
+    if isinstance(Session, DeploymentSnapshot):
+        return Session.get_vms_by_group(group)
     session = Session()
     virtual_machines = (
         session.query(VirtualMachine).filter(VirtualMachine.group == group).all()
@@ -1726,6 +2067,7 @@ def get_all_dns(Session):
     return dns
 
 
+@invalidates("dns")
 def add_dns(name, hostname, ip, Session):
     if Session is None:
         print("Session is not initialized")
@@ -1744,6 +2086,7 @@ def add_dns(name, hostname, ip, Session):
         session.close()
 
 
+@invalidates("dns")
 def update_dns_related_ip(new_ip, Session):
     if Session is None:
         print("Session is not initialized")
@@ -1771,6 +2114,7 @@ def get_flow_matrix(Session):
     return flow_matrix
 
 
+@invalidates("flow_matrix")
 def add_flow_matrix(source, destination, protocol, port, Session, description=None):
     if Session is None:
         print("Session is not initialized")
@@ -1790,6 +2134,29 @@ def add_flow_matrix(source, destination, protocol, port, Session, description=No
     return flow_matrix
 
 
+@invalidates("flow_matrix")
+def update_status_flows(results, Session):
+    """Write the is_open status of many flows ({flow id: is_open}) at once."""
+    if Session is None:
+        print("Session is not initialized")
+        return
+    if not results:
+        return
+    session = Session()
+    try:
+        session.bulk_update_mappings(
+            FlowMatrix,
+            [{"id": id, "is_open": is_open} for id, is_open in results.items()],
+        )
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+@invalidates("flow_matrix")
 def update_status_flow(id, is_open, Session):
     if Session is None:
         print("Session is not initialized")
@@ -1806,6 +2173,7 @@ def update_status_flow(id, is_open, Session):
     return flow_matrix
 
 
+@invalidates("flow_matrix")
 def update_flow_matrix_source(new_source, Session):
     if Session is None:
         print("Session is not initialized")
@@ -1825,22 +2193,83 @@ def update_flow_matrix_source(new_source, Session):
         session.close()
 
 
-def get_ansible_roles(Session):
+# Number of install runs kept with their roles and task logs
+INSTALL_RUN_RETENTION = int(os.getenv("INSTALL_RUN_RETENTION", "5"))
+# A running run whose heartbeat is older than this (seconds) lost its owner
+INSTALL_RUN_STALE_AFTER = float(os.getenv("INSTALL_RUN_STALE_AFTER", "120"))
+
+
+class InstallRunConflict(Exception):
+    """Another install run is running."""
+
+
+def install_run_owner():
+    """Owner recorded on the runs started by this process."""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _owner_gone(install_run, now, stale_after):
+    if (
+        install_run.heartbeat_at is None
+        or (now - install_run.heartbeat_at).total_seconds() > stale_after
+    ):
+        return True
+    host, _, pid = (install_run.owner or "").rpartition(":")
+    if host != socket.gethostname():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except (ValueError, PermissionError):
+        pass
+    return False
+
+
+def _latest_run_id(session):
+    return session.query(func.max(InstallRun.id)).scalar()
+
+
+def _current_ansible_role(session, role_name):
+    # The latest attempt of the role, earlier runs and attempts are history
+    return (
+        session.query(AnsibleRole)
+        .filter(AnsibleRole.role_name == role_name)
+        .order_by(AnsibleRole.id.desc())
+        .first()
+    )
+
+
+def get_ansible_roles(Session, after_order=None, limit=None, run_id=None):
+    """
+    Latest attempt of each role of an install run (default: the latest run).
+    """
     if Session is None:
         print("Session is not initialized")
         return []
     session = Session()
-    ansible_roles = (
-        session.query(AnsibleRole)
-        # .filter(AnsibleRole.status.notin_(["failed", "successful"]))
-        .order_by(AnsibleRole.order.asc())
-        .all()
-    )
+    query = session.query(AnsibleRole)
+    # .filter(AnsibleRole.status.notin_(["failed", "successful"]))
+    if run_id is None:
+        run_id = _latest_run_id(session)
+    if run_id is not None:
+        attempts = (
+            session.query(func.max(AnsibleRole.id))
+            .filter(AnsibleRole.run_id == run_id)
+            .group_by(AnsibleRole.role_name)
+        )
+        query = query.filter(AnsibleRole.id.in_(attempts))
+    if after_order is not None:
+        query = query.filter(AnsibleRole.order > after_order)
+    query = query.order_by(AnsibleRole.order.asc())
+    if limit is not None:
+        query = query.limit(limit)
+    ansible_roles = query.all()
     session.close()
     return ansible_roles
 
 
-def add_ansible_role(role_name, order, Session):
+def add_ansible_role(role_name, order, Session, run_id=None, attempt=1):
     if Session is None:
         print("Session is not initialized")
         return
@@ -1850,6 +2279,8 @@ def add_ansible_role(role_name, order, Session):
         order=order,
         start_time=datetime.datetime.now(),
         status="init",
+        run_id=run_id,
+        attempt=attempt,
     )
     session.add(ansible_role)
     session.commit()
@@ -1868,9 +2299,7 @@ def update_ansible_role(role_name, runner_ident, status, Session):
     #     .order_by(AnsibleRole.order)
     #     .first()
     # )
-    ansible_role = (
-        session.query(AnsibleRole).filter(AnsibleRole.role_name == role_name).first()
-    )
+    ansible_role = _current_ansible_role(session, role_name)
     if ansible_role is None:
         print("Ansible Role not found")
         session.close()
@@ -1886,30 +2315,305 @@ def update_ansible_role(role_name, runner_ident, status, Session):
     return ansible_role
 
 
+def update_ansible_role_status(role_name, status, Session):
+    """
+    Set the status of a role without touching its runner_ident.
+    Used by the scheduler for roles that failed before ansible_runner
+    started or that were skipped because a prerequisite did not succeed.
+    """
+    if Session is None:
+        print("Session is not initialized")
+        return
+    session = Session()
+    ansible_role = _current_ansible_role(session, role_name)
+    if ansible_role is None:
+        print("Ansible Role not found")
+        session.close()
+        return
+    ansible_role.status = status
+    ansible_role.end_time = datetime.datetime.now()
+    session.commit()
+    session.close()
+    return ansible_role
+
+
 def get_ansible_role_status(role_name, Session):
     if Session is None:
         print("Session is not initialized")
         return
     session = Session()
-    ansible_role = (
-        session.query(AnsibleRole).filter(AnsibleRole.role_name == role_name).first()
-    )
+    ansible_role = _current_ansible_role(session, role_name)
     return ansible_role.status
 
 
-def get_task_logs(runner_ident, Session):
+def set_ansible_role_fingerprint(role_name, fingerprint, Session):
+    """Store the fingerprint of the inputs of the current run of a role."""
+    if Session is None:
+        print("Session is not initialized")
+        return
+    session = Session()
+    ansible_role = _current_ansible_role(session, role_name)
+    if ansible_role is None:
+        print("Ansible Role not found")
+        session.close()
+        return
+    ansible_role.fingerprint = fingerprint
+    session.commit()
+    session.close()
+    return ansible_role
+
+
+def get_role_result(role_name, Session):
+    """Last successful run of a role (fingerprint), None if it never succeeded."""
+    if Session is None:
+        print("Session is not initialized")
+        return
+    session = Session()
+    role_result = (
+        session.query(RoleResult).filter(RoleResult.role_name == role_name).first()
+    )
+    session.close()
+    return role_result
+
+
+def save_role_result(role_name, fingerprint, status, Session):
+    if Session is None:
+        print("Session is not initialized")
+        return
+    session = Session()
+    role_result = (
+        session.query(RoleResult).filter(RoleResult.role_name == role_name).first()
+    )
+    if role_result is None:
+        role_result = RoleResult(role_name=role_name)
+        session.add(role_result)
+    role_result.fingerprint = fingerprint
+    role_result.status = status
+    role_result.finished_at = datetime.datetime.now()
+    session.commit()
+    session.close()
+    return role_result
+
+
+def delete_role_results(Session, role_name=None):
+    """Forget the successful runs, every role (or role_name) runs again."""
+    if Session is None:
+        print("Session is not initialized")
+        return
+    session = Session()
+    query = session.query(RoleResult)
+    if role_name is not None:
+        query = query.filter(RoleResult.role_name == role_name)
+    query.delete()
+    session.commit()
+    session.close()
+
+
+def get_task_logs(runner_ident, Session, after_id=None, limit=None, event=None):
+    """
+    Get the task logs of a runner, oldest first.
+    after_id only returns logs stored after that id (cursor), limit caps the
+    number of rows and event keeps a single event type. Served by the
+    (runner_ident, id) index of task_logs.
+    """
     if Session is None:
         print("Session is not initialized")
         return []
     session = Session()
-    task_logs = (
-        session.query(TaskLog)
-        .filter(TaskLog.runner_ident == runner_ident)
-        .order_by(TaskLog.id.asc())
+    query = session.query(TaskLog).filter(TaskLog.runner_ident == runner_ident)
+    if after_id is not None:
+        query = query.filter(TaskLog.id > after_id)
+    if event is not None:
+        query = query.filter(TaskLog.event == event)
+    query = query.order_by(TaskLog.id.asc())
+    if limit is not None:
+        query = query.limit(limit)
+    task_logs = query.all()
+    session.close()
+    return task_logs
+
+
+def start_install_run(Session, retention=None):
+    """
+    Create a new install run. The runs beyond the retention limit
+    (INSTALL_RUN_RETENTION) are deleted with their roles and task logs.
+
+    Raises:
+        InstallRunConflict: another run is running (unique index of the
+            running run, so it holds across processes)
+    """
+    if Session is None:
+        print("Session is not initialized")
+        return
+    if retention is None:
+        retention = INSTALL_RUN_RETENTION
+    session = Session()
+    now = datetime.datetime.now()
+    install_run = InstallRun(
+        status="running",
+        started_at=now,
+        resumes=0,
+        owner=install_run_owner(),
+        heartbeat_at=now,
+    )
+    session.add(install_run)
+    try:
+        session.flush()
+    except IntegrityError:
+        session.rollback()
+        session.close()
+        raise InstallRunConflict("An install run is already running")
+    expired = [
+        id
+        for (id,) in session.query(InstallRun.id)
+        .order_by(InstallRun.id.desc())
+        .offset(max(1, retention))
         .all()
+    ]
+    # Roles stored before install runs existed are removed with the first ones
+    expired_roles = session.query(AnsibleRole).filter(
+        (AnsibleRole.run_id.in_(expired)) | (AnsibleRole.run_id.is_(None))
+    )
+    runner_idents = [
+        runner_ident
+        for (runner_ident,) in expired_roles.with_entities(AnsibleRole.runner_ident)
+        if runner_ident is not None
+    ]
+    session.query(TaskLog).filter(TaskLog.runner_ident.in_(runner_idents)).delete(
+        synchronize_session=False
+    )
+    expired_roles.delete(synchronize_session=False)
+    session.query(InstallRun).filter(InstallRun.id.in_(expired)).delete(
+        synchronize_session=False
     )
+    session.commit()
+    session.refresh(install_run)
     session.close()
-    return task_logs
+    return install_run
+
+
+def resume_install_run(Session):
+    """
+    Reopen the latest install run if it failed, None when there is nothing
+    to resume. A run still running is never reopened.
+
+    Raises:
+        InstallRunConflict: another run is running
+    """
+    if Session is None:
+        print("Session is not initialized")
+        return
+    session = Session()
+    install_run = session.query(InstallRun).order_by(InstallRun.id.desc()).first()
+    if install_run is None or install_run.status != "failed":
+        session.close()
+        return None
+    install_run.status = "running"
+    install_run.finished_at = None
+    install_run.resumes = (install_run.resumes or 0) + 1
+    install_run.owner = install_run_owner()
+    install_run.heartbeat_at = datetime.datetime.now()
+    try:
+        session.commit()
+    except IntegrityError:
+        session.rollback()
+        session.close()
+        raise InstallRunConflict("An install run is already running")
+    session.refresh(install_run)
+    session.close()
+    return install_run
+
+
+def heartbeat_install_run(run_id, Session):
+    """Record that the owner of a running run is alive."""
+    if Session is None:
+        print("Session is not initialized")
+        return
+    session = Session()
+    session.query(InstallRun).filter(
+        InstallRun.id == run_id, InstallRun.status == "running"
+    ).update(
+        {"heartbeat_at": datetime.datetime.now()}, synchronize_session=False
+    )
+    session.commit()
+    session.close()
+
+
+def fail_interrupted_install_runs(Session, stale_after=None):
+    """
+    Mark as failed the running runs whose owner is gone: no heartbeat for
+    stale_after seconds (INSTALL_RUN_STALE_AFTER), or a process of this
+    host that no longer exists. Runs of live workers are left alone.
+    Returns the number of runs updated.
+    """
+    if Session is None:
+        print("Session is not initialized")
+        return 0
+    if stale_after is None:
+        stale_after = INSTALL_RUN_STALE_AFTER
+    session = Session()
+    now = datetime.datetime.now()
+    gone = [
+        install_run.id
+        for install_run in session.query(InstallRun).filter(
+            InstallRun.status == "running"
+        )
+        if _owner_gone(install_run, now, stale_after)
+    ]
+    if gone:
+        session.query(InstallRun).filter(
+            InstallRun.id.in_(gone), InstallRun.status == "running"
+        ).update({"status": "failed", "finished_at": now}, synchronize_session=False)
+    session.commit()
+    session.close()
+    return len(gone)
+
+
+def finish_install_run(run_id, status, Session):
+    if Session is None:
+        print("Session is not initialized")
+        return
+    session = Session()
+    install_run = session.get(InstallRun, run_id)
+    if install_run is None:
+        print("Install run not found")
+        session.close()
+        return
+    install_run.status = status
+    install_run.finished_at = datetime.datetime.now()
+    session.commit()
+    session.close()
+    return install_run
+
+
+def get_install_runs(Session, limit=None):
+    """Install runs, newest first."""
+    if Session is None:
+        print("Session is not initialized")
+        return []
+    session = Session()
+    query = session.query(InstallRun).order_by(InstallRun.id.desc())
+    if limit is not None:
+        query = query.limit(limit)
+    install_runs = query.all()
+    session.close()
+    return install_runs
+
+
+def get_install_run(run_id, Session):
+    """An install run with every attempt of its roles."""
+    if Session is None:
+        print("Session is not initialized")
+        return
+    session = Session()
+    install_run = (
+        session.query(InstallRun)
+        .options(selectinload(InstallRun.ansible_roles))
+        .filter(InstallRun.id == run_id)
+        .first()
+    )
+    session.close()
+    return install_run
 
 
 def delete_all_ansible_roles(Session):
@@ -1923,17 +2627,38 @@ def delete_all_ansible_roles(Session):
     session.close()
 
 
-def get_task_logs(runner_ident, Session):
+def get_task_logs_since(
+    after_id, Session, runner_ident=None, limit=500, cursors=None
+):
+    """
+    Get the task logs stored after the given id, oldest first.
+    Used by streaming clients to fetch only what they have not seen yet.
+
+    cursors maps a runner_ident to the last id seen for it, after_id then
+    only applies to the other runners. Parallel roles commit their batches
+    out of id order (PostgreSQL sequences), a single cursor would skip the
+    rows of a role committed after higher ids of another; the rows of one
+    runner are written in order.
+    """
     if Session is None:
         print("Session is not initialized")
         return []
     session = Session()
-    task_logs = (
-        session.query(TaskLog)
-        .filter(TaskLog.runner_ident == runner_ident)
-        .order_by(TaskLog.id.asc())
-        .all()
-    )
+    if cursors:
+        query = session.query(TaskLog).filter(
+            or_(
+                TaskLog.runner_ident.notin_(list(cursors)) & (TaskLog.id > after_id),
+                *(
+                    (TaskLog.runner_ident == ident) & (TaskLog.id > last_id)
+                    for ident, last_id in cursors.items()
+                ),
+            )
+        )
+    else:
+        query = session.query(TaskLog).filter(TaskLog.id > after_id)
+    if runner_ident is not None:
+        query = query.filter(TaskLog.runner_ident == runner_ident)
+    task_logs = query.order_by(TaskLog.id.asc()).limit(limit).all()
     session.close()
     return task_logs
 
@@ -1955,57 +2680,137 @@ def add_task_logs(event, task, stdout, runner_ident, Session):
     return task_log
 
 
+def add_task_logs_bulk(entries, Session):
+    """
+    Insert several task logs in a single transaction.
+    entries is a list of dicts with event, task, stdout and runner_ident keys.
+    """
+    if Session is None:
+        print("Session is not initialized")
+        return
+    if not entries:
+        return
+    session = Session()
+    try:
+        session.bulk_insert_mappings(TaskLog, entries)
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+    return len(entries)
+
+
 # Product-specific DNS functions removed (add_dns_gco, add_dns_eservices)
 # Add custom DNS entries manually using add_dns() function as needed
 
 
-def increment_ip(ip, n=1):
-    parts = list(map(int, ip.split(".")))
-    for _ in range(n):
-        parts[3] += 1
-        for i in range(3, -1, -1):
-            if parts[i] > 255:
-                parts[i] = 0
-                if i > 0:
-                    parts[i - 1] += 1
-    return ".".join(map(str, parts))
+def _vm_addresses(session, zone_id):
+    """Addresses (integers) of the VMs of a zone."""
+    addresses = []
+    for (ip,) in (
+        session.query(VirtualMachine.ip).filter(VirtualMachine.zone_id == zone_id).all()
+    ):
+        try:
+            addresses.append(ip_to_int(ip))
+        except (ValueError, IndexError, AttributeError):
+            # VM without (valid) IP yet
+            continue
+    return addresses
 
 
-def ip_to_int(ip):
+def _zone_pool(session, zone):
     """
-    Convert IP address string to 32-bit integer for numeric comparison.
-    Example: "192.168.1.1" -> 3232235777
+    IpPool of a zone built from the database: the addresses of its VMs and
+    the ones reserved by allocate_ips are used. Addresses freed by another
+    path or process are free again. Call with the zone lock held.
     """
-    parts = list(map(int, ip.split(".")))
-    return (parts[0] << 24) + (parts[1] << 16) + (parts[2] << 8) + parts[3]
+    start = ip_to_int(zone.ip_pool_start)
+    end = ip_to_int(zone.ip_pool_end)
+    stored = _vm_addresses(session, zone.id)
+    pool = IpPool(start, end)
+    pool.mark_many(stored)
+    pool.mark_many(zone_pools.reserved(zone.id, start, end, stored))
+    return pool
+
+
+def _get_zone(session, zone_id, lock=False):
+    query = session.query(Zone).filter(Zone.id == zone_id)
+    if lock:
+        # Serializes the allocations of other processes until the end of the
+        # transaction: SQLite ignores FOR UPDATE, a write takes its lock
+        session.query(Zone).filter(Zone.id == zone_id).update(
+            {Zone.ip_pool_start: Zone.ip_pool_start}, synchronize_session=False
+        )
+        query = query.with_for_update()
+    zone = query.first()
+    if not zone:
+        raise ValueError(f"Zone with ID {zone_id} not found")
+    if not zone.ip_pool_start or not zone.ip_pool_end:
+        raise ValueError(f"Zone {zone.name} does not have IP pool configured")
+    return zone
 
 
-def int_to_ip(num):
-    """
-    Convert 32-bit integer back to IP address string.
-    Example: 3232235777 -> "192.168.1.1"
-    """
-    return ".".join(str((num >> (8 * (3 - i))) & 255) for i in range(4))
+def _pool_exhausted(zone):
+    return ValueError(
+        f"No available IP addresses in zone '{zone.name}' "
+        f"(pool: {zone.ip_pool_start} - {zone.ip_pool_end})"
+    )
 
 
-def is_ip_in_pool(ip, pool_start, pool_end):
+def allocate_ips(zone_id, count, Session):
     """
-    Check if an IP address is within the specified pool range.
-    Returns True if IP is in [pool_start, pool_end], False otherwise.
+    Reserve count addresses (the lowest free ones) in a zone's IP pool.
+
+    Addresses used by the zone's VMs and addresses already handed out by
+    this process (until stored on a VM or released) are skipped. Session
+    must be a unit_of_work(): the zone row is written and locked until its
+    transaction ends, so the allocations of other processes (SQLite write
+    lock, PostgreSQL row lock) wait until the VMs using the addresses are
+    stored. Addresses that end up not being used must be given back with
+    release_ips().
+
+    Raises:
+        TypeError: Session is not a unit of work
+        ValueError: unknown zone, no pool configured or not enough addresses
     """
-    ip_int = ip_to_int(ip)
-    start_int = ip_to_int(pool_start)
-    end_int = ip_to_int(pool_end)
-    return start_int <= ip_int <= end_int
+    if not isinstance(Session, UnitOfWork):
+        raise TypeError(
+            "allocate_ips() needs a unit_of_work(), the VMs using the addresses "
+            "must be stored in the same transaction"
+        )
+    with zone_pools.lock(zone_id):
+        session = Session()
+        try:
+            zone = _get_zone(session, zone_id, lock=True)
+            pool = _zone_pool(session, zone)
+            try:
+                addresses = pool.allocate(count)
+            except ValueError:
+                raise _pool_exhausted(zone)
+            zone_pools.reserve(zone.id, pool.start, pool.end, addresses)
+            session.commit()
+            return [int_to_ip(address) for address in addresses]
+        finally:
+            session.close()
+
+
+def release_ips(zone_id, ips):
+    """Give back addresses reserved by allocate_ips() or freed by a VM."""
+    addresses = []
+    for ip in ips:
+        try:
+            addresses.append(ip_to_int(ip))
+        except (ValueError, IndexError, AttributeError):
+            continue
+    zone_pools.release(zone_id, addresses)
 
 
 def get_next_available_ip(zone_id, Session):
     """
-    Find the next available IP address within a zone's defined pool.
-    This function:
-    1. Gets the zone's IP pool range
-    2. Retrieves all currently assigned IPs in that zone
-    3. Returns the first unassigned IP in the pool
+    Find the next available IP address within a zone's defined pool,
+    without reserving it (see allocate_ips).
 
     Args:
         zone_id: The ID of the zone to allocate an IP from
@@ -2017,47 +2822,34 @@ def get_next_available_ip(zone_id, Session):
     Raises:
         Exception: If no IPs are available in the pool
     """
-    session = Session()
+    with zone_pools.lock(zone_id):
+        session = Session()
+        try:
+            zone = _get_zone(session, zone_id)
+            free = _zone_pool(session, zone).peek(1)
+        finally:
+            session.close()
+    if not free:
+        raise _pool_exhausted(zone)
+    return int_to_ip(free[0])
 
-    try:
-        # 1. Get the zone with its IP pool configuration
-        zone = session.query(Zone).filter(Zone.id == zone_id).first()
-        if not zone:
-            raise ValueError(f"Zone with ID {zone_id} not found")
-
-        if not zone.ip_pool_start or not zone.ip_pool_end:
-            raise ValueError(f"Zone {zone.name} does not have IP pool configured")
-
-        # 2. Get all currently assigned IPs in this zone
-        assigned_ips = {
-            vm.ip
-            for vm in session.query(VirtualMachine)
-            .filter(VirtualMachine.zone_id == zone_id)
-            .all()
-        }
-
-        # 3. Iterate through the pool to find the first available IP
-        current_ip_int = ip_to_int(zone.ip_pool_start)
-        end_ip_int = ip_to_int(zone.ip_pool_end)
-
-        while current_ip_int <= end_ip_int:
-            current_ip = int_to_ip(current_ip_int)
-
-            # Check if this IP is already assigned
-            if current_ip not in assigned_ips:
-                session.close()
-                return current_ip
-
-            current_ip_int += 1
-
-        # If we get here, the pool is exhausted
-        raise Exception(
-            f"No available IP addresses in zone '{zone.name}' "
-            f"(pool: {zone.ip_pool_start} - {zone.ip_pool_end})"
-        )
 
-    finally:
-        session.close()
+def get_zone_ip_pool_usage(zone_id, Session):
+    """Size, used and free addresses of a zone's IP pool."""
+    with zone_pools.lock(zone_id):
+        session = Session()
+        try:
+            zone = _get_zone(session, zone_id)
+            pool = _zone_pool(session, zone)
+            usage = pool.utilization()
+        finally:
+            session.close()
+    return {
+        "zone_id": zone_id,
+        "ip_pool_start": zone.ip_pool_start,
+        "ip_pool_end": zone.ip_pool_end,
+        **usage,
+    }
 
 
 def a_configurations(user_count, Session):
@@ -2081,6 +2873,82 @@ def a_configurations(user_count, Session):
     return config_dict
 
 
+def bump_capacity_version(session):
+    """
+    Make the capacity plans cached by every API worker stale, in the
+    transaction of the write.
+    """
+    session.query(Configuration).filter(Configuration.id == 1).update(
+        {
+            Configuration.capacity_version: func.coalesce(
+                Configuration.capacity_version, 0
+            )
+            + 1
+        },
+        synchronize_session=False,
+    )
+
+
+def get_capacity_version(Session):
+    session = Session()
+    version = (
+        session.query(Configuration.capacity_version)
+        .filter(Configuration.id == 1)
+        .scalar()
+    )
+    session.close()
+    return version or 0
+
+
+def get_capacity_plan(Session, user_count=None):
+    """
+    Capacity plan (see capacity.build_plan) for user_count, by default the
+    configured number of concurrent users. Cached until the users, the VM
+    configurations or the VMs change, in any process.
+    """
+
+    def compute():
+        session = Session()
+        try:
+            users = user_count
+            if users is None:
+                configuration = session.query(Configuration).get(1)
+                users = configuration.number_concurrent_users if configuration else 0
+            tiers = {}
+            for row in session.query(
+                VMConfiguration.user_count,
+                VMConfiguration.vm_type,
+                VMConfiguration.node_count,
+                VMConfiguration.cpu_per_node,
+                VMConfiguration.ram_per_node,
+                VMConfiguration.os_disk_size,
+                VMConfiguration.data_disk_size,
+                VMConfiguration.roles,
+            ):
+                sizing = row._asdict()
+                tiers.setdefault(sizing.pop("user_count"), {})[row.vm_type] = sizing
+            vms = [
+                row._asdict()
+                for row in session.query(
+                    VirtualMachine.group,
+                    VirtualMachine.nb_cpu,
+                    VirtualMachine.ram,
+                    VirtualMachine.os_disk_size,
+                    VirtualMachine.data_disk_size,
+                )
+            ]
+        finally:
+            session.close()
+        return build_plan(users, tiers, vms)
+
+    return capacity_planner.get(user_count, compute, get_capacity_version(Session))
+
+
+def get_global_recap(Session):
+    """CPU, memory (GB) and disk (GB) per zone of the capacity plan."""
+    return get_capacity_plan(Session)["zones"]
+
+
 def seed_vm_configurations(Session):
     """
     Seed the VMConfiguration table with recommended values for different user counts.
@@ -2685,9 +3553,11 @@ def seed_vm_configurations(Session):
         config = VMConfiguration(**config_data)
         session.add(config)
 
+    bump_capacity_version(session)
     session.commit()
     print(f"Seeded VMConfiguration table with {len(all_configs)} records")
     session.close()
+    capacity_planner.invalidate()
 
 
 def migrate_vm_configurations(Session):
@@ -2855,9 +3725,140 @@ def migrate_vm_configurations(Session):
             print(f"  - Fixed RKEDMZ: {old_count} nodes -> 3 nodes")
 
     # Commit all changes
+    bump_capacity_version(session)
     session.commit()
     print("\nMigration completed successfully!")
     session.close()
+    capacity_planner.invalidate()
+
+
+def plan_scaffold(Session, user_count=None):
+    """
+    Dry run of apply_scaffold(): the VMs to add, resize and remove so the
+    declared VMs match the capacity plan of user_count (by default the
+    configured number of concurrent users). Added VMs have no IP yet.
+    """
+    capacity = get_capacity_plan(Session, user_count=user_count)
+    session = Session()
+    try:
+        zones = [
+            {"id": zone.id, "name": zone.name}
+            for zone in session.query(Zone.id, Zone.name).order_by(Zone.id)
+        ]
+        security = session.query(Security.env_prefix).first()
+        env_prefix = security.env_prefix if security else ""
+        existing = [
+            row._asdict()
+            for row in session.query(
+                VirtualMachine.id,
+                VirtualMachine.hostname,
+                VirtualMachine.group,
+                VirtualMachine.roles,
+                VirtualMachine.ip,
+                VirtualMachine.nb_cpu,
+                VirtualMachine.ram,
+                VirtualMachine.os_disk_size,
+                VirtualMachine.data_disk_size,
+                VirtualMachine.zone_id,
+            )
+        ]
+    finally:
+        session.close()
+
+    desired = desired_vms(capacity["vm_types"], zones, env_prefix)
+    plan = diff_vms(desired, existing, env_prefix)
+    for vm in plan["add"]:
+        vm["ip"] = None
+    plan["user_count"] = capacity["user_count"]
+    plan["dry_run"] = True
+    return plan
+
+
+@invalidates("virtual_machines")
+def apply_scaffold(Session, user_count=None):
+    """
+    Apply the scaffold plan in one transaction: the added VMs get their IPs
+    from one allocate_ips() call per zone, resized VMs are updated and
+    scaffolded VMs no longer needed are removed (their IPs released).
+    Returns the applied plan.
+
+    Raises:
+        ValueError: no zone, or not enough free addresses in a zone's pool
+    """
+    allocated = {}
+    try:
+        with unit_of_work(Session) as uow:
+            plan = plan_scaffold(uow, user_count)
+            session = uow()
+
+            # Added VMs and adopted seeded VMs without IP get one
+            needing_ip = plan["add"] + [
+                vm for vm in plan["resize"] if vm.get("adopted") and not vm["ip"]
+            ]
+            by_zone = {}
+            for vm in needing_ip:
+                if vm["zone_id"] is None:
+                    raise ValueError(f"No zone to place {vm['hostname']}")
+                by_zone.setdefault(vm["zone_id"], []).append(vm)
+            for zone_id, vms in by_zone.items():
+                ips = allocate_ips(zone_id, len(vms), uow)
+                allocated[zone_id] = ips
+                for vm, ip in zip(vms, ips):
+                    vm["ip"] = ip
+                    if vm.get("adopted"):
+                        vm["changes"]["ip"] = {"from": "", "to": ip}
+
+            session.add_all(
+                VirtualMachine(
+                    hostname=vm["hostname"],
+                    roles=vm["roles"],
+                    group=vm["group"],
+                    ip=vm["ip"],
+                    nb_cpu=vm["nb_cpu"],
+                    ram=vm["ram"],
+                    os_disk_size=vm["os_disk_size"],
+                    data_disk_size=vm["data_disk_size"],
+                    zone_id=vm["zone_id"],
+                )
+                for vm in plan["add"]
+            )
+            if plan["resize"]:
+                session.bulk_update_mappings(
+                    VirtualMachine,
+                    [
+                        {
+                            "id": vm["id"],
+                            **{
+                                field: change["to"]
+                                for field, change in vm["changes"].items()
+                            },
+                        }
+                        for vm in plan["resize"]
+                    ],
+                )
+            removed_ids = [vm["id"] for vm in plan["remove"]]
+            removed = []
+            if removed_ids:
+                removed = (
+                    session.query(VirtualMachine.zone_id, VirtualMachine.ip)
+                    .filter(VirtualMachine.id.in_(removed_ids))
+                    .all()
+                )
+                session.query(VirtualMachine).filter(
+                    VirtualMachine.id.in_(removed_ids)
+                ).delete(synchronize_session=False)
+            bump_capacity_version(session)
+    except Exception:
+        # The VMs were not stored, their addresses are free again
+        for zone_id, ips in allocated.items():
+            release_ips(zone_id, ips)
+        raise
+
+    for zone_id, ip in removed:
+        release_ips(zone_id, [ip])
+    capacity_planner.invalidate()
+    plan["dry_run"] = False
+    return plan
 
 
 def scaffold_architecture(Session):
@@ -3006,68 +4007,32 @@ def test_flows(Session):
     try:
         flows = get_flow_matrix(Session)
         security = get_security(Session)
-        pkey_str = security.ssh_private_key
-        passphrase = security.ssh_private_key_pwd
-        for flow in flows:
-            if re.match("ldap://", flow.destination):
-                flow.destination = flow.destination.split("ldap://")[1]
-            isPortOpen = test_is_Port_Open(
-                source=flow.source,
-                destination=flow.destination,
-                port=flow.port,
-                protocol=flow.protocol,
-                pkey_str=pkey_str,
-                passphrase=passphrase,
-            )
-
-            update_status_flow(flow.id, isPortOpen, Session)
+        pkey = load_private_key(
+            security.ssh_private_key, security.ssh_private_key_pwd
+        )
+        results = run_flow_checks(flows, pkey)
+        update_status_flows(results, Session)
         return True
     except Exception as e:
         print(f"Error: {e}")
         return False
 
 
-def test_service_port(destination, port):
+def test_is_Port_Open(source, destination, port, protocol, pkey_str, passphrase=None):
     try:
-        result = subprocess.run(
-            ["nc", "-vz", "-w 5", destination, str(port)],
-            capture_output=True,
-            text=True,
-            check=True,
-        )
-        result_stdout = result.stdout
-        result_stderr = result.stderr
-        print(f"result : {result_stdout}")
-        print(f"error : {result_stderr}")
-        return True
+        pkey = ssh_pool.load_key(pkey_str, passphrase)
     except Exception as e:
         print(f"Error: {e}")
         return False
 
-
-def test_is_Port_Open(source, destination, port, protocol, pkey_str, passphrase=None):
-    source_client = client.SSHClient()
-    source_client.set_missing_host_key_policy(AutoAddPolicy())
-    if pkey_str:
-        try:
-            pkey = RSAKey.from_private_key(StringIO(pkey_str), passphrase)
-
-        except Exception:
-            print(f"Error: {e}")
-            return False
-
     try:
-        source_client.connect(hostname=source, pkey=pkey, passphrase=passphrase)
         if protocol == "udp":
             command = "nc -vzu"
         else:
             command = "nc -vz"
 
         full_command = f"{command} {destination} {port} 2>&1;"
-        stdin, stdout, stderr = source_client.exec_command(full_command)
-        output = stdout.read().decode()
-        exit_status = int(stdout.channel.recv_exit_status())
-        source_client.close()
+        exit_status, _, _ = ssh_pool.exec_command(source, full_command, pkey=pkey)
 
         if exit_status == 0:
             return True
@@ -3185,6 +4150,19 @@ def scaffold_test_architecture(Session):
         )
         zone_id = zone.id
 
+    zone = get_zone_by_id(zone_id, Session)
+    if zone is not None and zone.sub_network:
+        outside = addresses_outside(
+            [vm_config["ip"] for vm_config in VM_CONFIG["vms"]],
+            zone.sub_network,
+            zone.network_mask,
+        )
+        if outside:
+            logger.warning(
+                f"⚠️ VM IPs outside {zone.sub_network}/{zone.network_mask}: "
+                + ", ".join(outside)
+            )
+
     # Create 3 VMs
     for vm_config in VM_CONFIG["vms"]:
         vm = add_virtual_machine(
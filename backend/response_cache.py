@@ -0,0 +1,142 @@
+"""_summary_
+Read-through cache of the configuration read endpoints.
+
+Each cached endpoint belongs to a resource (zones, virtual_machines...). The
+JSON body is built (response model validation and serialization) once and
+kept with its ETag until a repository write of that resource invalidates it:
+write functions are decorated with @invalidates("resource", ...). Requests
+sending the ETag back in If-None-Match get a 304 without a body.
+
+Writes made by other processes (role hooks running in the role engine
+workers) do not reach this cache, entries also expire after
+RESPONSE_CACHE_TTL seconds.
+"""
+
+import functools
+import hashlib
+import os
+import threading
+import time
+
+from fastapi import Request, Response
+from pydantic import TypeAdapter
+
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "5"))
+
+
+def _etag(body):
+    return '"' + hashlib.sha1(body).hexdigest() + '"'
+
+
+def _matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    # Weak comparison, as for GET
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+
+class ResponseCache:
+    """JSON bodies and ETags per (resource, key)."""
+
+    def __init__(self, ttl=RESPONSE_CACHE_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._versions = {}
+        self._entries = {}
+        self.stats = {"hits": 0, "misses": 0, "not_modified": 0, "invalidations": 0}
+
+    def invalidate(self, *resources):
+        with self._lock:
+            for resource in resources:
+                self._versions[resource] = self._versions.get(resource, 0) + 1
+                for key in [key for key in self._entries if key[0] == resource]:
+                    del self._entries[key]
+            self.stats["invalidations"] += len(resources)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def get(self, resource, key, compute):
+        """(etag, body) of resource/key, compute() returns the body on a miss."""
+        with self._lock:
+            entry = self._entries.get((resource, key))
+            if entry is not None and entry[2] > time.monotonic():
+                self.stats["hits"] += 1
+                return entry[0], entry[1]
+            version = self._versions.get(resource, 0)
+            self.stats["misses"] += 1
+        body = compute()
+        etag = _etag(body)
+        with self._lock:
+            # Not cached if a write happened while computing
+            if self._versions.get(resource, 0) == version:
+                self._entries[(resource, key)] = (
+                    etag,
+                    body,
+                    time.monotonic() + self.ttl,
+                )
+        return etag, body
+
+    def respond(self, request: Request, resource, load, model=None, key=""):
+        """
+        Response of a cached endpoint: load() returns the data, validated
+        and serialized with model (the endpoint's response model) on a miss.
+        """
+
+        def compute():
+            data = load()
+            if model is None:
+                adapter = TypeAdapter(type(data))
+            else:
+                adapter = TypeAdapter(model)
+                data = adapter.validate_python(data, from_attributes=True)
+            return adapter.dump_json(data)
+
+        etag, body = self.get(resource, key, compute)
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        if _matches(request.headers.get("if-none-match"), etag):
+            with self._lock:
+                self.stats["not_modified"] += 1
+            return Response(status_code=304, headers=headers)
+        return Response(content=body, media_type="application/json", headers=headers)
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self.stats, entries=len(self._entries))
+
+
+response_cache = ResponseCache()
+
+
+def _unit_of_work(args, kwargs):
+    """The unit of work passed in place of Session, if any."""
+    for value in (*args, *kwargs.values()):
+        if hasattr(value, "defer_invalidation"):
+            return value
+    return None
+
+
+def invalidates(*resources):
+    """
+    Decorator of the repository writes of resources. Inside a unit of work
+    the entries are invalidated once the unit of work has committed, a read
+    in between would cache the data of before the write.
+    """
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            try:
+                return function(*args, **kwargs)
+            finally:
+                uow = _unit_of_work(args, kwargs)
+                if uow is not None:
+                    uow.defer_invalidation(*resources)
+                else:
+                    response_cache.invalidate(*resources)
+
+        return wrapper
+
+    return decorator
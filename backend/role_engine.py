@@ -0,0 +1,131 @@
+"""_summary_
+Execution engine for ansible roles.
+
+The scheduler in install.py decides which roles may start; RoleEngine runs
+them. By default roles run in threads of the current process: they share
+the hook modules cached by install.role_hooks (preloaded at API startup)
+and their broadcaster.publish() calls reach the /install/stream
+subscribers directly.
+
+INSTALL_ROLE_EXECUTOR=process runs each role in its own spawned process
+instead, so a runaway role cannot hold the GIL of the API process and its
+memory is given back when the role ends. Every role then pays for a fresh
+interpreter importing install.py and its hooks, and the stream only sees
+its progress through database polling.
+"""
+
+import asyncio
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from install_events import broadcaster
+from snapshot import DeploymentSnapshot
+
+# "process" or "thread"
+ROLE_EXECUTOR = os.getenv("INSTALL_ROLE_EXECUTOR", "thread")
+
+
+def database_url(Session):
+    """URL of the database a sessionmaker (or deployment snapshot) is bound to."""
+    if isinstance(Session, DeploymentSnapshot):
+        Session = Session.Session
+    return Session.kw["bind"].url.render_as_string(hide_password=False)
+
+
+def _run_in_child(target, role_name, db_url, snapshot):
+    """Entry point of a role process: reconnect to the database and run."""
+    from repository import get_session
+
+    _, Session = get_session(db_url)
+    if snapshot is not None:
+        Session = snapshot.bind(Session)
+    return target(role_name, Session)
+
+
+class RoleEngine:
+    """
+    Run target(role_name, Session) on a pool of max_workers workers.
+
+    The pool is created on first use, importing the module does not start
+    any thread or process.
+    """
+
+    def __init__(self, target, max_workers, mode=ROLE_EXECUTOR):
+        if mode not in ("process", "thread"):
+            raise ValueError(f"Unknown role executor '{mode}'")
+        self.target = target
+        self.max_workers = max(1, max_workers)
+        self.mode = mode
+        self._executor = None
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self.completed = 0
+        self.failed = 0
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                if self.mode == "process":
+                    self._executor = ProcessPoolExecutor(
+                        max_workers=self.max_workers,
+                        mp_context=multiprocessing.get_context("spawn"),
+                        # A fresh interpreter for every role
+                        max_tasks_per_child=1,
+                    )
+                else:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self.max_workers, thread_name_prefix="role"
+                    )
+            return self._executor
+
+    def submit(self, role_name, Session):
+        executor = self._get_executor()
+        if self.mode == "process":
+            snapshot = Session if isinstance(Session, DeploymentSnapshot) else None
+            db_url = database_url(Session)
+            args = (_run_in_child, self.target, role_name, db_url, snapshot)
+        else:
+            args = (self.target, role_name, Session)
+        with self._lock:
+            self._in_flight += 1
+        try:
+            future = executor.submit(*args)
+        except Exception:
+            with self._lock:
+                self._in_flight -= 1
+            raise
+        future.add_done_callback(self._job_done)
+        return future
+
+    async def run(self, role_name, Session):
+        await asyncio.wrap_future(self.submit(role_name, Session))
+
+    def _job_done(self, future):
+        with self._lock:
+            self._in_flight -= 1
+            if future.cancelled() or future.exception() is not None:
+                self.failed += 1
+            else:
+                self.completed += 1
+        # Role processes cannot reach the subscribers of this process
+        broadcaster.publish()
+
+    def stats(self):
+        with self._lock:
+            active = min(self._in_flight, self.max_workers)
+            return {
+                "mode": self.mode,
+                "max_workers": self.max_workers,
+                "active": active,
+                "queued": self._in_flight - active,
+                "completed": self.completed,
+                "failed": self.failed,
+            }
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait, cancel_futures=True)
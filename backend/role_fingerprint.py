@@ -0,0 +1,94 @@
+"""_summary_
+Fingerprint of the inputs of an ansible role.
+
+A role run is fully determined by the extra_vars and inventory returned by
+its prepare_inputs hook and by the files of the role. The fingerprint is a
+hash of the three. When it matches the fingerprint of the last successful
+run of the role (role_results table) the role is not run again:
+
+    INSTALL_FINGERPRINT_MODE=skip   the role is marked unchanged (default)
+    INSTALL_FINGERPRINT_MODE=check  the role runs with --check only
+    INSTALL_FINGERPRINT_MODE=off    roles always run
+
+Hooks write secrets (SSH keys...) to temporary files with random names,
+values pointing to an existing file of the temporary folder are hashed by
+content. Extra vars that change on every run without changing the result
+can be left out with FINGERPRINT_EXCLUDE (comma separated keys).
+
+Roles reading state outside of their inputs (files on disk...) declare it
+with a fingerprint_state(Session) function in their prepare_inputs hook,
+its result is part of the fingerprint. Their post_install hook can set
+RUN_WHEN_UNCHANGED = True to run even when the role is skipped.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+
+FINGERPRINT_MODE = os.getenv("INSTALL_FINGERPRINT_MODE", "skip")
+FINGERPRINT_EXCLUDE = frozenset(
+    key.strip()
+    for key in os.getenv("FINGERPRINT_EXCLUDE", "").split(",")
+    if key.strip()
+)
+FINGERPRINT_MODES = ("skip", "check", "off")
+
+_TEMP_FOLDER = os.path.realpath(tempfile.gettempdir())
+
+
+def _file_digest(path):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def normalize(value, exclude=frozenset()):
+    """value with temporary file paths replaced by their content hash."""
+    if isinstance(value, dict):
+        return {
+            str(key): normalize(item, exclude)
+            for key, item in value.items()
+            if key not in exclude
+        }
+    if isinstance(value, (list, tuple, set, frozenset)):
+        items = [normalize(item, exclude) for item in value]
+        if isinstance(value, (set, frozenset)):
+            items.sort(key=repr)
+        return items
+    if isinstance(value, str) and os.path.isabs(value):
+        path = os.path.realpath(value)
+        if path.startswith(_TEMP_FOLDER + os.sep) and os.path.isfile(path):
+            return "file:sha256:" + _file_digest(path)
+    return value
+
+
+def role_files_digest(role_path):
+    """Hash of the relative paths and contents of the files of a role."""
+    sha256 = hashlib.sha256()
+    for root, folders, files in os.walk(role_path):
+        folders[:] = sorted(folder for folder in folders if folder != "__pycache__")
+        for name in sorted(files):
+            if name.endswith(".pyc"):
+                continue
+            path = os.path.join(root, name)
+            sha256.update(os.path.relpath(path, role_path).encode() + b"\0")
+            sha256.update(_file_digest(path).encode())
+    return sha256.hexdigest()
+
+
+def fingerprint(
+    extra_vars, inventory, role_path, exclude=FINGERPRINT_EXCLUDE, state=None
+):
+    inputs = {
+        "extra_vars": normalize(extra_vars or {}, exclude),
+        "inventory": normalize(inventory or {}),
+        "files": role_files_digest(role_path) if os.path.isdir(role_path) else None,
+    }
+    # Left out when None, fingerprints of roles without state do not change
+    if state is not None:
+        inputs["state"] = normalize(state)
+    body = json.dumps(inputs, sort_keys=True, default=str)
+    return "sha256:" + hashlib.sha256(body.encode()).hexdigest()
@@ -0,0 +1,176 @@
+"""_summary_
+Incremental architecture scaffolding.
+
+The desired VMs are derived from the capacity plan (VMConfiguration sizing
+for the configured number of concurrent users) and compared by hostname with
+the VMs already declared. The resulting plan only holds the differences:
+VMs to add, VMs to resize and scaffolded VMs no longer needed. Changing the
+number of users no longer means deleting the database.
+
+The VMs seeded by initial_db.py have no hostname yet: they are adopted by
+the desired VMs of their group (renamed and resized, given an IP when they
+have none) instead of getting new VMs next to them. Other VMs whose
+hostname does not follow the scaffold naming are never resized nor removed.
+"""
+
+import re
+
+# VM type -> (hostname prefix, VM group read by the roles)
+VM_TYPES = {
+    "RKEAPPS_CONTROL": ("rkeapp-master", "RKEAPPS"),
+    "RKEAPPS_CNS": ("rkeapp-cns", "RKEAPPS"),
+    "RKEAPPS_WORKER": ("rkeapp-worker", "RKEAPPS"),
+    "RKEMIDDLEWARE_CONTROL": ("rkemiddleware-master", "RKEMIDDLEWARE"),
+    "RKEMIDDLEWARE_CNS": ("rkemiddleware-cns", "RKEMIDDLEWARE"),
+    "RKEMIDDLEWARE_WORKER": ("rkemiddleware-worker", "RKEMIDDLEWARE"),
+    "RKEDMZ": ("rkedmz", "RKEDMZ"),
+    "LBLAN": ("lblan", "LBLAN"),
+    "LBDMZ": ("lbdmz", "LBDMZ"),
+    "LBINTEGRATION": ("lbintegration", "LBINTEGRATION"),
+    "VAULT": ("vault", "vault"),
+    "GITOPS": ("gitops", "gitops"),
+    "MONITORING": ("monitoring", "monitoring"),
+}
+
+# Fields compared to decide a resize
+RESIZE_FIELDS = ("group", "roles", "nb_cpu", "ram", "os_disk_size", "data_disk_size")
+# Fields set on an adopted seeded VM
+ADOPT_FIELDS = ("hostname",) + RESIZE_FIELDS
+
+
+def env_prefix_of(env_prefix):
+    """Hostname prefix of an environment: "test" -> "test-"."""
+    if not env_prefix:
+        return ""
+    return env_prefix if env_prefix.endswith("-") else f"{env_prefix}-"
+
+
+def generate_hostname(hostname_prefix, prefix, i):
+    """
+    Hostname of the i-th VM (from 1). hostname_prefix is not prefixed twice
+    when it already starts with the environment prefix.
+    """
+    base_hostname = hostname_prefix
+    if prefix and prefix.endswith("-") and hostname_prefix.startswith(prefix):
+        base_hostname = hostname_prefix[len(prefix) :]
+    return f"{prefix}{base_hostname}{i}"
+
+
+def managed_hostname_pattern(prefix):
+    """Regex matching the hostnames generated for every VM type."""
+    bases = sorted((re.escape(base) for base, _ in VM_TYPES.values()), key=len, reverse=True)
+    return re.compile(rf"^{re.escape(prefix)}(?:{'|'.join(bases)})\d+$")
+
+
+def pick_zone(category, zones):
+    """
+    Zone (dict with id and name) hosting a recap zone category: a zone named
+    after DMZ for the DMZ, otherwise the first other zone.
+    """
+    if not zones:
+        return None
+    dmz = [zone for zone in zones if "dmz" in zone["name"].lower()]
+    lan = [zone for zone in zones if "dmz" not in zone["name"].lower()]
+    if category == "DMZ":
+        return (dmz or lan)[0]
+    return (lan or dmz)[0]
+
+
+def desired_vms(vm_types, zones, env_prefix):
+    """
+    {hostname: VM fields} for the capacity plan sizing (vm_types: dicts with
+    vm_type, zone, node_count, cpu_per_node, ram_per_node, os_disk_size,
+    data_disk_size and roles).
+    """
+    prefix = env_prefix_of(env_prefix)
+    desired = {}
+    for sizing in vm_types:
+        if sizing["vm_type"] not in VM_TYPES:
+            continue
+        hostname_prefix, group = VM_TYPES[sizing["vm_type"]]
+        zone = pick_zone(sizing["zone"], zones)
+        for i in range(1, sizing["node_count"] + 1):
+            hostname = generate_hostname(hostname_prefix, prefix, i)
+            desired[hostname] = {
+                "hostname": hostname,
+                "vm_type": sizing["vm_type"],
+                "group": group,
+                "roles": sizing["roles"],
+                "nb_cpu": sizing["cpu_per_node"],
+                "ram": sizing["ram_per_node"],
+                "os_disk_size": sizing["os_disk_size"],
+                "data_disk_size": sizing["data_disk_size"] or 0,
+                "zone_id": zone["id"] if zone else None,
+            }
+    return desired
+
+
+def diff(desired, existing, env_prefix):
+    """
+    Plan turning existing (dicts with the VirtualMachine columns) into
+    desired: add, resize (with the changed fields) and remove lists, and
+    the number of unchanged, adopted and unmanaged VMs. Adopted seeded VMs
+    are resized with adopted set, and with ip None when they need one.
+    """
+    managed = managed_hostname_pattern(env_prefix_of(env_prefix))
+    by_hostname = {vm["hostname"]: vm for vm in existing if vm["hostname"]}
+    seeded = {}
+    for vm in existing:
+        if not vm["hostname"]:
+            seeded.setdefault(vm["group"], []).append(vm)
+    plan = {
+        "add": [],
+        "resize": [],
+        "remove": [],
+        "unchanged": 0,
+        "adopted": 0,
+        "unmanaged": 0,
+    }
+    adopted = set()
+
+    for hostname, vm in desired.items():
+        current = by_hostname.get(hostname)
+        fields = RESIZE_FIELDS
+        if current is None and seeded.get(vm["group"]):
+            current = seeded[vm["group"]].pop(0)
+            adopted.add(current["id"])
+            fields = ADOPT_FIELDS
+        if current is None:
+            plan["add"].append(vm)
+            continue
+        changes = {
+            field: {"from": current[field], "to": vm[field]}
+            for field in fields
+            if current[field] != vm[field]
+        }
+        if current["id"] in adopted:
+            if current["zone_id"] is None and vm["zone_id"] is not None:
+                changes["zone_id"] = {"from": None, "to": vm["zone_id"]}
+            plan["adopted"] += 1
+            plan["resize"].append(
+                {
+                    "id": current["id"],
+                    "hostname": hostname,
+                    "changes": changes,
+                    "adopted": True,
+                    "ip": current["ip"] or None,
+                    "zone_id": current["zone_id"] or vm["zone_id"],
+                }
+            )
+        elif changes:
+            plan["resize"].append(
+                {"id": current["id"], "hostname": hostname, "changes": changes}
+            )
+        else:
+            plan["unchanged"] += 1
+
+    for vm in existing:
+        if vm["hostname"] in desired or vm["id"] in adopted:
+            continue
+        if managed.match(vm["hostname"] or ""):
+            plan["remove"].append(
+                {"id": vm["id"], "hostname": vm["hostname"], "ip": vm["ip"]}
+            )
+        else:
+            plan["unmanaged"] += 1
+    return plan
@@ -0,0 +1,127 @@
+"""_summary_
+Read-only snapshot of the deployment configuration.
+
+Every prepare_inputs hook reads the security settings, the VMs of several
+groups, the databases, the LDAPs... build_snapshot() loads these rows once
+per install run. The snapshot is also a Session factory, so it can be
+passed to the hooks and to the repository functions in place of Session:
+the repository getters answer from the snapshot and everything else
+(vault credentials, role statuses, task logs) goes to the database.
+"""
+
+from dataclasses import dataclass, field, fields, replace
+from types import MappingProxyType
+from typing import Any, Callable, Mapping, Optional, Tuple
+
+from models import (
+    Database,
+    Ldap,
+    Monitoring,
+    Security,
+    SMSProvider,
+    SMTPServer,
+    VirtualMachine,
+)
+
+
+@dataclass(frozen=True)
+class DeploymentSnapshot:
+    """Configuration rows loaded at the start of an install run."""
+
+    security: Optional[Security]
+    monitoring: Optional[Monitoring]
+    virtual_machines: Tuple[VirtualMachine, ...]
+    vms_by_group: Mapping[str, Tuple[VirtualMachine, ...]]
+    vms_by_role: Mapping[str, Tuple[VirtualMachine, ...]]
+    databases: Tuple[Database, ...]
+    databases_by_alias: Mapping[str, Database]
+    ldaps: Tuple[Ldap, ...]
+    ldaps_by_type: Mapping[str, Tuple[Ldap, ...]]
+    sms_providers: Tuple[SMSProvider, ...]
+    smtp_servers: Tuple[SMTPServer, ...]
+    Session: Optional[Callable[[], Any]] = field(
+        default=None, compare=False, repr=False
+    )
+
+    def __call__(self):
+        """Open a database session, like the sessionmaker it replaces."""
+        if self.Session is None:
+            raise RuntimeError("Deployment snapshot is not bound to a database")
+        return self.Session()
+
+    def bind(self, Session):
+        """Return the same snapshot opening its sessions with Session."""
+        return replace(self, Session=Session)
+
+    def __getstate__(self):
+        # The sessionmaker holds the engine and cannot be pickled, a snapshot
+        # sent to another process is bound again there with bind()
+        state = {}
+        for f in fields(self):
+            value = getattr(self, f.name)
+            if isinstance(value, MappingProxyType):
+                value = dict(value)
+            state[f.name] = value
+        state["Session"] = None
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            if isinstance(value, dict):
+                value = MappingProxyType(value)
+            object.__setattr__(self, name, value)
+
+    def get_vms_by_group(self, group):
+        return list(self.vms_by_group.get(group, ()))
+
+    def get_vms_by_role(self, role):
+        return list(self.vms_by_role.get(role, ()))
+
+
+def _group_by(items, key):
+    groups = {}
+    for item in items:
+        groups.setdefault(key(item), []).append(item)
+    return MappingProxyType({k: tuple(v) for k, v in groups.items()})
+
+
+def build_snapshot(Session):
+    """
+    Load the configuration in one session and return a DeploymentSnapshot
+    bound to Session.
+    """
+    session = Session()
+    try:
+        security = session.query(Security).get(1)
+        monitoring = session.query(Monitoring).get(1)
+        vms = tuple(session.query(VirtualMachine).order_by(VirtualMachine.id).all())
+        databases = tuple(session.query(Database).order_by(Database.id).all())
+        ldaps = tuple(session.query(Ldap).order_by(Ldap.id).all())
+        sms_providers = tuple(
+            session.query(SMSProvider).order_by(SMSProvider.id).all()
+        )
+        smtp_servers = tuple(session.query(SMTPServer).order_by(SMTPServer.id).all())
+    finally:
+        session.close()
+
+    vms_by_role = {}
+    for vm in vms:
+        for role in (vm.roles or "").split(","):
+            role = role.strip()
+            if role:
+                vms_by_role.setdefault(role, []).append(vm)
+
+    return DeploymentSnapshot(
+        security=security,
+        monitoring=monitoring,
+        virtual_machines=vms,
+        vms_by_group=_group_by(vms, lambda vm: vm.group),
+        vms_by_role=MappingProxyType({k: tuple(v) for k, v in vms_by_role.items()}),
+        databases=databases,
+        databases_by_alias=MappingProxyType({db.alias: db for db in databases}),
+        ldaps=ldaps,
+        ldaps_by_type=_group_by(ldaps, lambda ldap: ldap.ldap_type),
+        sms_providers=sms_providers,
+        smtp_servers=smtp_servers,
+        Session=Session,
+    )
@@ -0,0 +1,273 @@
+"""_summary_
+Shared SSH connections for remote checks.
+
+Parsing the RSA key and opening an SSH connection cost far more than the
+commands the checks run. SSHPool parses each private key once and keeps one
+connection per (host, user, key fingerprint); commands run on their own
+channel of that connection, so several threads can use it at the same time.
+Connections idle for more than SSH_POOL_TTL seconds are closed.
+"""
+
+import atexit
+import getpass
+import hashlib
+import logging
+import os
+import select
+import shutil
+import tempfile
+import threading
+import time
+from io import StringIO
+
+from paramiko import AutoAddPolicy, RSAKey, SSHException, client
+
+logger = logging.getLogger(__name__)
+
+# Seconds an idle connection is kept open
+SSH_POOL_TTL = float(os.getenv("SSH_POOL_TTL", "300"))
+SSH_CONNECT_TIMEOUT = float(os.getenv("SSH_CONNECT_TIMEOUT", "10"))
+# Seconds between keepalive packets on pooled connections
+SSH_KEEPALIVE = int(os.getenv("SSH_KEEPALIVE", "30"))
+# Parent of the per-process directory of the key files written by key_file()
+SSH_KEY_DIR = os.getenv("SSH_KEY_DIR", tempfile.gettempdir())
+# Bytes read from a channel at a time
+READ_SIZE = 32768
+
+_key_dir = None
+_key_dir_lock = threading.Lock()
+
+
+def key_fingerprint(pkey):
+    if pkey is None:
+        return None
+    return hashlib.sha256(pkey.asbytes()).hexdigest()
+
+
+def _process_key_dir():
+    """
+    0700 directory created by this process with mkdtemp, removed at exit.
+    Nobody else can create files in it, unlike a well-known shared path.
+    """
+    global _key_dir
+    with _key_dir_lock:
+        if _key_dir is None or not os.path.isdir(_key_dir):
+            _key_dir = tempfile.mkdtemp(prefix="harmonisation-keys-", dir=SSH_KEY_DIR)
+            atexit.register(shutil.rmtree, _key_dir, True)
+        return _key_dir
+
+
+def key_file(content):
+    """
+    Write content (an SSH key) to a 0600 file named after its sha256 and
+    return the path. The same key always gets the same file, which is
+    written only once per process.
+    """
+    key_dir = _process_key_dir()
+    path = os.path.join(key_dir, hashlib.sha256(content.encode()).hexdigest())
+    if os.path.exists(path):
+        return path
+    fd, tmp_path = tempfile.mkstemp(dir=key_dir)
+    with os.fdopen(fd, "w") as f:
+        f.write(content)
+    # Atomic, concurrent writers of the same key end with the same file
+    os.replace(tmp_path, path)
+    return path
+
+
+def read_channel(channel, timeout=None):
+    """
+    (stdout, stderr) of the command running on channel, read until it
+    exits. Both streams are drained as data arrives: reading stdout to the
+    end first blocks both sides once stderr fills the channel window.
+    """
+    stdout, stderr = bytearray(), bytearray()
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+        # The exit status arrives after the output, checked first so no
+        # output received in between is left behind
+        exited = channel.exit_status_ready()
+        if channel.recv_ready():
+            stdout += channel.recv(READ_SIZE)
+        elif channel.recv_stderr_ready():
+            stderr += channel.recv_stderr(READ_SIZE)
+        elif exited:
+            return bytes(stdout), bytes(stderr)
+        else:
+            wait = 1.0
+            if deadline is not None:
+                wait = deadline - time.monotonic()
+                if wait <= 0:
+                    raise TimeoutError("Timed out reading the command output")
+            select.select([channel], [], [], min(wait, 1.0))
+
+
+class _Connection:
+    def __init__(self, ssh):
+        self.ssh = ssh
+        self.last_used = time.monotonic()
+        self.users = 0
+
+    def is_active(self):
+        transport = self.ssh.get_transport()
+        return transport is not None and transport.is_active()
+
+
+class SSHPool:
+    """Parsed key cache and SSH connection pool."""
+
+    def __init__(self, ttl=SSH_POOL_TTL, connect_timeout=SSH_CONNECT_TIMEOUT):
+        self.ttl = ttl
+        self.connect_timeout = connect_timeout
+        self._lock = threading.Lock()
+        self._keys = {}
+        self._connections = {}
+        self._connect_locks = {}
+        self.stats = {
+            "key_hits": 0,
+            "key_misses": 0,
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0,
+        }
+
+    def load_key(self, pkey_str, passphrase=None):
+        """
+        Parse an RSA private key, once per (key, passphrase).
+        Parsing errors (e.g. PasswordRequiredException) are raised as is.
+        """
+        if not pkey_str:
+            return None
+        cache_key = hashlib.sha256(
+            f"{pkey_str}\0{passphrase or ''}".encode()
+        ).hexdigest()
+        with self._lock:
+            pkey = self._keys.get(cache_key)
+            if pkey is not None:
+                self.stats["key_hits"] += 1
+                return pkey
+        pkey = RSAKey.from_private_key(StringIO(pkey_str), passphrase or None)
+        with self._lock:
+            self.stats["key_misses"] += 1
+            self._keys[cache_key] = pkey
+        return pkey
+
+    def _acquire(self, host, pkey, username, port):
+        username = username or getpass.getuser()
+        key = (host, port, username, key_fingerprint(pkey))
+        self.evict_idle()
+        with self._lock:
+            connect_lock = self._connect_locks.setdefault(key, threading.Lock())
+        # One connection attempt per key at a time, others wait and reuse it
+        with connect_lock:
+            with self._lock:
+                connection = self._connections.get(key)
+                if connection is not None and connection.is_active():
+                    self.stats["hits"] += 1
+                    connection.users += 1
+                    return key, connection
+
+            ssh = client.SSHClient()
+            ssh.set_missing_host_key_policy(AutoAddPolicy())
+            ssh.connect(
+                hostname=host,
+                port=port,
+                username=username,
+                pkey=pkey,
+                timeout=self.connect_timeout,
+            )
+            transport = ssh.get_transport()
+            if transport is not None:
+                transport.set_keepalive(SSH_KEEPALIVE)
+            connection = _Connection(ssh)
+            connection.users = 1
+            with self._lock:
+                self.stats["misses"] += 1
+                stale = self._connections.get(key)
+                self._connections[key] = connection
+            if stale is not None:
+                stale.ssh.close()
+            return key, connection
+
+    def _release(self, key, connection, broken=False):
+        with self._lock:
+            connection.users -= 1
+            connection.last_used = time.monotonic()
+            if broken and self._connections.get(key) is connection:
+                del self._connections[key]
+            close = broken and connection.users == 0
+        if close:
+            connection.ssh.close()
+
+    def exec_command(
+        self, host, command, pkey=None, username=None, port=22, input=None, timeout=None
+    ):
+        """
+        Run command on host over a pooled connection.
+        Returns (exit status, stdout, stderr). input is sent to stdin.
+        """
+        for attempt in range(2):
+            key, connection = self._acquire(host, pkey, username, port)
+            try:
+                channel = connection.ssh.get_transport().open_session(
+                    timeout=self.connect_timeout
+                )
+            except (SSHException, EOFError, OSError, AttributeError):
+                # The server closed the connection while it was idle
+                self._release(key, connection, broken=True)
+                if attempt:
+                    raise
+                continue
+
+            try:
+                channel.settimeout(timeout)
+                channel.exec_command(command)
+                if input is not None:
+                    channel.sendall(input.encode())
+                channel.shutdown_write()
+                stdout, stderr = read_channel(channel, timeout)
+                exit_status = channel.recv_exit_status()
+            except Exception:
+                self._release(key, connection, broken=not connection.is_active())
+                channel.close()
+                raise
+            channel.close()
+            self._release(key, connection)
+            return (
+                exit_status,
+                stdout.decode(errors="replace"),
+                stderr.decode(errors="replace"),
+            )
+
+    def evict_idle(self):
+        """Close the connections unused for more than ttl seconds."""
+        now = time.monotonic()
+        evicted = []
+        with self._lock:
+            for key, connection in list(self._connections.items()):
+                idle = connection.users == 0 and now - connection.last_used > self.ttl
+                if idle or (connection.users == 0 and not connection.is_active()):
+                    evicted.append(self._connections.pop(key))
+                    self.stats["evictions"] += 1
+        for connection in evicted:
+            connection.ssh.close()
+        return len(evicted)
+
+    def close_all(self):
+        with self._lock:
+            connections = list(self._connections.values())
+            self._connections.clear()
+        for connection in connections:
+            connection.ssh.close()
+
+    def get_stats(self):
+        with self._lock:
+            return dict(
+                self.stats,
+                connections=len(self._connections),
+                keys=len(self._keys),
+            )
+
+
+# Shared by every remote check of the process
+pool = SSHPool()
@@ -1,7 +1,32 @@
+"""_summary_
+Exports the Docker images listed in the roles' images.txt for offline installs.
+
+Images are deduplicated across roles, pulled in parallel (--pulls or
+TAR_IMAGES_PULLS) and written as multi-image `docker save` bundles, one per
+role, so layers shared by the images of a bundle are stored once.
+
+The export is incremental: the image store manifest (image_store.py) in the
+output folder records the digests and bundle of every exported image. Images
+already in the manifest are not pulled again; with --refresh their tags are
+pulled and only the bundles holding an image whose id changed are rewritten.
+"""
+
+import argparse
+import hashlib
 import os
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-import argparse
+
+from image_store import (
+    file_sha256,
+    load_manifest,
+    save_manifest,
+    split_reference,
+    verify,
+)
+
+DEFAULT_PULLS = int(os.getenv("TAR_IMAGES_PULLS", "4"))
 
 
 def sanitize_image_name(image_name):
@@ -9,87 +34,218 @@ def sanitize_image_name(image_name):
     return image_name.replace("/", "_")
 
 
-def tar_images(input_folder_path, output_folder_path, role_name=None, all_roles=False):
-    """
-    Pulls Docker images and saves them as tar files.
+def docker(*args):
+    """Runs a docker command, raises CalledProcessError when it fails."""
+    return subprocess.run(
+        ["docker", *args], check=True, capture_output=True, text=True
+    ).stdout
 
-    Can process either a single role or all roles. It checks if an image
-    has already been downloaded before pulling it.
-    """
-    # Ensure the output folder exists
-    Path(output_folder_path).mkdir(parents=True, exist_ok=True)
 
-    roles_to_process = []
+def list_roles(input_folder_path, role_name=None, all_roles=False):
     if all_roles:
-        roles_to_process = [
+        return sorted(
             d
             for d in os.listdir(input_folder_path)
             if os.path.isdir(os.path.join(input_folder_path, d))
-        ]
-    elif role_name:
-        # Check if the specified role directory exists
+        )
+    if role_name:
         role_path = os.path.join(input_folder_path, role_name)
         if os.path.isdir(role_path):
-            roles_to_process = [role_name]
-        else:
-            print(f"Error: Role directory not found at '{role_path}'")
-            return
-
-    # Iterate over each role to be processed
-    for role in roles_to_process:
-        role_path = os.path.join(input_folder_path, role)
-        images_file_path = os.path.join(role_path, "images.txt")
-
-        if os.path.exists(images_file_path):
-            with open(images_file_path, "r") as file:
-                for image in file.readlines():
-                    image = image.strip()
-                    if not image:
-                        continue
-
-                    # Sanitize the image name and create the tar file path
-                    sanitized_image_name = sanitize_image_name(image)
-                    tar_file_name = f"{role}_{sanitized_image_name}.tar"
-                    tar_file_path = os.path.join(output_folder_path, tar_file_name)
-
-                    # Skip if tar file already exists
-                    if os.path.exists(tar_file_path):
-                        print(
-                            f"Image '{image}' already exists as '{tar_file_path}'. Skipping."
-                        )
-                        continue
-
-                    try:
-                        # Pull the Docker image
-                        print(f"Pulling image: {image}")
-                        subprocess.run(
-                            ["docker", "pull", image],
-                            check=True,
-                            capture_output=True,
-                            text=True,
-                        )
-
-                        # Create a tar archive of the pulled image
-                        print(f"Saving image '{image}' to '{tar_file_path}'")
-                        subprocess.run(
-                            ["docker", "save", "-o", tar_file_path, image],
-                            check=True,
-                            capture_output=True,
-                            text=True,
-                        )
-
-                        # Remove the Docker image to save space
-                        print(f"Removing image '{image}' from local storage")
-                        subprocess.run(
-                            ["docker", "rmi", image],
-                            check=False,  # Don't fail if removal fails
-                            capture_output=True,
-                            text=True,
-                        )
-                    except subprocess.CalledProcessError as e:
-                        print(f"Failed to pull or save {image}: {e.stderr}")
-        else:
-            print(f"No 'images-f.txt' file found in '{role}'. Skipping.")
+            return [role_name]
+        print(f"Error: Role directory not found at '{role_path}'")
+    return []
+
+
+def read_images(input_folder_path, roles):
+    """{image: [roles listing it]}, in order of first appearance."""
+    images = {}
+    for role in roles:
+        images_file_path = os.path.join(input_folder_path, role, "images.txt")
+        if not os.path.exists(images_file_path):
+            print(f"No 'images.txt' file found in '{role}'. Skipping.")
+            continue
+        with open(images_file_path, "r") as file:
+            for image in file.readlines():
+                image = image.strip()
+                if not image or image.startswith("#"):
+                    continue
+                roles_of_image = images.setdefault(image, [])
+                if role not in roles_of_image:
+                    roles_of_image.append(role)
+    return images
+
+
+def bundle_name(role, image_ids):
+    """Bundle file name, derived from the ids of the images it holds."""
+    digest = hashlib.sha256("\n".join(sorted(image_ids)).encode()).hexdigest()
+    return f"{role}-{digest[:12]}.tar"
+
+
+def inspect_image(image, run=docker):
+    """image_id, size and registry digest of a local image."""
+    output = run(
+        "image",
+        "inspect",
+        "--format",
+        '{{.Id}}|{{.Size}}|{{join .RepoDigests ","}}',
+        image,
+    )
+    image_id, size, repo_digests = output.strip().split("|")
+    name, _ = split_reference(image)
+    digest = None
+    for repo_digest in repo_digests.split(","):
+        if "@" in repo_digest:
+            digest = repo_digest.split("@", 1)[1]
+            if repo_digest.split("@", 1)[0] == name:
+                break
+    return {"image_id": image_id, "size": int(size), "digest": digest}
+
+
+def pull_images(images, pulls, run=docker):
+    """{image: inspect_image()} of the images pulled, failures are left out."""
+
+    def pull(image):
+        print(f"Pulling image: {image}")
+        try:
+            run("pull", image)
+            return image, inspect_image(image, run)
+        except subprocess.CalledProcessError as e:
+            print(f"Failed to pull {image}: {e.stderr}")
+            return image, None
+
+    with ThreadPoolExecutor(max_workers=max(1, pulls)) as executor:
+        results = list(executor.map(pull, images))
+    return {image: info for image, info in results if info}
+
+
+def save_bundle(output_folder_path, name, images, run=docker):
+    """docker save of images into name, replaced atomically."""
+    path = os.path.join(output_folder_path, name)
+    print(f"Saving {len(images)} image(s) to '{path}'")
+    try:
+        run("save", "-o", path + ".tmp", *images)
+    except subprocess.CalledProcessError as e:
+        print(f"Failed to save {', '.join(images)}: {e.stderr}")
+        if os.path.exists(path + ".tmp"):
+            os.remove(path + ".tmp")
+        return False
+    os.replace(path + ".tmp", path)
+    return True
+
+
+def tar_images(
+    input_folder_path,
+    output_folder_path,
+    role_name=None,
+    all_roles=False,
+    pulls=DEFAULT_PULLS,
+    refresh=False,
+    keep_images=False,
+    run=docker,
+):
+    """
+    Pulls the Docker images of a role (or all roles) and saves them in
+    per-role bundles, skipping the images already exported.
+
+    Returns the manifest written to the output folder.
+    """
+    Path(output_folder_path).mkdir(parents=True, exist_ok=True)
+    manifest = load_manifest(output_folder_path)
+    entries, bundles = manifest["images"], manifest["bundles"]
+
+    def exported(image):
+        entry = entries.get(image)
+        return entry is not None and os.path.exists(
+            os.path.join(output_folder_path, entry["file"])
+        )
+
+    wanted = read_images(
+        input_folder_path, list_roles(input_folder_path, role_name, all_roles)
+    )
+    for image, roles in wanted.items():
+        if image in entries:
+            entries[image]["roles"] = sorted(set(entries[image]["roles"]) | set(roles))
+        if exported(image) and not refresh:
+            bundle = entries[image]["file"]
+            print(f"Image '{image}' already exported in '{bundle}'. Skipping.")
+
+    ids = pull_images(
+        [image for image in wanted if refresh or not exported(image)], pulls, run
+    )
+    changed = {
+        image
+        for image, info in ids.items()
+        if not exported(image) or entries[image]["image_id"] != info["image_id"]
+    }
+
+    # Bundles holding a changed image are rewritten with all their images
+    stale = {entries[image]["file"] for image in changed if image in entries}
+    rewrite = set(changed)
+    for name in stale:
+        rewrite.update(bundles.get(name, {}).get("images", []))
+    ids.update(pull_images(sorted(rewrite - set(ids)), pulls, run))
+
+    groups = {}
+    for image in sorted(rewrite):
+        if image not in ids:
+            # Not pullable anymore, dropped from the manifest
+            entries.pop(image, None)
+            continue
+        roles = entries[image]["roles"] if image in entries else wanted[image]
+        groups.setdefault(roles[0], []).append(image)
+
+    def write(group):
+        role, images = group
+        name = bundle_name(role, [ids[image]["image_id"] for image in images])
+        return role, images, name, save_bundle(output_folder_path, name, images, run)
+
+    with ThreadPoolExecutor(max_workers=max(1, pulls)) as executor:
+        written = list(executor.map(write, groups.items()))
+
+    for role, images, name, saved in written:
+        if not saved:
+            for image in images:
+                entries.pop(image, None)
+            continue
+        path = os.path.join(output_folder_path, name)
+        bundles[name] = {
+            "role": role,
+            "images": images,
+            "size": os.path.getsize(path),
+            "sha256": file_sha256(path),
+        }
+        for image in images:
+            name_of_image, tag = split_reference(image)
+            roles = set(entries.get(image, {}).get("roles", []))
+            entries[image] = {
+                "name": name_of_image,
+                "tag": tag,
+                **ids[image],
+                "roles": sorted(roles | set(wanted.get(image, []))),
+                "file": name,
+            }
+
+    # Bundles no image points to anymore
+    referenced = {entry["file"] for entry in entries.values()}
+    for name in list(bundles):
+        if name not in referenced:
+            del bundles[name]
+            path = os.path.join(output_folder_path, name)
+            if os.path.exists(path):
+                print(f"Removing stale bundle '{path}'")
+                os.remove(path)
+
+    save_manifest(output_folder_path, manifest)
+
+    if not keep_images:
+        for image in ids:
+            # Remove the Docker image to save space, failures are ignored
+            print(f"Removing image '{image}' from local storage")
+            try:
+                run("rmi", image)
+            except subprocess.CalledProcessError:
+                pass
+    return manifest
 
 
 if __name__ == "__main__":
@@ -110,6 +266,27 @@ if __name__ == "__main__":
         action="store_true",
         help="Download images for all roles found in the project/roles directory.",
     )
+    group.add_argument(
+        "--verify",
+        action="store_true",
+        help="Check the bundles of the output folder against its manifest.",
+    )
+    parser.add_argument(
+        "--pulls",
+        type=int,
+        default=DEFAULT_PULLS,
+        help="Number of concurrent pulls (default: TAR_IMAGES_PULLS or 4).",
+    )
+    parser.add_argument(
+        "--refresh",
+        action="store_true",
+        help="Pull exported images again and rewrite the bundles whose digests changed.",
+    )
+    parser.add_argument(
+        "--keep-images",
+        action="store_true",
+        help="Do not remove the pulled images from local storage.",
+    )
     parser.add_argument(
         "OUTPUT_FOLDER_PATH",
         help="Path to the output folder where tarred images will be saved.",
@@ -117,9 +294,19 @@ if __name__ == "__main__":
 
     args = parser.parse_args()
 
+    if args.verify:
+        problems = verify(args.OUTPUT_FOLDER_PATH, deep=True)
+        for problem in problems:
+            print(problem)
+        print(f"{len(problems)} problem(s) found.")
+        raise SystemExit(1 if problems else 0)
+
     tar_images(
         str(INPUT_FOLDER_PATH),
         args.OUTPUT_FOLDER_PATH,
         role_name=args.role,
         all_roles=args.all,
+        pulls=args.pulls,
+        refresh=args.refresh,
+        keep_images=args.keep_images,
     )
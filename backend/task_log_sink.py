@@ -0,0 +1,150 @@
+"""_summary_
+Background writer for ansible task logs.
+
+ansible_runner calls the event handler once per event; writing each event in
+its own transaction costs one commit per event on the runner thread.
+TaskLogSink queues the rows and a writer thread inserts them in batches.
+"""
+
+import logging
+import os
+import queue
+import threading
+import time
+
+from install_events import broadcaster
+from repository import add_task_logs_bulk
+
+logger = logging.getLogger(__name__)
+
+# Rows written in one transaction
+BATCH_SIZE = int(os.getenv("TASK_LOG_BATCH_SIZE", "200"))
+# Maximum time (seconds) a row waits in the buffer before being written
+FLUSH_INTERVAL = float(os.getenv("TASK_LOG_FLUSH_INTERVAL", "0.5"))
+# Maximum number of rows waiting to be written
+QUEUE_SIZE = int(os.getenv("TASK_LOG_QUEUE_SIZE", "5000"))
+
+_FLUSH = object()
+_STOP = object()
+
+
+class TaskLogSink:
+    """
+    Buffer TaskLog rows and bulk insert them from a writer thread.
+
+    Rows are written when BATCH_SIZE rows are buffered, when the oldest row
+    waited FLUSH_INTERVAL seconds, or when flush()/close() is called.
+    When the queue is full, add() blocks until the writer makes room, logging
+    a warning every put_timeout seconds: a slow database slows the producer
+    down, and rows of one runner are still written in the order they came.
+    Only when the writer thread is gone does add() write the queued rows and
+    its own row itself.
+    """
+
+    def __init__(
+        self,
+        Session,
+        batch_size=BATCH_SIZE,
+        flush_interval=FLUSH_INTERVAL,
+        queue_size=QUEUE_SIZE,
+        put_timeout=1.0,
+    ):
+        self.Session = Session
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._closed = False
+        self._thread = threading.Thread(
+            target=self._run, name="task-log-sink", daemon=True
+        )
+        self._thread.start()
+
+    def add(self, event, task, stdout, runner_ident):
+        row = {
+            "event": event,
+            "task": task,
+            "stdout": stdout,
+            "runner_ident": runner_ident,
+        }
+        if self._closed:
+            self._write([row])
+            return
+        while self._thread.is_alive():
+            try:
+                self._queue.put(row, timeout=self.put_timeout)
+                return
+            except queue.Full:
+                logger.warning("Task log queue is full, waiting for the writer")
+        logger.error("Task log writer stopped, writing logs synchronously")
+        self._write(self._drain() + [row])
+
+    def flush(self):
+        """Block until every row added before this call is written."""
+        if self._closed:
+            return
+        self._queue.put(_FLUSH)
+        self._queue.join()
+
+    def close(self):
+        """Write the remaining rows and stop the writer thread."""
+        if self._closed:
+            return
+        self._queue.put(_STOP)
+        self._queue.join()
+        self._thread.join()
+        self._closed = True
+
+    def _drain(self):
+        """Take the rows left in the queue, oldest first."""
+        rows = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                return rows
+            if item is not _FLUSH and item is not _STOP:
+                rows.append(item)
+            self._queue.task_done()
+
+    def _write(self, rows):
+        if not rows:
+            return
+        try:
+            add_task_logs_bulk(rows, self.Session)
+        except Exception as e:
+            logger.error(f"Could not write {len(rows)} task logs: {e}")
+            return
+        broadcaster.publish()
+
+    def _run(self):
+        batch = []
+        deadline = None
+        while True:
+            timeout = self.flush_interval
+            if batch:
+                timeout = max(0, deadline - time.monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if item is None or item is _FLUSH or item is _STOP:
+                write = bool(batch)
+            else:
+                if not batch:
+                    deadline = time.monotonic() + self.flush_interval
+                batch.append(item)
+                write = (
+                    len(batch) >= self.batch_size or time.monotonic() >= deadline
+                )
+
+            if write:
+                self._write(batch)
+                for _ in batch:
+                    self._queue.task_done()
+                batch = []
+            if item is _FLUSH or item is _STOP:
+                self._queue.task_done()
+            if item is _STOP:
+                return
@@ -0,0 +1,172 @@
+"""
+Tests for the capacity planner (capacity.py) and get_capacity_plan.
+"""
+
+from unittest.mock import patch
+
+import pytest
+
+import initial_db
+import repository
+from capacity import (
+    CapacityPlanner,
+    build_plan,
+    interpolate_tiers,
+    planner,
+    zone_category,
+)
+
+
+def _row(node_count, cpu=4, ram=8192, os_disk=80, data_disk=0):
+    return {
+        "node_count": node_count,
+        "cpu_per_node": cpu,
+        "ram_per_node": ram,
+        "os_disk_size": os_disk,
+        "data_disk_size": data_disk,
+        "roles": "worker",
+    }
+
+
+TIERS = {
+    100: {"RKEAPPS_WORKER": _row(0), "LBLAN": _row(2, cpu=2, ram=2048)},
+    500: {"RKEAPPS_WORKER": _row(4), "LBLAN": _row(2, cpu=4, ram=4096)},
+    1000: {"RKEAPPS_WORKER": _row(8, cpu=8), "LBLAN": _row(2, cpu=4, ram=4096)},
+}
+
+
+@pytest.fixture
+def Session(tmp_path):
+    _, Session = initial_db.initialize_database(str(tmp_path / "app.db"))
+    planner.invalidate()
+    yield Session
+    planner.invalidate()
+    initial_db.dispose_engines()
+
+
+def test_zone_category():
+    assert zone_category("RKEAPPS_WORKER") == "LAN Apps"
+    assert zone_category("lbdmz") == "DMZ"
+    assert zone_category("vault") == "LAN Infra"
+    assert zone_category("unknown") == "LAN Infra"
+
+
+def test_interpolation_between_and_past_tiers():
+    assert interpolate_tiers(TIERS, 50) == TIERS[100]
+    assert interpolate_tiers(TIERS, 500) == TIERS[500]
+
+    middle = interpolate_tiers(TIERS, 300)
+    assert middle["RKEAPPS_WORKER"]["node_count"] == 2
+    assert middle["LBLAN"]["node_count"] == 2
+    assert middle["LBLAN"]["cpu_per_node"] == 3
+
+    # Rounded up: 750 users need 6 workers of ceil(4 + 4 * 0.5) CPUs
+    assert interpolate_tiers(TIERS, 750)["RKEAPPS_WORKER"]["node_count"] == 6
+    assert interpolate_tiers(TIERS, 750)["RKEAPPS_WORKER"]["cpu_per_node"] == 6
+
+    # Past the last tier, node counts keep growing and fixed counts stay
+    beyond = interpolate_tiers(TIERS, 2000)
+    assert beyond["RKEAPPS_WORKER"]["node_count"] == 16
+    assert beyond["RKEAPPS_WORKER"]["cpu_per_node"] == 8
+    assert beyond["LBLAN"]["node_count"] == 2
+
+
+def test_vm_types_missing_from_a_tier_are_interpolated_against_zero():
+    tiers = {
+        100: {"LBLAN": _row(2), "LEGACY": _row(4, cpu=2)},
+        500: {"LBLAN": _row(2), "RKEDMZ": _row(4, cpu=8)},
+    }
+    middle = interpolate_tiers(tiers, 300)
+    assert middle["RKEDMZ"]["node_count"] == 2
+    assert middle["RKEDMZ"]["cpu_per_node"] == 8
+    assert middle["LEGACY"]["node_count"] == 2
+    assert middle["LEGACY"]["cpu_per_node"] == 2
+    assert middle["LBLAN"]["node_count"] == 2
+    # No node left past the tier dropping the type
+    assert "LEGACY" not in interpolate_tiers(tiers, 1000)
+    assert interpolate_tiers(tiers, 1000)["RKEDMZ"]["node_count"] == 9
+
+
+def test_plan_falls_back_to_inventory():
+    vms = [
+        {"group": "RKEAPPS", "nb_cpu": 4, "ram": 16384, "os_disk_size": 80, "data_disk_size": 100},
+        {"group": "vault", "nb_cpu": 2, "ram": 2048, "os_disk_size": 50, "data_disk_size": 0},
+    ]
+    plan = build_plan(100, {}, vms)
+    assert plan["source"] == "inventory"
+    zones = {zone["zone"]: zone for zone in plan["zones"]}
+    assert zones["LAN Apps"]["total_cpu"] == 4
+    assert zones["LAN Apps"]["total_memory"] == 16
+    assert zones["LAN Apps"]["total_disk"] == 180
+    assert zones["LAN Infra"]["nodes"] == 1
+    assert zones["DMZ"]["total_cpu"] == 0
+    # The plan is JSON serializable: no zone refers to itself
+    assert "actual" not in zones["DMZ"]["actual"]
+
+    plan = build_plan(100, TIERS, vms)
+    assert plan["source"] == "vm_configurations"
+    zones = {zone["zone"]: zone for zone in plan["zones"]}
+    assert zones["LAN Apps"]["total_cpu"] == 4
+    assert zones["LAN Apps"]["total_memory"] == 4
+    assert zones["LAN Apps"]["actual"]["total_cpu"] == 4
+
+
+def test_planner_cache_is_versioned():
+    cache = CapacityPlanner()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return {"n": len(calls)}
+
+    assert cache.get(None, compute) == {"n": 1}
+    assert cache.get(None, compute) == {"n": 1}
+    cache.invalidate()
+    assert cache.get(None, compute) == {"n": 2}
+    assert cache.get_stats()["hits"] == 1
+
+
+def test_planner_cache_follows_the_database_version_and_expires():
+    cache = CapacityPlanner(ttl=60)
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return {"n": len(calls)}
+
+    assert cache.get(None, compute, 1) == {"n": 1}
+    assert cache.get(None, compute, 1) == {"n": 1}
+    assert cache.get(None, compute, 2) == {"n": 2}
+    expired = CapacityPlanner(ttl=0)
+    assert expired.get(None, compute, 2) == {"n": 3}
+    assert expired.get(None, compute, 2) == {"n": 4}
+
+
+def test_plan_follows_writes_of_other_workers(Session):
+    repository.seed_vm_configurations(Session)
+    plan = repository.get_capacity_plan(Session)
+    assert repository.get_capacity_plan(Session) is plan
+    # Another worker: the write does not reach this process' planner
+    with patch("repository.capacity_planner.invalidate"):
+        repository.update_number_concurent_users(10000, Session)
+    assert repository.get_capacity_plan(Session)["user_count"] == 10000
+
+
+def test_recap_follows_repository_writes(Session):
+    repository.seed_vm_configurations(Session)
+    recap = {zone["zone"]: zone for zone in repository.get_global_recap(Session)}
+    assert set(recap) == {"LAN Apps", "LAN Infra", "DMZ"}
+    assert all(zone["total_cpu"] > 0 for zone in recap.values())
+
+    plan = repository.get_capacity_plan(Session)
+    assert plan["user_count"] == 100
+    assert repository.get_capacity_plan(Session) is plan
+
+    repository.update_number_concurent_users(10000, Session)
+    bigger = repository.get_capacity_plan(Session)
+    assert bigger["user_count"] == 10000
+    assert sum(zone["total_cpu"] for zone in bigger["zones"]) > sum(
+        zone["total_cpu"] for zone in plan["zones"]
+    )
+    what_if = repository.get_capacity_plan(Session, user_count=750)
+    assert what_if["user_count"] == 750
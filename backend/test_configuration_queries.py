@@ -0,0 +1,73 @@
+"""
+Query count regression test of getConfiguration (repository.py).
+"""
+
+import pytest
+from sqlalchemy import event
+
+import initial_db
+import repository
+from models import ConfigurationModel
+
+# Configuration + security + monitoring, then one query per collection
+MAX_CONFIGURATION_QUERIES = 7
+
+
+@pytest.fixture
+def db(tmp_path):
+    Engine, Session = initial_db.initialize_database(str(tmp_path / "app.db"))
+    yield Engine, Session
+    initial_db.dispose_engines()
+
+
+def _count_queries(Engine):
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(Engine, "before_cursor_execute", before_cursor_execute)
+    return statements, lambda: event.remove(
+        Engine, "before_cursor_execute", before_cursor_execute
+    )
+
+
+def _add_services(Session, count):
+    for i in range(count):
+        repository.add_database(
+            f"db{i}",
+            "Postgresql",
+            f"db{i}",
+            "10.0.0.5",
+            5432,
+            "u",
+            "p",
+            Session,
+            servername="db",
+        )
+        repository.add_sms_provider(f"http://sms{i}", "u", "p", "b", Session)
+        repository.add_smtp_server(
+            f"smtp{i}", 25, "u", "p", "noreply@local", False, Session
+        )
+
+
+@pytest.mark.parametrize("count", [1, 5])
+def test_configuration_is_loaded_in_a_fixed_number_of_queries(db, count):
+    Engine, Session = db
+    _add_services(Session, count)
+
+    statements, stop = _count_queries(Engine)
+    try:
+        configuration = repository.getConfiguration(Session)
+        loaded = len(statements)
+        model = ConfigurationModel.model_validate(configuration)
+    finally:
+        stop()
+
+    assert loaded <= MAX_CONFIGURATION_QUERIES
+    # Serializing the detached object does not query again
+    assert len(statements) == loaded
+    assert len(model.databases) == count
+    assert len(model.sms_providers) == count
+    assert len(model.smtp_servers) == count
+    assert model.security is not None
@@ -0,0 +1,64 @@
+"""
+Tests for the cached engine (initial_db.py) and unit_of_work (repository.py).
+"""
+
+import pytest
+from sqlalchemy import text
+
+import initial_db
+import repository
+from models import VirtualMachine
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    path = str(tmp_path / "app.db")
+    yield path
+    initial_db.dispose_engines()
+
+
+def test_engine_and_sessionmaker_are_cached(db_path):
+    Engine, Session = repository.get_session(db_path)
+    Engine2, Session2 = repository.get_session(db_path)
+    assert Engine is Engine2
+    assert Session is Session2
+    assert initial_db.get_engine(db_path) is Engine
+
+
+def test_sqlite_uses_wal(db_path):
+    Engine, _ = initial_db.initialize_database(db_path)
+    with Engine.connect() as connection:
+        mode = connection.execute(text("PRAGMA journal_mode")).scalar()
+    assert mode == "wal"
+
+
+def test_fresh_database_is_initialized(db_path):
+    _, Session = initial_db.initialize_database(db_path)
+    assert len(repository.get_vms_by_group("RKEAPPS", Session)) == 3
+
+
+def test_unit_of_work_shares_one_session(db_path):
+    _, Session = initial_db.initialize_database(db_path)
+    with repository.unit_of_work(Session) as uow:
+        vm = repository.get_vms_by_group("vault", uow)[0]
+        repository.update_status_vm(vm.id, "deployed", uow)
+        assert uow() is uow()
+        # Objects stay attached between calls
+        assert vm.status == "deployed"
+    assert vm.status == "deployed"
+    assert repository.get_vms_by_group("vault", Session)[0].status == "deployed"
+
+
+def test_unit_of_work_rolls_back_on_error(db_path):
+    _, Session = initial_db.initialize_database(db_path)
+    vm_id = repository.get_vms_by_group("vault", Session)[0].id
+    with pytest.raises(RuntimeError):
+        with repository.unit_of_work(Session) as uow:
+            repository.update_status_vm(vm_id, "deployed", uow)
+            with repository.unit_of_work(uow) as inner:
+                assert inner is uow
+            raise RuntimeError("boom")
+
+    session = Session()
+    assert session.get(VirtualMachine, vm_id).status == "created"
+    session.close()
@@ -0,0 +1,75 @@
+"""
+Tests for the flow matrix verification engine (flow_checks.py).
+"""
+
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import initial_db
+import repository
+from flow_checks import build_probe_script, parse_probe_output, run_flow_checks
+from models import FlowMatrix
+
+
+def flow(id, source, destination="10.0.0.1", port=443, protocol="tcp"):
+    return SimpleNamespace(
+        id=id, source=source, destination=destination, port=port, protocol=protocol
+    )
+
+
+def test_probe_script_runs_every_flow():
+    script = build_probe_script(
+        [flow(1, "a", "ldap://dc1", 389), flow(2, "a", port=53, protocol="udp")],
+        timeout=3,
+    )
+    assert "nc -vz -w 3 dc1 389" in script
+    assert "nc -vzu -w 3 10.0.0.1 53" in script
+    assert script.rstrip().endswith("wait")
+
+
+def test_parse_probe_output():
+    assert parse_probe_output("2 1\nnoise\n1 0\n") == {1: True, 2: False}
+
+
+def test_one_check_per_source_in_parallel():
+    calls = []
+    active = {"now": 0, "max": 0}
+    lock = threading.Lock()
+
+    def fake_check(source, flows, pkey):
+        with lock:
+            calls.append(source)
+            active["now"] += 1
+            active["max"] = max(active["max"], active["now"])
+        time.sleep(0.05)
+        with lock:
+            active["now"] -= 1
+        return {f.id: source == "a" for f in flows}
+
+    flows = [flow(1, "a"), flow(2, "a"), flow(3, "b"), flow(4, "c")]
+    results = run_flow_checks(flows, None, max_workers=2, check=fake_check)
+    assert sorted(calls) == ["a", "b", "c"]
+    assert active["max"] == 2
+    assert results == {1: True, 2: True, 3: False, 4: False}
+
+
+@pytest.fixture
+def Session(tmp_path):
+    _, Session = initial_db.initialize_database(str(tmp_path / "app.db"))
+    yield Session
+    initial_db.dispose_engines()
+
+
+def test_update_status_flows(Session):
+    repository.add_flow_matrix("a", "b", "tcp", 22, Session)
+    repository.add_flow_matrix("a", "c", "tcp", 22, Session)
+    first, second = repository.get_flow_matrix(Session)
+    repository.update_status_flows({first.id: True, second.id: False}, Session)
+
+    session = Session()
+    assert session.get(FlowMatrix, first.id).is_open is True
+    assert session.get(FlowMatrix, second.id).is_open is False
+    session.close()
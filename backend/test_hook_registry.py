@@ -0,0 +1,55 @@
+"""
+Tests for the role hook module cache (hook_registry.py).
+"""
+
+import os
+
+from hook_registry import HookRegistry
+
+
+def write_hook(roles_root, role_name, hook_name, body):
+    role_dir = roles_root / role_name
+    role_dir.mkdir(exist_ok=True)
+    path = role_dir / f"{hook_name}.py"
+    path.write_text(body)
+    return path
+
+
+def test_module_is_loaded_once(tmp_path):
+    write_hook(tmp_path, "role-a", "prepare_inputs", "LOADS = []\nLOADS.append(1)\n")
+    registry = HookRegistry(str(tmp_path))
+
+    first = registry.get("role-a", "prepare_inputs")
+    second = registry.get("role-a", "prepare_inputs")
+    assert first is second
+    assert first.LOADS == [1]
+    assert registry.metrics()["hits"] == 1
+    assert registry.metrics()["misses"] == 1
+
+
+def test_changed_file_is_reloaded(tmp_path):
+    path = write_hook(tmp_path, "role-a", "post_install", "VALUE = 1\n")
+    registry = HookRegistry(str(tmp_path))
+    assert registry.get("role-a", "post_install").VALUE == 1
+
+    path.write_text("VALUE = 22\n")
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000))
+    assert registry.get("role-a", "post_install").VALUE == 22
+
+
+def test_missing_hook_returns_none(tmp_path):
+    registry = HookRegistry(str(tmp_path))
+    assert registry.get("role-a", "post_install") is None
+
+
+def test_preload_skips_broken_hooks(tmp_path):
+    write_hook(tmp_path, "role-a", "prepare_inputs", "def get_inputs(Session): pass\n")
+    write_hook(tmp_path, "role-a", "post_install", "def post_install(Session): pass\n")
+    write_hook(tmp_path, "role-b", "prepare_inputs", "raise ImportError('boom')\n")
+    registry = HookRegistry(str(tmp_path))
+
+    assert registry.preload() == 2
+    metrics = registry.metrics()
+    assert metrics["cached"] == 2
+    assert set(metrics["load_times"]) == {"role-a/prepare_inputs", "role-a/post_install"}
@@ -0,0 +1,77 @@
+"""
+Tests for the offline image store manifest (image_store.py).
+"""
+
+import json
+
+from image_store import (
+    LEGACY_INDEX_FILE,
+    MANIFEST_FILE,
+    bundles_to_load,
+    legacy_tar_images,
+    load_manifest,
+    save_manifest,
+    split_reference,
+    verify,
+)
+
+
+def _manifest(tmp_path):
+    (tmp_path / "a.tar").write_bytes(b"bundle")
+    return {
+        "images": {
+            "redis:7": {"image_id": "sha256:d", "file": "a.tar"},
+            "quay.io/app:1": {"image_id": "sha256:q", "file": "a.tar"},
+        },
+        "bundles": {
+            "a.tar": {"images": ["redis:7", "quay.io/app:1"], "size": 6, "sha256": None}
+        },
+    }
+
+
+def test_split_reference():
+    assert split_reference("redis:7.0.15-alpine") == ("redis", "7.0.15-alpine")
+    assert split_reference("harbor.local:8443/my_app") == (
+        "harbor.local:8443/my_app",
+        "latest",
+    )
+    assert split_reference("nginx@sha256:ab") == ("nginx", "sha256:ab")
+
+
+def test_bundles_to_load_and_verify(tmp_path):
+    manifest = _manifest(tmp_path)
+    assert bundles_to_load(manifest, ["sha256:d", "sha256:q"]) == []
+    assert bundles_to_load(manifest, ["sha256:d"]) == ["a.tar"]
+    assert verify(str(tmp_path), manifest) == []
+
+    (tmp_path / "a.tar").write_bytes(b"truncated bundle")
+    assert verify(str(tmp_path), manifest) == ["a.tar: size 16, expected 6"]
+    (tmp_path / "a.tar").unlink()
+    assert verify(str(tmp_path), manifest) == ["a.tar: missing"]
+
+
+def test_legacy_index_is_migrated(tmp_path):
+    (tmp_path / LEGACY_INDEX_FILE).write_text(
+        json.dumps(
+            {
+                "images": {
+                    "redis:7": {"id": "sha256:d", "bundle": "a.tar", "roles": []}
+                },
+                "bundles": {"a.tar": {"role": "a", "images": ["redis:7"], "size": 6}},
+            }
+        )
+    )
+    manifest = load_manifest(str(tmp_path))
+    assert manifest["images"]["redis:7"]["image_id"] == "sha256:d"
+    assert manifest["images"]["redis:7"]["tag"] == "7"
+    save_manifest(str(tmp_path), manifest)
+    assert [path.name for path in tmp_path.iterdir()] == [MANIFEST_FILE]
+
+
+def test_legacy_tar_images(tmp_path):
+    assert legacy_tar_images(str(tmp_path / "missing")) == {}
+    (tmp_path / "install-a_quay.io_app:1.tar").write_bytes(b"")
+    (tmp_path / "notes.txt").write_text("")
+    assert legacy_tar_images(str(tmp_path)) == {
+        "install-a_quay.io_app:1.tar": "quay.io/app:1"
+    }
@@ -0,0 +1,224 @@
+"""
+Tests for the install runs: resume from the failed roles and run history.
+"""
+
+import asyncio
+import datetime
+import os
+import socket
+import tempfile
+import uuid
+from unittest.mock import patch
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, inspect
+
+import initial_db
+import install
+import repository
+
+# Importing the API opens its database, keep it out of the working directory
+with patch("initial_db.DATABASE_URL", os.path.join(tempfile.mkdtemp(), "api.db")):
+    import api
+
+
+@pytest.fixture
+def Session(tmp_path):
+    _, Session = initial_db.initialize_database(str(tmp_path / "app.db"))
+    with patch("install.check_monitoring_role_existence", return_value=False):
+        yield Session
+    initial_db.dispose_engines()
+
+
+def run_install(Session, statuses, resume=False):
+    started = []
+
+    async def fake_async_call_role(role_name, Session):
+        started.append(role_name)
+        runner_ident = str(uuid.uuid4())
+        repository.update_ansible_role(role_name, runner_ident, "running", Session)
+        repository.add_task_logs("runner_on_ok", "task", "ok", runner_ident, Session)
+        repository.update_ansible_role_status(
+            role_name, statuses.get(role_name, "successful"), Session
+        )
+
+    with patch("install.async_call_role", fake_async_call_role), patch(
+        "install.build_snapshot", lambda Session: Session
+    ):
+        results = asyncio.run(install.install_all_roles(Session, resume=resume))
+    return results, started
+
+
+def test_resume_runs_only_the_roles_that_did_not_succeed(Session):
+    results, _ = run_install(Session, {"install-gogs": "failed"})
+    assert results["install-gogs"] == "failed"
+    assert results["install-argocd"] == "skipped"
+    first = repository.get_install_runs(Session)[0]
+    assert first.status == "failed"
+
+    not_run = sorted(role for role, status in results.items() if status != "successful")
+    assert "install-gogs" in not_run and "prepare-vms" not in not_run
+
+    results, started = run_install(Session, {}, resume=True)
+    assert sorted(started) == not_run
+    assert all(status == "successful" for status in results.values())
+
+    runs = repository.get_install_runs(Session)
+    assert len(runs) == 1
+    assert runs[0].status == "successful" and runs[0].resumes == 1
+    roles = {role.role_name: role for role in repository.get_ansible_roles(Session)}
+    assert len(roles) == len(install.noinf_roles)
+    assert roles["install-gogs"].attempt == 2
+    assert roles["prepare-vms"].attempt == 1
+    # The failed attempt is kept for comparison
+    attempts = repository.get_install_run(runs[0].id, Session).ansible_roles
+    assert [role.status for role in attempts if role.role_name == "install-gogs"] == [
+        "failed",
+        "successful",
+    ]
+
+
+def test_resume_after_success_starts_a_new_run(Session):
+    run_install(Session, {})
+    _, started = run_install(Session, {}, resume=True)
+    assert sorted(started) == sorted(install.noinf_roles)
+    assert len(repository.get_install_runs(Session)) == 2
+
+
+def test_resume_never_reopens_a_running_run(Session):
+    running = repository.start_install_run(Session)
+    assert repository.resume_install_run(Session) is None
+    run = repository.get_install_run(running.id, Session)
+    assert run.status == "running" and run.resumes == 0
+
+
+def _set_run(run_id, Session, **values):
+    session = Session()
+    session.query(repository.InstallRun).filter(
+        repository.InstallRun.id == run_id
+    ).update(values)
+    session.commit()
+    session.close()
+
+
+def test_one_running_run_across_processes(Session):
+    running = repository.start_install_run(Session)
+    assert running.owner == repository.install_run_owner()
+    # The unique index refuses it, whatever process asks
+    with pytest.raises(repository.InstallRunConflict):
+        repository.start_install_run(Session)
+    repository.finish_install_run(running.id, "failed", Session)
+    other = repository.start_install_run(Session)
+    assert repository.resume_install_run(Session) is None
+    assert repository.get_install_run(other.id, Session).status == "running"
+
+
+def test_only_runs_whose_owner_is_gone_are_failed(Session):
+    live = repository.start_install_run(Session)
+    assert repository.fail_interrupted_install_runs(Session) == 0
+
+    # A worker of this host that stopped
+    _set_run(live.id, Session, owner=f"{socket.gethostname()}:999999999")
+    assert repository.fail_interrupted_install_runs(Session) == 1
+
+    # A worker of another host that stopped beating
+    other = repository.start_install_run(Session)
+    _set_run(other.id, Session, owner="other-host:1")
+    assert repository.fail_interrupted_install_runs(Session) == 0
+    _set_run(
+        other.id,
+        Session,
+        heartbeat_at=datetime.datetime.now() - datetime.timedelta(hours=1),
+    )
+    assert repository.fail_interrupted_install_runs(Session) == 1
+    statuses = [run.status for run in repository.get_install_runs(Session)]
+    assert statuses == ["failed", "failed"]
+
+
+def test_running_install_beats_its_heartbeat(Session):
+    install_run = repository.start_install_run(Session)
+    _set_run(install_run.id, Session, heartbeat_at=None)
+
+    async def scenario():
+        async with install.install_run_heartbeat(install_run.id, Session, 0.01):
+            await asyncio.sleep(0.1)
+
+    asyncio.run(scenario())
+    assert repository.get_install_run(install_run.id, Session).heartbeat_at
+    assert repository.fail_interrupted_install_runs(Session) == 0
+
+
+def test_failed_preparation_does_not_leave_the_run_running(Session):
+    with patch("install.add_ansible_role", side_effect=RuntimeError("db down")):
+        with pytest.raises(RuntimeError):
+            install.prepare_install_run(Session)
+    assert [run.status for run in repository.get_install_runs(Session)] == ["failed"]
+
+
+def test_start_is_refused_while_a_run_is_running(Session):
+    async def fake_install_all_roles(Session, prepared=None):
+        pass
+
+    repository.save_role_result("prepare-vms", "sha256:x", "successful", Session)
+    client = TestClient(api.app)
+    with patch("api.Session", Session), patch(
+        "api.install_all_roles", fake_install_all_roles
+    ):
+        assert client.post("/start").status_code == 200
+        refused = client.post("/start", params={"resume": True, "force": True})
+        assert refused.status_code == 409
+        assert len(repository.get_install_runs(Session)) == 1
+        # The running run keeps the fingerprints it was planned with
+        assert repository.get_role_result("prepare-vms", Session) is not None
+
+        # The worker running it stopped beating
+        run_id = repository.get_install_runs(Session)[0].id
+        _set_run(run_id, Session, heartbeat_at=None)
+        resumed = client.post("/start", params={"resume": True, "force": True})
+        assert resumed.status_code == 200
+    runs = repository.get_install_runs(Session)
+    assert len(runs) == 1
+    assert runs[0].status == "running" and runs[0].resumes == 1
+    assert repository.get_role_result("prepare-vms", Session) is None
+
+
+def test_upgrade_fails_the_runs_of_older_versions(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    with engine.begin() as connection:
+        connection.exec_driver_sql(
+            "CREATE TABLE install_runs (id INTEGER PRIMARY KEY, status VARCHAR "
+            "NOT NULL, started_at DATETIME NOT NULL, finished_at DATETIME, "
+            "resumes INTEGER NOT NULL)"
+        )
+        for id in (1, 2):
+            connection.exec_driver_sql(
+                "INSERT INTO install_runs VALUES "
+                f"({id}, 'running', '2026-01-01 00:00:00', NULL, 0)"
+            )
+    initial_db.upgrade_schema(engine)
+    with engine.begin() as connection:
+        statuses = [
+            status
+            for (status,) in connection.exec_driver_sql(
+                "SELECT status FROM install_runs"
+            )
+        ]
+    indexes = [index["name"] for index in inspect(engine).get_indexes("install_runs")]
+    engine.dispose()
+    assert statuses == ["failed", "failed"]
+    assert "ux_install_runs_running" in indexes
+
+
+def test_old_runs_are_pruned_with_their_logs(Session):
+    with patch("repository.INSTALL_RUN_RETENTION", 2):
+        for _ in range(3):
+            run_install(Session, {})
+    runs = repository.get_install_runs(Session)
+    assert len(runs) == 2
+    session = Session()
+    run_ids = {run_id for (run_id,) in session.query(repository.AnsibleRole.run_id)}
+    logs = session.query(repository.TaskLog).count()
+    session.close()
+    assert run_ids == {run.id for run in runs}
+    assert logs == 2 * len(install.noinf_roles)
@@ -0,0 +1,165 @@
+"""
+Tests for the Server-Sent Events stream of install progress (/install/stream).
+"""
+
+import asyncio
+import json
+import os
+import tempfile
+from unittest.mock import patch
+
+import pytest
+
+import initial_db
+import repository
+from install_events import broadcaster
+from models import TaskLog
+
+# Importing the API opens its database, keep it out of the working directory
+with patch("initial_db.DATABASE_URL", os.path.join(tempfile.mkdtemp(), "api.db")):
+    import api
+
+
+class FakeRequest:
+    def __init__(self, headers=None):
+        self.headers = headers or {}
+        self.disconnected = False
+
+    async def is_disconnected(self):
+        return self.disconnected
+
+
+@pytest.fixture
+def Session(tmp_path):
+    _, Session = initial_db.initialize_database(str(tmp_path / "app.db"))
+    install_run = repository.start_install_run(Session)
+    for order, role in enumerate(["prepare-vms", "install-vault"], 1):
+        repository.add_ansible_role(role, order, Session, run_id=install_run.id)
+    repository.update_ansible_role("prepare-vms", "ident-1", "running", Session)
+    for task in ("one", "two", "three"):
+        repository.add_task_logs("runner_on_ok", task, task, "ident-1", Session)
+    with patch("api.Session", Session), patch("api.STREAM_POLL_INTERVAL", 0.05):
+        yield Session
+    initial_db.dispose_engines()
+
+
+def parse(message):
+    fields = dict(
+        line.split(": ", 1) for line in message.strip().splitlines() if ": " in line
+    )
+    if "data" in fields:
+        fields["data"] = json.loads(fields["data"])
+    return fields
+
+
+async def read_until_keep_alive(stream):
+    messages = []
+    async for message in stream:
+        if message.startswith(": keep-alive"):
+            return messages
+        messages.append(parse(message))
+    return messages
+
+
+def task_log_ids(Session):
+    return [log.id for log in repository.get_task_logs("ident-1", Session)]
+
+
+def test_last_event_id_resumes_after_the_seen_task_logs(Session):
+    ids = task_log_ids(Session)
+
+    async def scenario():
+        request = FakeRequest({"last-event-id": str(ids[1])})
+        response = await api.stream_install_events(request, None, 0)
+        stream = response.body_iterator
+        first = await read_until_keep_alive(stream)
+
+        repository.update_ansible_role_status("install-vault", "running", Session)
+        repository.add_task_logs("runner_on_ok", "four", "four", "ident-1", Session)
+        broadcaster.publish()
+        second = await read_until_keep_alive(stream)
+        await stream.aclose()
+        return first, second
+
+    first, second = asyncio.run(scenario())
+    # The current state of every role, then only the logs after Last-Event-ID
+    roles = {m["data"]["role_name"]: m["data"]["status"] for m in first[:2]}
+    assert roles == {"prepare-vms": "running", "install-vault": "init"}
+    assert [m["event"] for m in first] == ["role", "role", "task_log"]
+    assert first[2]["id"] == str(ids[2]) and first[2]["data"]["task"] == "three"
+
+    # Only the role that changed and the new log are sent afterwards
+    assert [(m["event"], m["data"].get("role_name")) for m in second] == [
+        ("role", "install-vault"),
+        ("task_log", None),
+    ]
+    assert second[1]["data"]["task"] == "four"
+    assert int(second[1]["id"]) > ids[2]
+
+
+def test_after_id_and_last_event_id_take_the_latest(Session):
+    ids = task_log_ids(Session)
+
+    async def scenario():
+        request = FakeRequest({"last-event-id": str(ids[0])})
+        response = await api.stream_install_events(request, None, ids[1])
+        messages = await read_until_keep_alive(response.body_iterator)
+        await response.body_iterator.aclose()
+        return messages
+
+    logs = [m for m in asyncio.run(scenario()) if m["event"] == "task_log"]
+    assert [int(m["id"]) for m in logs] == [ids[2]]
+
+
+def test_stream_keeps_alive_and_ends_on_disconnect(Session):
+    async def scenario():
+        request = FakeRequest()
+        stream = api.install_event_stream(request, "other-ident", 0)
+        messages = []
+        async for message in stream:
+            messages.append(message)
+            if message.startswith(": keep-alive"):
+                if messages.count(": keep-alive\n\n") == 2:
+                    request.disconnected = True
+        return messages
+
+    messages = asyncio.run(scenario())
+    # Roles once, no log of another runner, a keep-alive per idle interval
+    assert [parse(m).get("event") for m in messages] == ["role", "role", None, None]
+    assert messages[-1] == ": keep-alive\n\n"
+    assert broadcaster._subscribers == {}
+
+
+def test_rows_committed_out_of_id_order_are_not_skipped(Session):
+    def add_log(id, task, runner_ident):
+        session = Session()
+        session.add(
+            TaskLog(
+                id=id, event="runner_on_ok", task=task, stdout="",
+                runner_ident=runner_ident,
+            )
+        )
+        session.commit()
+        session.close()
+
+    add_log(20, "four", "ident-1")
+
+    async def scenario():
+        stream = api.install_event_stream(FakeRequest(), None, 0)
+        first = await read_until_keep_alive(stream)
+        # Another role commits a batch whose ids were taken before id 20
+        add_log(15, "late", "ident-2")
+        add_log(21, "five", "ident-1")
+        broadcaster.publish()
+        second = await read_until_keep_alive(stream)
+        await stream.aclose()
+        return first, second
+
+    first, second = asyncio.run(scenario())
+    assert [m["data"]["task"] for m in first if m["event"] == "task_log"] == [
+        "one", "two", "three", "four",
+    ]
+    assert [(m["id"], m["data"]["task"]) for m in second] == [
+        ("15", "late"),
+        ("21", "five"),
+    ]
@@ -0,0 +1,176 @@
+"""
+Tests for the bitmap IP pools (ip_allocator.py) and the zone IP allocation
+of repository.py.
+"""
+
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+
+import pytest
+from fastapi.testclient import TestClient
+
+import initial_db
+import repository
+from ip_allocator import IpPool, zone_pools
+from models import VirtualMachine, Zone
+
+# Importing the API opens its database, keep it out of the working directory
+with patch("initial_db.DATABASE_URL", os.path.join(tempfile.mkdtemp(), "api.db")):
+    import api
+
+
+@pytest.fixture
+def Session(tmp_path):
+    _, Session = initial_db.initialize_database(str(tmp_path / "app.db"))
+    session = Session()
+    zone = session.query(Zone).get(1)
+    zone.ip_pool_start = "10.0.0.10"
+    zone.ip_pool_end = "10.0.0.29"
+    vms = session.query(VirtualMachine).order_by(VirtualMachine.id).all()
+    # Used addresses: .10, .11 and .13
+    for vm, ip in zip(vms, ["10.0.0.10", "10.0.0.11", "10.0.0.13"]):
+        vm.ip = ip
+    session.commit()
+    session.close()
+    zone_pools.forget(1)
+    yield Session
+    zone_pools.forget(1)
+    initial_db.dispose_engines()
+
+
+def allocate(zone_id, count, Session):
+    with repository.unit_of_work(Session) as uow:
+        return repository.allocate_ips(zone_id, count, uow)
+
+
+def test_pool_pads_the_last_byte():
+    pool = IpPool(100, 109)
+    assert pool.allocate(10) == list(range(100, 110))
+    with pytest.raises(ValueError):
+        pool.allocate(1)
+    assert pool.utilization()["utilization"] == 100.0
+
+
+def test_allocate_skips_used_addresses(Session):
+    assert repository.get_next_available_ip(1, Session) == "10.0.0.12"
+    ips = allocate(1, 3, Session)
+    assert ips == ["10.0.0.12", "10.0.0.14", "10.0.0.15"]
+    # Allocated addresses are not handed out again
+    assert repository.get_next_available_ip(1, Session) == "10.0.0.16"
+    assert allocate(1, 1, Session) == ["10.0.0.16"]
+
+
+def test_concurrent_allocations_are_unique(Session):
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(
+            executor.map(lambda _: allocate(1, 2, Session), range(8))
+        )
+    ips = [ip for result in results for ip in result]
+    assert len(ips) == len(set(ips)) == 16
+    with pytest.raises(ValueError, match="No available IP"):
+        allocate(1, 2, Session)
+
+
+def test_allocation_needs_a_unit_of_work(Session):
+    with pytest.raises(TypeError, match="unit_of_work"):
+        repository.allocate_ips(1, 1, Session)
+
+
+def test_allocations_of_another_process_wait_for_the_stored_vms(Session):
+    allocated = threading.Event()
+    other = {}
+
+    def other_process():
+        allocated.wait(5)
+        # Its reservations are not seen by the other process
+        zone_pools.forget(1)
+        other["ips"] = allocate(1, 2, Session)
+
+    thread = threading.Thread(target=other_process)
+    thread.start()
+    with repository.unit_of_work(Session) as uow:
+        ips = repository.allocate_ips(1, 2, uow)
+        allocated.set()
+        time.sleep(0.2)
+        # Waiting for the zone lock
+        assert thread.is_alive()
+        for ip in ips:
+            repository.add_virtual_machine(
+                f"vm-{ip}", "worker", ip, "RKEAPPS", 2, 4, 50, 0, 1, uow
+            )
+    thread.join(10)
+    assert ips == ["10.0.0.12", "10.0.0.14"]
+    assert other["ips"] == ["10.0.0.15", "10.0.0.16"]
+
+
+def test_allocation_in_a_unit_of_work(Session):
+    with repository.unit_of_work(Session) as uow:
+        ips = repository.allocate_ips(1, 2, uow)
+        for ip in ips:
+            repository.add_virtual_machine(
+                f"vm-{ip}", "worker", ip, "RKEAPPS", 2, 4, 50, 0, 1, uow
+            )
+    usage = repository.get_zone_ip_pool_usage(1, Session)
+    assert usage["size"] == 20
+    assert usage["used"] == 5
+
+
+def test_deleting_a_vm_releases_its_address(Session):
+    allocate(1, 1, Session)
+    vm = repository.get_virtual_machines(Session)[0]
+    assert vm.ip == "10.0.0.10"
+    repository.delete_virtual_machine(vm.id, Session)
+    assert allocate(1, 1, Session) == ["10.0.0.10"]
+
+
+def test_addresses_freed_by_other_paths_are_reused(Session):
+    # Fill the pool, then free an address without release_ips (another
+    # process or a bulk delete)
+    allocate(1, 17, Session)
+    with pytest.raises(ValueError, match="No available IP"):
+        allocate(1, 1, Session)
+    session = Session()
+    session.query(VirtualMachine).filter(VirtualMachine.ip == "10.0.0.11").delete()
+    session.commit()
+    session.close()
+    assert allocate(1, 1, Session) == ["10.0.0.11"]
+
+
+def test_reservations_stored_on_a_vm_stay_used(Session):
+    ip = allocate(1, 1, Session)[0]
+    repository.add_virtual_machine(
+        "vm", "worker", ip, "RKEAPPS", 2, 4, 50, 0, 1, Session
+    )
+    vm = [vm for vm in repository.get_virtual_machines(Session) if vm.ip == ip][0]
+    assert allocate(1, 1, Session) != [ip]
+    session = Session()
+    session.query(VirtualMachine).filter(VirtualMachine.id == vm.id).delete()
+    session.commit()
+    session.close()
+    # Stored then deleted: no longer reserved
+    assert repository.get_next_available_ip(1, Session) == ip
+
+
+def test_deleting_an_unknown_vm_is_a_404(Session):
+    client = TestClient(api.app)
+    with patch("api.Session", Session):
+        assert client.delete("/virtual-machine/999").status_code == 404
+        vm = repository.get_virtual_machines(Session)[0]
+        assert client.delete(f"/virtual-machine/{vm.id}").status_code == 200
+        assert client.delete(f"/virtual-machine/{vm.id}").status_code == 404
+
+
+def test_pool_change_resets_the_allocations(Session):
+    allocate(1, 2, Session)
+    session = Session()
+    session.query(Zone).get(1).ip_pool_end = "10.0.0.30"
+    session.commit()
+    session.close()
+    # Unknown zone or range change: the pool is rebuilt from the VMs
+    assert allocate(1, 1, Session) == ["10.0.0.12"]
+    with pytest.raises(ValueError, match="not found"):
+        allocate(99, 1, Session)
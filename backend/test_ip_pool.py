@@ -106,6 +106,48 @@ print(f"  Total allocated IPs: {len(assigned_ips)}")
 assert len(assigned_ips) == 3, f"Expected 3 allocated IPs, got {len(assigned_ips)}"
 print("  ✓ Passed")
 
+# Test 6: Bitmap allocator on a /16 pool
+print("\nTest 6: Bitmap allocation benchmark (/16 pool)")
+import time
+
+from ip_allocator import IpPool
+
+pool_start = "10.96.0.1"
+pool_end = "10.96.255.254"
+pool = IpPool(ip_to_int(pool_start), ip_to_int(pool_end))
+# Every other address of the first half is already used by a VM
+pool.mark_many(range(pool.start, pool.start + pool.size // 2, 2))
+used_before = pool.used
+
+start = time.perf_counter()
+allocated = []
+for i in range(1000):
+    allocated.extend(pool.allocate(1))
+single_ms = (time.perf_counter() - start) * 1000
+start = time.perf_counter()
+bulk = pool.allocate(5000)
+bulk_ms = (time.perf_counter() - start) * 1000
+print(f"  Pool size: {pool.size}, used before: {used_before}")
+print(f"  1000 single allocations: {single_ms:.1f} ms")
+print(f"  1 bulk allocation of 5000: {bulk_ms:.1f} ms")
+print(f"  Utilization: {pool.utilization()}")
+assert len(set(allocated + bulk)) == 6000, "Allocated IPs must be unique"
+assert int_to_ip(allocated[0]) == "10.96.0.2", f"Got {int_to_ip(allocated[0])}"
+assert pool.used == used_before + 6000
+assert single_ms < 2000 and bulk_ms < 2000, "Allocation is too slow"
+
+# Released addresses are handed out again first
+pool.release(allocated[0])
+assert pool.allocate(1) == [allocated[0]]
+# Exhaustion allocates nothing
+try:
+    pool.allocate(pool.size)
+    raise AssertionError("Expected pool exhaustion")
+except ValueError:
+    print("  Exhausted pool rejected the allocation")
+assert pool.used == used_before + 6000
+print("  ✓ Passed")
+
 print("\n" + "="*50)
 print("All tests passed! ✓")
 print("="*50)
@@ -0,0 +1,89 @@
+"""
+Tests for the projection listings get_services and get_hypervisor_list.
+"""
+
+import pytest
+from sqlalchemy import event
+
+import initial_db
+import repository
+from models import VMwareEsxi
+
+
+@pytest.fixture
+def db(tmp_path):
+    Engine, Session = initial_db.initialize_database(str(tmp_path / "app.db"))
+    repository.add_sms_provider("http://sms", "u", "p", "b", Session)
+    repository.add_smtp_server("smtp", 25, "u", "p", "noreply@local", False, Session)
+    repository.add_database(
+        "db", "Postgresql", "db", "10.0.0.5", 5432, "u", "p", Session, servername="db"
+    )
+    repository.add_database(
+        "db2", "Postgresql", "db2", "10.0.0.6", 5432, "u", "p", Session, servername="db"
+    )
+    session = Session()
+    session.add(
+        VMwareEsxi(
+            alias="vcenter",
+            login="u",
+            password="secret",
+            api_url="vcenter.local",
+            api_timeout=10,
+            allow_unverified_ssl=True,
+            datacenter_name="dc",
+            datacenter_id="dc-1",
+            target_name="cluster",
+            target_id="c-1",
+            target_type="cluster",
+            datastore_name="ds",
+            datastore_id="ds-1",
+            pool_ressource_name="pool",
+            pool_ressource_id="p-1",
+            is_connected=True,
+            configuration_id=1,
+        )
+    )
+    session.commit()
+    session.close()
+    repository.add_nutanix_ahv_configuration(
+        "ahv", "u", "secret", "ahv.local", 9440, True, False, Session
+    )
+    yield Engine, Session
+    initial_db.dispose_engines()
+
+
+def test_services_listing(db):
+    Engine, Session = db
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(Engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        services = repository.get_services(Session)
+    finally:
+        event.remove(Engine, "before_cursor_execute", before_cursor_execute)
+    assert services == [
+        {"id": 1, "type": "sms_provider"},
+        {"id": 1, "type": "smtp_server"},
+        {"id": 1, "type": "database"},
+        {"id": 2, "type": "database"},
+    ]
+    assert len(statements) == 1
+    assert "UNION ALL" in statements[0]
+    assert repository.get_services(Session, type="database", limit=1, offset=1) == [
+        {"id": 2, "type": "database"}
+    ]
+
+
+def test_hypervisor_listing_has_no_credentials(db):
+    _, Session = db
+    hypervisors = repository.get_hypervisor_list(Session)
+    assert hypervisors == [
+        {"id": 1, "alias": "vcenter", "type": "vmware", "is_connected": True},
+        {"id": 1, "alias": "ahv", "type": "nutanix", "is_connected": False},
+    ]
+    assert repository.get_hypervisor_list(Session, type="nutanix") == hypervisors[1:]
+    assert repository.get_hypervisor_list(Session, is_connected=True) == hypervisors[:1]
+    assert repository.get_hypervisor_list(Session, limit=1, offset=1) == hypervisors[1:]
@@ -0,0 +1,109 @@
+"""
+Tests for the IPv4 helpers of network_math.py.
+"""
+
+import pytest
+
+import initial_db
+import network_math
+import repository
+from network_math import (
+    addresses_outside,
+    batch_in_network,
+    batch_in_range,
+    increment_ip,
+    int_to_ip,
+    ip_to_int,
+    is_ip_in_network,
+    is_ip_in_pool,
+    to_array,
+    validate_zone_network,
+)
+
+
+def test_conversions_and_increment():
+    assert ip_to_int("192.168.1.1") == 3232235777
+    assert int_to_ip(3232235777) == "192.168.1.1"
+    assert increment_ip("10.0.0.254") == "10.0.0.255"
+    assert increment_ip("10.0.0.255") == "10.0.1.0"
+    assert increment_ip("10.0.255.255", 2) == "10.1.0.1"
+    assert increment_ip("10.0.0.1", 65536) == "10.1.0.1"
+    assert increment_ip("255.255.255.255") == "0.0.0.0"
+    with pytest.raises(ValueError):
+        ip_to_int("10.0.0")
+
+
+def test_range_and_network_membership():
+    assert is_ip_in_pool("10.97.235.150", "10.97.235.100", "10.97.235.200")
+    assert not is_ip_in_pool("10.97.235.50", "10.97.235.100", "10.97.235.200")
+    assert is_ip_in_network("10.1.2.3", "10.1.0.0", 16)
+    assert is_ip_in_network("10.1.2.3", "10.1.0.0", "255.255.0.0")
+    assert not is_ip_in_network("10.2.0.1", "10.1.0.0", 16)
+
+
+@pytest.mark.parametrize("numpy", [True, False])
+def test_batch_checks(monkeypatch, numpy):
+    if not numpy:
+        monkeypatch.setattr(network_math, "np", None)
+    elif network_math.np is None:
+        pytest.skip("NumPy is not installed")
+    ips = ["10.0.0.5", "10.0.1.5", "10.0.0.200", "192.168.0.1"]
+    addresses = to_array(ips)
+    assert list(batch_in_network(addresses, "10.0.0.0", 24)) == [
+        True,
+        False,
+        True,
+        False,
+    ]
+    assert list(batch_in_range(addresses, "10.0.0.1", "10.0.0.100")) == [
+        True,
+        False,
+        False,
+        False,
+    ]
+    assert addresses_outside(ips + ["bad"], "10.0.0.0", 24, "10.0.0.1", "10.0.0.100") == [
+        "bad",
+        "10.0.1.5",
+        "10.0.0.200",
+        "192.168.0.1",
+    ]
+
+
+def test_validate_zone_network():
+    validate_zone_network("10.0.0.0", 24, "10.0.0.1", "10.0.0.10", "10.0.0.99")
+    # Not filled in yet
+    validate_zone_network("", 0, "", "", "")
+    with pytest.raises(ValueError, match="Invalid network"):
+        validate_zone_network("10.0.0.1", 24, "10.0.0.1")
+    with pytest.raises(ValueError, match="Gateway 10.0.1.1 is not in"):
+        validate_zone_network("10.0.0.0", 24, "10.0.1.1")
+    with pytest.raises(ValueError, match="not a host address"):
+        validate_zone_network("10.0.0.0", 24, "10.0.0.255")
+    with pytest.raises(ValueError, match="lower than its start"):
+        validate_zone_network("10.0.0.0", 24, "10.0.0.1", "10.0.0.99", "10.0.0.10")
+
+
+def test_update_zone_rejects_inconsistent_network(tmp_path):
+    _, Session = initial_db.initialize_database(str(tmp_path / "app.db"))
+    try:
+        zone = repository.get_zones(Session)[0]
+        arguments = dict(
+            name=zone.name,
+            sub_network="10.0.0.0",
+            network_mask=24,
+            dns="10.0.0.2",
+            hypervisor_type="",
+            gateway="10.0.0.1",
+            domain="local",
+            vlan_name="default",
+            hypervisor_id=None,
+            ip_pool_start="10.0.0.10",
+            ip_pool_end="10.0.1.10",
+            Session=Session,
+        )
+        with pytest.raises(ValueError, match="IP pool end"):
+            repository.update_zone(zone.id, **arguments)
+        arguments["ip_pool_end"] = "10.0.0.50"
+        assert repository.update_zone(zone.id, **arguments).ip_pool_end == "10.0.0.50"
+    finally:
+        initial_db.dispose_engines()
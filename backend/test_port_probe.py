@@ -0,0 +1,69 @@
+"""
+Tests for the asyncio port prober (port_probe.py), against local sockets.
+"""
+
+import asyncio
+import socket
+
+import initial_db
+import repository
+from port_probe import probe, probe_many
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def test_open_and_closed_tcp_ports():
+    async def scenario():
+        server = await asyncio.start_server(
+            lambda reader, writer: writer.close(), "127.0.0.1", 0
+        )
+        open_port = server.sockets[0].getsockname()[1]
+        async with server:
+            return await probe_many(
+                [
+                    {"name": "open", "host": "127.0.0.1", "port": open_port},
+                    {"name": "closed", "host": "127.0.0.1", "port": free_port()},
+                    {"name": "bad", "host": "127.0.0.1", "port": "abc"},
+                ],
+                timeout=2,
+            )
+
+    open_result, closed_result, bad_result = asyncio.run(scenario())
+    assert open_result["name"] == "open"
+    assert open_result["is_open"] and open_result["latency_ms"] is not None
+    assert not closed_result["is_open"] and closed_result["error"]
+    assert not bad_result["is_open"] and bad_result["error"]
+
+
+def test_udp_port_unreachable_is_closed():
+    result = asyncio.run(probe("127.0.0.1", free_port(), "udp", timeout=1))
+    assert not result["is_open"]
+
+
+def test_service_endpoints(tmp_path):
+    _, Session = initial_db.initialize_database(str(tmp_path / "app.db"))
+    repository.add_smtp_server("smtp.local", 25, None, None, "a@b.c", False, Session)
+    endpoints = repository.get_service_endpoints(Session)
+    initial_db.dispose_engines()
+    assert endpoints == [
+        {"kind": "smtp", "id": 1, "name": "smtp.local", "host": "smtp.local", "port": 25}
+    ]
+
+
+def test_service_check_runs_on_the_callers_loop():
+    async def scenario():
+        server = await asyncio.start_server(
+            lambda reader, writer: writer.close(), "127.0.0.1", 0
+        )
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            return (
+                await repository.test_services_async(f"127.0.0.1:{port}"),
+                await repository.test_services_async("127.0.0.1", free_port()),
+            )
+
+    assert asyncio.run(scenario()) == (True, False)
@@ -0,0 +1,234 @@
+"""
+Tests for the registry seeding (registry_seed.py) against an in-memory registry.
+"""
+
+import hashlib
+import io
+import json
+import re
+import tarfile
+
+from unittest.mock import patch
+
+import pytest
+import requests
+
+import initial_db
+import install
+from image_store import save_manifest
+from models import VirtualMachine
+from registry_seed import RegistryClient, missing_images, seed
+
+
+def _digest(data):
+    return "sha256:" + hashlib.sha256(data).hexdigest()
+
+
+class Response:
+    def __init__(self, status_code, body=None, headers=None):
+        self.status_code = status_code
+        self._body = body
+        self.headers = headers or {}
+
+    def json(self):
+        return self._body
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise RuntimeError(self.status_code)
+
+
+class FakeRegistry:
+    """The registry v2 routes used by RegistryClient."""
+
+    def __init__(self):
+        self.blobs = {}  # repository -> {digest: bytes}
+        self.manifests = {}  # (repository, tag) -> manifest
+        self.uploaded = []
+        self.mounted = []
+
+    def request(self, method, url, params=None, data=None, headers=None, **kwargs):
+        path = url.split("://", 1)[1].split("/", 1)[1]
+        path, _, query = path.partition("?")
+        if path == "v2/":
+            return Response(200)
+        if path == "v2/_catalog":
+            return Response(200, {"repositories": sorted(self.blobs)})
+        repository, route = re.match(
+            r"v2/(.+?)/(tags/list|manifests/.+|blobs/.*)$", path
+        ).groups()
+        blobs = self.blobs.setdefault(repository, {})
+        if route == "tags/list":
+            tags = [tag for repo, tag in self.manifests if repo == repository]
+            return Response(200, {"name": repository, "tags": tags})
+        if route.startswith("manifests/"):
+            key = (repository, route.split("/", 1)[1])
+            if method == "PUT":
+                manifest = json.loads(data)
+                for blob in [manifest["config"]] + manifest["layers"]:
+                    assert blob["digest"] in blobs
+                self.manifests[key] = manifest
+                return Response(201)
+            status = 200 if key in self.manifests else 404
+            return Response(status, self.manifests.get(key))
+        if method == "HEAD":
+            return Response(200 if route.split("/", 1)[1] in blobs else 404)
+        if method == "POST":
+            mount = (params or {}).get("mount")
+            source = self.blobs.get((params or {}).get("from"), {})
+            if mount in source:
+                blobs[mount] = source[mount]
+                self.mounted.append(mount)
+                return Response(201)
+            location = f"/v2/{repository}/blobs/uploads/1?_state=x"
+            return Response(202, headers={"Location": location})
+        # PUT of a monolithic upload
+        digest = query.split("digest=", 1)[1]
+        body = data if isinstance(data, bytes) else data.read()
+        assert _digest(body) == digest
+        assert int(headers["Content-Length"]) == len(body)
+        blobs[digest] = body
+        self.uploaded.append(digest)
+        return Response(201)
+
+
+def _add(bundle, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    bundle.addfile(info, io.BytesIO(data))
+
+
+def _save(path, images):
+    """docker save bundle of images: {reference: [layer bytes]}."""
+    ids, saved = {}, []
+    with tarfile.open(path, "w") as bundle:
+        for reference, layers in images.items():
+            diff_ids = [_digest(layer) for layer in layers]
+            config = json.dumps({"rootfs": {"type": "layers", "diff_ids": diff_ids}})
+            config = config.encode()
+            ids[reference] = _digest(config)
+            _add(bundle, f"blobs/sha256/{ids[reference][7:]}", config)
+            names = []
+            for digest, layer in zip(diff_ids, layers):
+                names.append(f"{digest[7:]}/layer.tar")
+                if f"blobs/sha256/{digest[7:]}" not in bundle.getnames():
+                    _add(bundle, f"blobs/sha256/{digest[7:]}", layer)
+                link = tarfile.TarInfo(names[-1])
+                link.type = tarfile.SYMTYPE
+                link.linkname = f"../blobs/sha256/{digest[7:]}"
+                bundle.addfile(link)
+            saved.append(
+                {
+                    "Config": f"blobs/sha256/{ids[reference][7:]}",
+                    "RepoTags": [reference],
+                    "Layers": names,
+                }
+            )
+        _add(bundle, "manifest.json", json.dumps(saved).encode())
+    return ids
+
+
+@pytest.fixture
+def store(tmp_path):
+    base = b"base layer"
+    ids = _save(
+        tmp_path / "a.tar",
+        {"redis:7": [base, b"redis"], "quay.io/app:1": [base, b"app"]},
+    )
+    manifest = {
+        "images": {
+            image: {"image_id": image_id, "file": "a.tar"}
+            for image, image_id in ids.items()
+        },
+        "bundles": {"a.tar": {"images": sorted(ids)}},
+    }
+    return str(tmp_path), manifest
+
+
+def test_only_missing_images_are_streamed(store):
+    folder, manifest = store
+    registry = FakeRegistry()
+    client = RegistryClient("https://registry:8443", "u", "p", http=registry)
+    assert missing_images(client, manifest) == ["quay.io/app:1", "redis:7"]
+
+    result = seed(client, manifest, folder)
+    assert result["failed"] == {}
+    assert result["pushed"] == ["quay.io/app:1", "redis:7"]
+    # The shared base layer is uploaded once and mounted in the other repository
+    assert result["layers"] == 3
+    assert len(registry.mounted) == 1
+    assert registry.manifests[("redis", "7")]["config"]["digest"] == (
+        manifest["images"]["redis:7"]["image_id"]
+    )
+    assert missing_images(client, manifest) == []
+
+    uploads = len(registry.uploaded)
+    again = seed(client, manifest, folder)
+    assert again["pushed"] == [] and again["present"] == 2
+    assert len(registry.uploaded) == uploads
+
+
+def test_changed_image_is_pushed_again(store):
+    folder, manifest = store
+    registry = FakeRegistry()
+    client = RegistryClient("https://registry:8443", http=registry)
+    seed(client, manifest, folder)
+    manifest["images"]["redis:7"]["image_id"] = "sha256:other"
+    assert missing_images(client, manifest) == ["redis:7"]
+
+
+def test_unreachable_registry_misses_everything(store):
+    _, manifest = store
+
+    class Down:
+        def request(self, *args, **kwargs):
+            raise requests.ConnectionError("down")
+
+    client = RegistryClient("https://registry:8443", http=Down())
+    assert missing_images(client, manifest) == sorted(manifest["images"])
+
+
+@pytest.fixture
+def registry_inputs(tmp_path):
+    _, Session = initial_db.initialize_database(str(tmp_path / "app.db"))
+    module = install.role_hooks.get("install-docker-registry", "prepare_inputs")
+    images = tmp_path / "images"
+    images.mkdir()
+    # No VM with the docker-registry role
+    session = Session()
+    session.query(VirtualMachine).filter(
+        VirtualMachine.roles.contains("docker-registry")
+    ).delete(synchronize_session=False)
+    session.commit()
+    session.close()
+    with patch.object(module, "IMAGES_FOLDER", str(images)), patch.object(
+        module, "REGISTRY_SEED_MODE", "docker"
+    ):
+        yield images, lambda: module.get_inputs(Session)
+    initial_db.dispose_engines()
+
+
+def test_registry_inputs_fall_back_to_the_per_image_tars(registry_inputs):
+    images, get_inputs = registry_inputs
+    extra_vars, _ = get_inputs()
+    assert extra_vars["registry_seed_mode"] == "docker"
+    assert extra_vars["registry_images"] == []
+    assert extra_vars["registry_image_bundles"] == {}
+
+    (images / "install-a_redis:7.tar").write_bytes(b"")
+    extra_vars, _ = get_inputs()
+    assert extra_vars["registry_images"] == ["redis:7"]
+    assert extra_vars["registry_image_bundles"] == {"install-a_redis:7.tar": []}
+
+
+def test_registry_inputs_need_a_registry_vm_to_compare(registry_inputs):
+    images, get_inputs = registry_inputs
+    save_manifest(
+        str(images),
+        {
+            "images": {"redis:7": {"image_id": "sha256:r", "file": "a.tar"}},
+            "bundles": {"a.tar": {"images": ["redis:7"]}},
+        },
+    )
+    with pytest.raises(ValueError, match="docker-registry"):
+        get_inputs()
@@ -0,0 +1,127 @@
+"""
+Tests for the read endpoint cache (response_cache.py).
+"""
+
+from typing import List
+
+import pytest
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+from pydantic import BaseModel
+
+import initial_db
+import repository
+from response_cache import ResponseCache, invalidates, response_cache
+
+
+class Item(BaseModel):
+    id: int
+    name: str
+
+    class Config:
+        from_attributes = True
+
+
+class Row:
+    def __init__(self, id, name):
+        self.id = id
+        self.name = name
+
+
+@pytest.fixture
+def app():
+    cache = ResponseCache(ttl=60)
+    rows = [Row(1, "a")]
+    loads = []
+    app = FastAPI()
+
+    @app.get("/items")
+    def read_items(request: Request):
+        def load():
+            loads.append(1)
+            return list(rows)
+
+        return cache.respond(request, "items", load, List[Item])
+
+    app.state.cache, app.state.rows, app.state.loads = cache, rows, loads
+    return app
+
+
+def test_etag_and_not_modified(app):
+    client = TestClient(app)
+    first = client.get("/items")
+    assert first.json() == [{"id": 1, "name": "a"}]
+    etag = first.headers["etag"]
+
+    cached = client.get("/items", headers={"If-None-Match": etag})
+    assert cached.status_code == 304
+    assert cached.content == b""
+    assert cached.headers["etag"] == etag
+    assert len(app.state.loads) == 1
+
+    app.state.rows.append(Row(2, "b"))
+    app.state.cache.invalidate("items")
+    changed = client.get("/items", headers={"If-None-Match": etag})
+    assert changed.status_code == 200
+    assert len(changed.json()) == 2
+    assert changed.headers["etag"] != etag
+    assert app.state.cache.get_stats()["not_modified"] == 1
+
+
+def test_entries_expire():
+    cache = ResponseCache(ttl=0)
+    bodies = iter([b"1", b"2"])
+    assert cache.get("items", "", lambda: next(bodies))[1] == b"1"
+    assert cache.get("items", "", lambda: next(bodies))[1] == b"2"
+
+
+def test_write_during_compute_is_not_cached():
+    cache = ResponseCache(ttl=60)
+
+    def compute():
+        cache.invalidate("items")
+        return b"old"
+
+    cache.get("items", "", compute)
+    assert cache.get("items", "", lambda: b"new")[1] == b"new"
+
+
+def test_invalidates_decorator_runs_even_on_error():
+    cache_before = response_cache.get_stats()["invalidations"]
+
+    @invalidates("items", "configuration")
+    def write(fail):
+        if fail:
+            raise RuntimeError("write failed")
+        return "done"
+
+    assert write(False) == "done"
+    with pytest.raises(RuntimeError):
+        write(True)
+    assert response_cache.get_stats()["invalidations"] == cache_before + 4
+
+
+def test_repository_writes_invalidate_their_resource(tmp_path):
+    _, Session = initial_db.initialize_database(str(tmp_path / "app.db"))
+    try:
+        response_cache.get("dns", "", lambda: b"[]")
+        assert response_cache.get("dns", "", lambda: b"stale")[1] == b"[]"
+        repository.add_dns("app", "app.local", "10.0.0.5", Session)
+        assert response_cache.get("dns", "", lambda: b"fresh")[1] == b"fresh"
+    finally:
+        response_cache.clear()
+        initial_db.dispose_engines()
+
+
+def test_unit_of_work_invalidates_after_its_commit(tmp_path):
+    _, Session = initial_db.initialize_database(str(tmp_path / "app.db"))
+    try:
+        with repository.unit_of_work(Session) as uow:
+            repository.add_dns("app", "app.local", "10.0.0.5", uow)
+            # A read before the commit does not see the new record
+            response_cache.get("dns", "", lambda: b"[]")
+            assert response_cache.get("dns", "", lambda: b"stale")[1] == b"[]"
+        assert response_cache.get("dns", "", lambda: b"fresh")[1] == b"fresh"
+    finally:
+        response_cache.clear()
+        initial_db.dispose_engines()
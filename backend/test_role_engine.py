@@ -0,0 +1,79 @@
+"""
+Tests for the role execution engine (role_engine.py).
+"""
+
+import asyncio
+import importlib
+import os
+import pickle
+import threading
+
+import pytest
+
+import initial_db
+import repository
+import role_engine
+from role_engine import RoleEngine
+from snapshot import build_snapshot
+
+
+def count_vms_in_child(role_name, Session):
+    return os.getpid(), len(repository.get_vms_by_group(role_name, Session))
+
+
+@pytest.fixture
+def Session(tmp_path):
+    _, Session = initial_db.initialize_database(str(tmp_path / "app.db"))
+    yield Session
+    initial_db.dispose_engines()
+
+
+def test_roles_run_in_the_api_process_by_default(monkeypatch):
+    monkeypatch.delenv("INSTALL_ROLE_EXECUTOR", raising=False)
+    importlib.reload(role_engine)
+    engine = role_engine.RoleEngine(lambda role_name, Session: os.getpid(), 1)
+    assert engine.mode == "thread"
+    assert engine.submit("role", None).result(timeout=5) == os.getpid()
+    engine.shutdown()
+
+
+def test_thread_mode_gauges():
+    release = threading.Event()
+    started = threading.Semaphore(0)
+
+    def target(role_name, Session):
+        started.release()
+        release.wait(5)
+
+    engine = RoleEngine(target, max_workers=2, mode="thread")
+    futures = [engine.submit(f"role-{i}", None) for i in range(3)]
+    started.acquire(timeout=5)
+    started.acquire(timeout=5)
+    assert engine.stats()["active"] == 2
+    assert engine.stats()["queued"] == 1
+
+    release.set()
+    for future in futures:
+        future.result(timeout=5)
+    stats = engine.stats()
+    assert stats["active"] == 0 and stats["completed"] == 3
+    engine.shutdown()
+
+
+def test_snapshot_survives_pickling(Session):
+    snapshot = pickle.loads(pickle.dumps(build_snapshot(Session)))
+    assert snapshot.Session is None
+    snapshot = snapshot.bind(Session)
+    assert len(repository.get_vms_by_group("RKEAPPS", snapshot)) == 3
+
+
+def test_process_mode_runs_role_in_child(Session):
+    engine = RoleEngine(count_vms_in_child, max_workers=1, mode="process")
+    snapshot = build_snapshot(Session)
+    pid, count = engine.submit("RKEAPPS", snapshot).result(timeout=60)
+    assert pid != os.getpid()
+    assert count == 3
+
+    asyncio.run(engine.run("vault", Session))
+    assert engine.stats()["completed"] == 2
+    engine.shutdown()
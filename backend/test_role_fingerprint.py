@@ -0,0 +1,220 @@
+"""
+Tests for the role input fingerprint (role_fingerprint.py) and its use by
+install.plan_role_run.
+"""
+
+import os
+import tempfile
+from unittest.mock import patch
+
+import pytest
+from ansible_runner.utils import dump_artifacts
+from sqlalchemy import create_engine
+
+import initial_db
+import install
+import repository
+from role_fingerprint import fingerprint
+
+
+@pytest.fixture
+def role(tmp_path):
+    role = tmp_path / "install-x"
+    (role / "tasks").mkdir(parents=True)
+    (role / "tasks" / "main.yml").write_text("- debug: msg=x\n")
+    return str(role)
+
+
+def _key_file(content):
+    with tempfile.NamedTemporaryFile(delete=False, mode="w") as key_file:
+        key_file.write(content)
+    return key_file.name
+
+
+def test_temporary_files_are_hashed_by_content(role):
+    first, second = _key_file("key"), _key_file("key")
+    try:
+        assert first != second
+        assert fingerprint({"key": first}, {}, role) == fingerprint(
+            {"key": second}, {}, role
+        )
+        with open(second, "w") as file:
+            file.write("other key")
+        assert fingerprint({"key": first}, {}, role) != fingerprint(
+            {"key": second}, {}, role
+        )
+    finally:
+        os.remove(first)
+        os.remove(second)
+
+
+def test_inputs_and_role_files_change_the_fingerprint(role):
+    base = fingerprint({"a": 1, "b": [1, 2]}, {"all": {}}, role)
+    assert base == fingerprint({"b": [1, 2], "a": 1}, {"all": {}}, role)
+    assert base != fingerprint({"a": 2, "b": [1, 2]}, {"all": {}}, role)
+    assert base != fingerprint({"a": 1, "b": [1, 2]}, {"web": {}}, role)
+    assert base == fingerprint(
+        {"a": 1, "b": [1, 2], "now": "12:00"}, {"all": {}}, role, exclude={"now"}
+    )
+    with open(os.path.join(role, "tasks", "main.yml"), "a") as file:
+        file.write("- debug: msg=y\n")
+    assert base != fingerprint({"a": 1, "b": [1, 2]}, {"all": {}}, role)
+
+
+def test_external_state_changes_the_fingerprint(role):
+    base = fingerprint({"a": 1}, {}, role)
+    assert fingerprint({"a": 1}, {}, role, state=None) == base
+    with_state = fingerprint({"a": 1}, {}, role, state={"manifest": "sha256:1"})
+    assert with_state != base
+    assert with_state != fingerprint({"a": 1}, {}, role, state={"manifest": "sha256:2"})
+
+
+def test_registry_fingerprint_follows_the_image_manifest(tmp_path):
+    module = install.role_hooks.get("install-docker-registry", "prepare_inputs")
+    with patch.object(module, "IMAGES_FOLDER", str(tmp_path)):
+        assert install.load_fingerprint_state("install-docker-registry", None) is None
+        (tmp_path / "manifest.json").write_text('{"images": {}}')
+        first = install.load_fingerprint_state("install-docker-registry", None)
+        (tmp_path / "manifest.json").write_text('{"images": {"redis:7": {}}}')
+        second = install.load_fingerprint_state("install-docker-registry", None)
+    assert first != second
+    assert first["manifest.json"].startswith("sha256:")
+    assert install.load_fingerprint_state("prepare-vms", None) is None
+
+
+def test_skipped_role_runs_the_post_install_that_checks_itself():
+    assert install.post_install_runs_when_unchanged("install-docker-registry")
+    assert not install.post_install_runs_when_unchanged("prepare-vms")
+    for role_name, calls in (("install-docker-registry", 1), ("prepare-vms", 0)):
+        with patch(
+            "install.load_and_call_get_inputs", return_value=({}, {})
+        ), patch("install.load_fingerprint_state"), patch(
+            "install.plan_role_run", return_value=("sha256:x", "skip")
+        ), patch(
+            "install.set_ansible_role_fingerprint"
+        ), patch(
+            "install.update_ansible_role_status"
+        ) as update_status, patch(
+            "install.ansible_runner.run"
+        ) as run, patch(
+            "install.call_post_install"
+        ) as post_install:
+            install.call_role(role_name, None)
+        assert post_install.call_count == calls
+        assert not run.called
+        update_status.assert_called_once_with(role_name, "unchanged", None)
+
+
+def test_plan_role_run(tmp_path):
+    _, Session = initial_db.initialize_database(str(tmp_path / "app.db"))
+    try:
+        inputs = ({"a": 1}, {"all": {}})
+        value, mode = install.plan_role_run("prepare-vms", *inputs, Session)
+        assert mode == "run"
+        repository.save_role_result("prepare-vms", value, "successful", Session)
+        plan = install.plan_role_run
+        assert plan("prepare-vms", *inputs, Session) == (value, "skip")
+        assert plan("prepare-vms", *inputs, Session, mode="check")[1] == "check"
+        assert plan("prepare-vms", *inputs, Session, mode="off")[1] == "run"
+        assert plan("prepare-vms", {"a": 2}, {}, Session)[1] == "run"
+        repository.delete_role_results(Session)
+        assert plan("prepare-vms", *inputs, Session)[1] == "run"
+    finally:
+        initial_db.dispose_engines()
+
+
+def test_prepare_vms_inputs_keep_their_fingerprint(tmp_path):
+    _, Session = initial_db.initialize_database(str(tmp_path / "app.db"))
+    module = install.role_hooks.get("prepare-vms", "prepare_inputs")
+    hosts_file = str(tmp_path / "hosts")
+    try:
+        # The hook writes the hosts file of the VMs to the role files
+        with patch.object(
+            module, "open", lambda path, mode: open(hosts_file, mode), create=True
+        ):
+            plans = [
+                install.plan_role_run(
+                    "prepare-vms",
+                    *install.load_and_call_get_inputs("prepare-vms", Session),
+                    Session,
+                )
+                for _ in range(2)
+            ]
+    finally:
+        initial_db.dispose_engines()
+    assert plans[0] == plans[1]
+    assert plans[0][1] == "run"
+
+
+def test_root_password_is_generated_once(tmp_path):
+    _, Session = initial_db.initialize_database(str(tmp_path / "app.db"))
+    try:
+        password = repository.get_root_password(Session)
+        assert len(password) == 16
+        assert repository.get_root_password(Session) == password
+        assert repository.get_security(Session).root_password != password
+    finally:
+        initial_db.dispose_engines()
+
+
+def test_upgrade_schema_adds_missing_columns(tmp_path):
+    path = tmp_path / "old.db"
+    engine = create_engine(f"sqlite:///{path}")
+    with engine.begin() as connection:
+        connection.exec_driver_sql(
+            "CREATE TABLE ansible_roles (id INTEGER PRIMARY KEY, role_name VARCHAR "
+            "NOT NULL, 'order' INTEGER NOT NULL, runner_ident VARCHAR, status "
+            "VARCHAR NOT NULL, start_time DATETIME NOT NULL, end_time DATETIME)"
+        )
+    initial_db.upgrade_schema(engine)
+    with engine.begin() as connection:
+        columns = [
+            row[1]
+            for row in connection.exec_driver_sql("PRAGMA table_info(ansible_roles)")
+        ]
+        tables = [
+            row[0]
+            for row in connection.exec_driver_sql(
+                "SELECT name FROM sqlite_master WHERE type='table'"
+            )
+        ]
+    engine.dispose()
+    assert "fingerprint" in columns
+    assert "role_results" in tables
+
+
+def test_check_run_does_not_leak_into_the_next_run(tmp_path):
+    (tmp_path / "project" / "roles").mkdir(parents=True)
+    (tmp_path / "env").mkdir()
+    # Left in the shared env folder by earlier versions
+    (tmp_path / "env" / "cmdline").write_text("--check")
+    runs = []
+
+    def fake_run(**kwargs):
+        dump_artifacts(kwargs)
+        cmdline = os.path.join(kwargs["private_data_dir"], "env", "cmdline")
+        if kwargs.get("cmdline") is None and os.path.exists(cmdline):
+            with open(cmdline) as file:
+                kwargs["cmdline"] = file.read()
+        env = os.listdir(os.path.join(kwargs["private_data_dir"], "env"))
+        runs.append((kwargs.get("cmdline"), env))
+
+    plans = iter([("sha256:x", "check"), ("sha256:x", "run")])
+    with patch("install.ANSIBLE_ROOT", str(tmp_path)), patch(
+        "install.ansible_runner.run", fake_run
+    ), patch(
+        "install.load_and_call_get_inputs", return_value=({"a": 1}, {"all": {}})
+    ), patch(
+        "install.plan_role_run", side_effect=lambda *args, **kwargs: next(plans)
+    ), patch(
+        "install.set_ansible_role_fingerprint"
+    ), patch(
+        "install.get_ansible_role_status", return_value="failed"
+    ), patch(
+        "install.call_post_install"
+    ):
+        install.call_role("install-x", None)
+        install.call_role("install-x", None)
+
+    assert runs == [("--check", []), (None, [])]
+    assert os.listdir(tmp_path / "env") == ["cmdline"]
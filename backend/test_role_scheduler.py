@@ -0,0 +1,144 @@
+"""
+Tests for the dependency-graph role scheduler in install.py.
+
+The ansible execution itself is mocked: each fake role sleeps a little and
+reports the status configured in the test.
+"""
+
+import asyncio
+import json
+import os
+import threading
+from unittest.mock import patch
+
+from ansible_runner.utils import dump_artifacts
+
+import install
+
+
+def run_scheduler(roles, statuses, **kwargs):
+    started = []
+    active = {"now": 0, "max": 0}
+
+    async def fake_async_call_role(role_name, Session):
+        started.append(role_name)
+        active["now"] += 1
+        active["max"] = max(active["max"], active["now"])
+        # Failing roles end first so fail-fast is deterministic
+        await asyncio.sleep(0.01 if role_name not in statuses else 0)
+        active["now"] -= 1
+
+    def fake_status(role_name, Session):
+        return statuses.get(role_name, "successful")
+
+    with patch("install.async_call_role", fake_async_call_role), patch(
+        "install.get_ansible_role_status", fake_status
+    ), patch("install.update_ansible_role_status"):
+        results = asyncio.run(install.run_roles(roles, None, **kwargs))
+    return results, started, active["max"]
+
+
+def test_resolve_dependencies_falls_back_to_previous_role():
+    deps = install.resolve_role_dependencies(
+        ["prepare-vms", "install-vault", "custom-role"]
+    )
+    assert deps["install-vault"] == ["prepare-vms"]
+    assert deps["custom-role"] == ["install-vault"]
+
+
+def test_independent_roles_run_in_parallel():
+    results, started, max_active = run_scheduler(install.noinf_roles, {})
+    assert all(status == "successful" for status in results.values())
+    assert started[0] == "prepare-vms"
+    # vault and docker registry only need prepare-vms
+    assert set(started[1:3]) == {"install-vault", "install-docker-registry"}
+    assert max_active >= 2
+
+
+def test_concurrency_cap():
+    _, _, max_active = run_scheduler(install.noinf_roles, {}, max_parallel=1)
+    assert max_active == 1
+
+
+def test_fail_fast_skips_everything_not_started():
+    results, started, _ = run_scheduler(
+        install.noinf_roles, {"install-vault": "failed"}, fail_fast=True
+    )
+    assert results["install-vault"] == "failed"
+    assert "install-rke2-apps" not in started
+    assert results["install-rke2-apps"] == "skipped"
+
+
+def test_fail_fast_skips_roles_waiting_for_a_slot():
+    results, started, _ = run_scheduler(
+        install.noinf_roles,
+        {"install-vault": "failed"},
+        fail_fast=True,
+        max_parallel=1,
+    )
+    # docker registry was ready when vault failed but had no slot yet
+    assert started == ["prepare-vms", "install-vault"]
+    assert results["install-docker-registry"] == "skipped"
+
+
+def test_continue_unaffected_branches():
+    results, started, _ = run_scheduler(
+        install.noinf_roles, {"install-vault": "failed"}, fail_fast=False
+    )
+    assert results["install-gogs"] == "skipped"
+    assert results["install-argocd"] == "skipped"
+    assert results["install-rke2-apps"] == "successful"
+    assert results["install-longhorn"] == "successful"
+
+
+def test_unchanged_roles_satisfy_their_dependents():
+    results, started, _ = run_scheduler(
+        install.noinf_roles, {"prepare-vms": "unchanged"}, fail_fast=True
+    )
+    assert results["prepare-vms"] == "unchanged"
+    assert results["install-argocd"] == "successful"
+    assert set(started) == set(install.noinf_roles)
+
+
+def test_parallel_roles_get_their_own_private_data_dir():
+    both_written = threading.Barrier(2, timeout=5)
+    seen = {}
+
+    def fake_run(**kwargs):
+        dump_artifacts(kwargs)
+        # The other role writes its playbook and inventory meanwhile
+        both_written.wait()
+        private_data_dir = kwargs["private_data_dir"]
+        with open(os.path.join(private_data_dir, "project", "main.json")) as file:
+            playbook = json.load(file)
+        with open(kwargs["inventory"]) as file:
+            inventory = json.load(file)
+        assert os.path.isdir(os.path.join(private_data_dir, "project", "roles"))
+        seen[playbook[0]["roles"][0]["name"]] = (private_data_dir, inventory)
+
+    def fake_inputs(role_name, Session):
+        return {}, {"all": {"hosts": {role_name: {}}}}
+
+    with patch("install.ansible_runner.run", fake_run), patch(
+        "install.load_and_call_get_inputs", fake_inputs
+    ), patch("install.plan_role_run", return_value=("sha256:x", "run")), patch(
+        "install.set_ansible_role_fingerprint"
+    ), patch(
+        "install.get_ansible_role_status", return_value="failed"
+    ), patch(
+        "install.call_post_install"
+    ):
+        threads = [
+            threading.Thread(target=install.call_role, args=(role, None))
+            for role in ("install-vault", "install-docker-registry")
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+
+    assert set(seen) == {"install-vault", "install-docker-registry"}
+    for role, (private_data_dir, inventory) in seen.items():
+        assert list(inventory["all"]["hosts"]) == [role]
+        assert not os.path.exists(private_data_dir)
+    assert seen["install-vault"][0] != seen["install-docker-registry"][0]
@@ -0,0 +1,175 @@
+"""
+Tests for the scaffold diff (scaffolding.py) and plan_scaffold/apply_scaffold.
+"""
+
+import pytest
+
+import initial_db
+import repository
+from capacity import planner
+from ip_allocator import zone_pools
+from models import VirtualMachine, Zone
+from scaffolding import desired_vms, diff, generate_hostname, pick_zone
+
+ZONES = [{"id": 1, "name": "lan"}, {"id": 2, "name": "dmz"}]
+
+
+def _sizing(vm_type, zone, node_count, cpu=4):
+    return {
+        "vm_type": vm_type,
+        "zone": zone,
+        "node_count": node_count,
+        "cpu_per_node": cpu,
+        "ram_per_node": 8192,
+        "os_disk_size": 80,
+        "data_disk_size": 0,
+        "roles": "worker",
+    }
+
+
+def _existing(id, vm):
+    return {**vm, "id": id, "ip": f"10.0.0.{id}"}
+
+
+@pytest.fixture
+def Session(tmp_path):
+    _, Session = initial_db.initialize_database(str(tmp_path / "app.db"))
+    repository.seed_vm_configurations(Session)
+    session = Session()
+    zone = session.query(Zone).get(1)
+    zone.ip_pool_start = "10.0.0.10"
+    zone.ip_pool_end = "10.0.0.200"
+    session.commit()
+    session.close()
+    planner.invalidate()
+    zone_pools.forget(1)
+    yield Session
+    planner.invalidate()
+    zone_pools.forget(1)
+    initial_db.dispose_engines()
+
+
+def test_hostnames_and_zones():
+    assert generate_hostname("vault", "test-", 1) == "test-vault1"
+    assert generate_hostname("test-vault", "test-", 2) == "test-vault2"
+    assert pick_zone("DMZ", ZONES)["id"] == 2
+    assert pick_zone("LAN Apps", ZONES)["id"] == 1
+    assert pick_zone("DMZ", ZONES[:1])["id"] == 1
+
+
+def test_diff_adds_resizes_and_removes_scaffolded_vms_only():
+    before = desired_vms(
+        [_sizing("RKEAPPS_WORKER", "LAN Apps", 3), _sizing("LBDMZ", "DMZ", 2)],
+        ZONES,
+        "test",
+    )
+    assert sorted(before) == [
+        "test-lbdmz1",
+        "test-lbdmz2",
+        "test-rkeapp-worker1",
+        "test-rkeapp-worker2",
+        "test-rkeapp-worker3",
+    ]
+    assert before["test-lbdmz1"]["zone_id"] == 2
+    existing = [_existing(i, vm) for i, vm in enumerate(before.values(), 1)]
+    existing.append(_existing(99, {**before["test-lbdmz1"], "hostname": "infra-vm"}))
+
+    after = desired_vms(
+        [_sizing("RKEAPPS_WORKER", "LAN Apps", 2, cpu=8), _sizing("LBDMZ", "DMZ", 3)],
+        ZONES,
+        "test",
+    )
+    plan = diff(after, existing, "test")
+    assert [vm["hostname"] for vm in plan["add"]] == ["test-lbdmz3"]
+    assert [vm["hostname"] for vm in plan["resize"]] == [
+        "test-rkeapp-worker1",
+        "test-rkeapp-worker2",
+    ]
+    assert plan["resize"][0]["changes"] == {"nb_cpu": {"from": 4, "to": 8}}
+    assert [vm["hostname"] for vm in plan["remove"]] == ["test-rkeapp-worker3"]
+    assert plan["unchanged"] == 2
+    # infra-vm is not named like a scaffolded VM
+    assert plan["unmanaged"] == 1
+
+
+def test_seeded_vms_are_adopted_by_their_group():
+    desired = desired_vms(
+        [_sizing("VAULT", "LAN Infra", 1), _sizing("RKEAPPS_WORKER", "LAN Apps", 3)],
+        ZONES,
+        "",
+    )
+    seeded = {"hostname": "", "roles": "worker", "ip": "", "zone_id": None}
+    existing = [
+        {**desired["vault1"], **seeded, "id": 1},
+        {**desired["rkeapp-worker1"], **seeded, "id": 2, "roles": "master"},
+        {**desired["vault1"], **seeded, "id": 3, "group": "monitoring"},
+    ]
+    plan = diff(desired, existing, "")
+    assert [vm["hostname"] for vm in plan["add"]] == [
+        "rkeapp-worker2",
+        "rkeapp-worker3",
+    ]
+    assert plan["adopted"] == 2
+    vault, worker = plan["resize"]
+    assert vault["id"] == 1 and vault["adopted"] and vault["ip"] is None
+    assert vault["changes"]["hostname"] == {"from": "", "to": "vault1"}
+    assert worker["changes"]["roles"] == {"from": "master", "to": "worker"}
+    assert worker["zone_id"] == worker["changes"]["zone_id"]["to"] == 1
+    # No desired VM in the monitoring group
+    assert plan["unmanaged"] == 1 and not plan["remove"]
+
+
+def test_apply_is_incremental(Session):
+    plan = repository.plan_scaffold(Session)
+    assert plan["dry_run"]
+    assert plan["add"] and not plan["remove"]
+    # The 5 VMs of initial_db.py are taken over, not doubled
+    assert plan["adopted"] == 5 and plan["unmanaged"] == 0
+    assert len(repository.get_virtual_machines(Session)) == 5
+
+    applied = repository.apply_scaffold(Session)
+    assert not applied["dry_run"]
+    vms = repository.get_virtual_machines(Session)
+    assert len(vms) == 5 + len(plan["add"])
+    assert all(vm.hostname for vm in vms)
+    ips = [vm.ip for vm in vms if vm.ip]
+    assert len(ips) == len(set(ips)) == len(vms)
+
+    again = repository.plan_scaffold(Session)
+    assert not again["add"] and not again["resize"] and not again["remove"]
+    assert again["unchanged"] == len(vms)
+
+    # More users: only the difference is applied
+    repository.update_number_concurent_users(10000, Session)
+    bigger = repository.apply_scaffold(Session)
+    assert bigger["add"] or bigger["resize"]
+    repository.update_number_concurent_users(100, Session)
+    smaller = repository.apply_scaffold(Session)
+    assert len(repository.get_virtual_machines(Session)) == 5 + len(plan["add"])
+    assert smaller["remove"]
+    # Addresses of removed VMs are handed out again
+    freed = sorted(repository.ip_to_int(vm["ip"]) for vm in smaller["remove"])
+    assert repository.get_next_available_ip(1, Session) == repository.int_to_ip(
+        freed[0]
+    )
+
+
+def test_failed_apply_changes_nothing(Session):
+    session = Session()
+    zone = session.query(Zone).get(1)
+    zone.ip_pool_end = "10.0.0.12"
+    session.commit()
+    session.close()
+    with pytest.raises(ValueError, match="No available IP"):
+        repository.apply_scaffold(Session)
+    session = Session()
+    assert session.query(VirtualMachine).count() == 5
+    session.close()
+    # The addresses allocated before the failure were released
+    with repository.unit_of_work(Session) as uow:
+        ips = repository.allocate_ips(1, 3, uow)
+    assert ips == [
+        "10.0.0.10",
+        "10.0.0.11",
+        "10.0.0.12",
+    ]
@@ -0,0 +1,63 @@
+"""
+Tests for the deployment snapshot (snapshot.py) shared by the role hooks.
+"""
+
+import pytest
+from sqlalchemy import event
+
+import initial_db
+import install
+import repository
+from snapshot import build_snapshot
+
+
+@pytest.fixture
+def Session(tmp_path):
+    _, Session = initial_db.initialize_database(str(tmp_path / "app.db"))
+    yield Session
+    initial_db.dispose_engines()
+
+
+def count_queries(Session):
+    engine = Session.kw["bind"]
+    queries = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        queries.append(statement)
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    return queries
+
+
+def test_getters_answer_from_snapshot(Session):
+    snapshot = build_snapshot(Session)
+    queries = count_queries(Session)
+
+    assert repository.get_security(snapshot).id == 1
+    assert len(repository.get_vms_by_group("RKEAPPS", snapshot)) == 3
+    assert repository.get_vms_by_group("missing", snapshot) == []
+    assert len(repository.get_virtual_machines(snapshot)) == 5
+    assert repository.get_databases(snapshot) == []
+    assert len(snapshot.get_vms_by_role("master")) == 3
+    assert queries == []
+
+
+def test_snapshot_is_a_session_factory(Session):
+    snapshot = build_snapshot(Session)
+    repository.add_ansible_role("prepare-vms", 1, snapshot)
+    assert repository.get_ansible_role_status("prepare-vms", snapshot) == "init"
+
+
+def test_hooks_receive_snapshot_when_asked(Session):
+    snapshot = build_snapshot(Session)
+    received = {}
+
+    def old_hook(Session):
+        received["old"] = Session
+
+    def new_hook(Session, snapshot=None):
+        received["new"] = snapshot
+
+    install.call_hook(old_hook, snapshot)
+    install.call_hook(new_hook, snapshot)
+    assert received == {"old": snapshot, "new": snapshot}
@@ -0,0 +1,180 @@
+"""
+Tests for the shared SSH connection pool (ssh_pool.py).
+paramiko's SSHClient is replaced by a fake, no SSH server is needed.
+"""
+
+import hashlib
+import io
+import os
+import stat
+from unittest.mock import MagicMock, patch
+
+import pytest
+from paramiko import RSAKey
+
+import ssh_pool
+from ssh_pool import SSHPool
+
+
+@pytest.fixture(scope="module")
+def key_str():
+    key = RSAKey.generate(1024)
+    buffer = io.StringIO()
+    key.write_private_key(buffer)
+    return buffer.getvalue()
+
+
+class FakeChannel:
+    """
+    Channel of a command writing output chunks in order, (stream, bytes).
+    Like a real SSH window, the command blocks while the buffer of the
+    stream it writes to holds window bytes or more.
+    """
+
+    def __init__(self, output=(("stdout", b"out"),), window=4096):
+        self.pending = list(output)
+        self.buffers = {"stdout": bytearray(), "stderr": bytearray()}
+        self.window = window
+
+    def _produce(self):
+        while self.pending and len(self.buffers[self.pending[0][0]]) < self.window:
+            stream, data = self.pending.pop(0)
+            self.buffers[stream] += data
+
+    def _read(self, stream, size):
+        data = bytes(self.buffers[stream][:size])
+        del self.buffers[stream][:size]
+        return data
+
+    def recv_ready(self):
+        self._produce()
+        return bool(self.buffers["stdout"])
+
+    def recv(self, size):
+        return self._read("stdout", size)
+
+    def recv_stderr_ready(self):
+        self._produce()
+        return bool(self.buffers["stderr"])
+
+    def recv_stderr(self, size):
+        return self._read("stderr", size)
+
+    def exit_status_ready(self):
+        self._produce()
+        return not self.pending
+
+    def recv_exit_status(self):
+        return 0
+
+    def settimeout(self, timeout):
+        pass
+
+    def exec_command(self, command):
+        pass
+
+    def sendall(self, data):
+        pass
+
+    def shutdown_write(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def fake_client(output=(("stdout", b"out"),)):
+    ssh = MagicMock()
+    ssh.get_transport.return_value.is_active.return_value = True
+    ssh.get_transport.return_value.open_session.side_effect = (
+        lambda timeout=None: FakeChannel(output, window=4)
+    )
+    return ssh
+
+
+def test_key_is_parsed_once(key_str):
+    pool = SSHPool()
+    first = pool.load_key(key_str)
+    assert pool.load_key(key_str) is first
+    assert pool.get_stats()["key_misses"] == 1
+    assert pool.get_stats()["key_hits"] == 1
+    assert pool.load_key("") is None
+
+
+def test_connection_is_reused(key_str):
+    pool = SSHPool()
+    pkey = pool.load_key(key_str)
+    with patch("ssh_pool.client.SSHClient", side_effect=fake_client) as factory:
+        assert pool.exec_command("host-a", "true", pkey=pkey, username="u") == (
+            0,
+            "out",
+            "",
+        )
+        pool.exec_command("host-a", "true", pkey=pkey, username="u")
+        pool.exec_command("host-b", "true", pkey=pkey, username="u")
+    assert factory.call_count == 2
+    stats = pool.get_stats()
+    assert stats["hits"] == 1 and stats["misses"] == 2
+    assert stats["connections"] == 2
+
+
+def test_idle_connections_are_evicted():
+    pool = SSHPool(ttl=0)
+    with patch("ssh_pool.client.SSHClient", side_effect=fake_client):
+        pool.exec_command("host-a", "true", username="u")
+        ssh = pool._connections[("host-a", 22, "u", None)].ssh
+        assert pool.evict_idle() == 1
+    ssh.close.assert_called_once()
+    assert pool.get_stats()["connections"] == 0
+
+
+def test_dead_connection_is_replaced():
+    pool = SSHPool()
+    with patch("ssh_pool.client.SSHClient", side_effect=fake_client):
+        pool.exec_command("host-a", "true", username="u")
+        dead = pool._connections[("host-a", 22, "u", None)]
+        dead.ssh.get_transport.return_value.is_active.return_value = False
+        pool.exec_command("host-a", "true", username="u")
+    assert pool._connections[("host-a", 22, "u", None)] is not dead
+    assert pool.get_stats()["misses"] == 2
+
+
+def test_large_stderr_does_not_block_stdout():
+    output = [("stderr", b"e" * 4)] * 5 + [("stdout", b"o" * 4)] * 5
+    output += [("stderr", b"tail")]
+    pool = SSHPool()
+    with patch("ssh_pool.client.SSHClient", side_effect=lambda: fake_client(output)):
+        exit_status, stdout, stderr = pool.exec_command("host-a", "cmd", username="u")
+    assert exit_status == 0
+    assert stdout == "o" * 20
+    assert stderr == "e" * 20 + "tail"
+
+
+def test_key_file_is_written_once(tmp_path):
+    with patch.object(ssh_pool, "SSH_KEY_DIR", str(tmp_path)), patch.object(
+        ssh_pool, "_key_dir", None
+    ):
+        path = ssh_pool.key_file("secret key")
+        assert ssh_pool.key_file("secret key") == path
+        assert ssh_pool.key_file("other key") != path
+    with open(path) as f:
+        assert f.read() == "secret key"
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+
+
+def test_key_file_ignores_a_planted_directory(tmp_path):
+    # A directory created first by someone else is not trusted
+    planted = tmp_path / "harmonisation-keys"
+    planted.mkdir(mode=0o777)
+    digest = hashlib.sha256(b"secret key").hexdigest()
+    (planted / digest).write_text("attacker key")
+    with patch.object(ssh_pool, "SSH_KEY_DIR", str(tmp_path)), patch.object(
+        ssh_pool, "_key_dir", None
+    ):
+        path = ssh_pool.key_file("secret key")
+    key_dir = os.path.dirname(path)
+    assert key_dir != str(planted)
+    assert stat.S_IMODE(os.stat(key_dir).st_mode) == 0o700
+    assert os.stat(key_dir).st_uid == os.getuid()
+    with open(path) as f:
+        assert f.read() == "secret key"
@@ -0,0 +1,108 @@
+"""
+Tests for the image export pipeline (tar_images.py), docker is faked.
+"""
+
+import json
+import os
+import threading
+
+import pytest
+
+from image_store import MANIFEST_FILE, verify
+from tar_images import tar_images
+
+IDS = {"registry:2": "sha256:r", "redis:7": "sha256:d", "vault:1.12.0": "sha256:v"}
+
+
+class FakeDocker:
+    def __init__(self, ids):
+        self.ids = ids
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def __call__(self, *args):
+        with self._lock:
+            self.calls.append(args)
+        if args[0] == "image":
+            name = args[-1].rsplit(":", 1)[0]
+            digest = "sha256:d" + self.ids[args[-1]][-2:]
+            return f"{self.ids[args[-1]]}|100|{name}@{digest}\n"
+        if args[0] == "save":
+            with open(args[2], "w") as file:
+                file.write("\n".join(args[3:]))
+        return ""
+
+    def commands(self, name):
+        return [call[1:] for call in self.calls if call[0] == name]
+
+
+@pytest.fixture
+def roles(tmp_path):
+    roles = tmp_path / "roles"
+    for role, images in {
+        "install-a": ["registry:2", "redis:7", ""],
+        "install-b": ["redis:7", "vault:1.12.0"],
+        "install-c": [],
+    }.items():
+        (roles / role).mkdir(parents=True)
+        if images:
+            (roles / role / "images.txt").write_text("\n".join(images))
+    return str(roles)
+
+
+def test_images_are_deduplicated_and_bundled_per_role(roles, tmp_path):
+    out = str(tmp_path / "out")
+    docker = FakeDocker(IDS)
+    index = tar_images(roles, out, all_roles=True, pulls=3, run=docker)
+
+    # redis:7 is listed by two roles but pulled once
+    assert sorted(docker.commands("pull")) == [
+        ("redis:7",),
+        ("registry:2",),
+        ("vault:1.12.0",),
+    ]
+    saves = sorted(docker.commands("save"))
+    assert len(saves) == 2
+    assert saves[0][2:] == ("redis:7", "registry:2")
+    assert saves[1][2:] == ("vault:1.12.0",)
+    redis = index["images"]["redis:7"]
+    assert redis["name"] == "redis" and redis["tag"] == "7"
+    assert redis["image_id"] == "sha256:d" and redis["size"] == 100
+    assert redis["digest"].startswith("sha256:")
+    assert redis["roles"] == ["install-a", "install-b"]
+    assert redis["file"].startswith("install-a-")
+    assert sorted(os.listdir(out)) == sorted([MANIFEST_FILE] + list(index["bundles"]))
+    assert verify(out, deep=True) == []
+    assert len(docker.commands("rmi")) == 3
+
+
+def test_incremental_runs_are_keyed_by_digest(roles, tmp_path):
+    out = str(tmp_path / "out")
+    tar_images(roles, out, all_roles=True, run=FakeDocker(IDS))
+    with open(os.path.join(out, MANIFEST_FILE)) as file:
+        before = json.load(file)
+
+    # Nothing to pull when the index is up to date
+    again = FakeDocker(IDS)
+    tar_images(roles, out, all_roles=True, run=again)
+    assert again.calls == []
+
+    # Refresh: the install-b bundle is rewritten, install-a's is kept
+    refreshed = FakeDocker(dict(IDS, **{"vault:1.12.0": "sha256:v2"}))
+    after = tar_images(roles, out, all_roles=True, refresh=True, run=refreshed)
+    assert [save[2:] for save in refreshed.commands("save")] == [("vault:1.12.0",)]
+    assert after["images"]["vault:1.12.0"]["image_id"] == "sha256:v2"
+    assert after["images"]["redis:7"] == before["images"]["redis:7"]
+    old_bundle = before["images"]["vault:1.12.0"]["file"]
+    assert old_bundle not in after["bundles"]
+    assert not os.path.exists(os.path.join(out, old_bundle))
+
+
+def test_single_role_reuses_images_exported_for_other_roles(roles, tmp_path):
+    out = str(tmp_path / "out")
+    tar_images(roles, out, role_name="install-a", run=FakeDocker(IDS))
+    docker = FakeDocker(IDS)
+    index = tar_images(roles, out, role_name="install-b", run=docker)
+    assert docker.commands("pull") == [("vault:1.12.0",)]
+    assert index["images"]["redis:7"]["roles"] == ["install-a", "install-b"]
+    assert set(index["images"]) == {"registry:2", "redis:7", "vault:1.12.0"}
@@ -0,0 +1,99 @@
+"""
+Tests for the batched task log writer (task_log_sink.py).
+"""
+
+import queue
+import threading
+from unittest.mock import patch
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+import repository
+from models import TaskLog, create_tables
+from task_log_sink import _STOP, TaskLogSink
+
+
+def make_session(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'logs.db'}")
+    create_tables(engine)
+    return sessionmaker(bind=engine)
+
+
+def test_rows_are_written_in_batches(tmp_path):
+    Session = make_session(tmp_path)
+    with patch(
+        "task_log_sink.add_task_logs_bulk", wraps=repository.add_task_logs_bulk
+    ) as bulk:
+        sink = TaskLogSink(Session, batch_size=100, flush_interval=10)
+        for i in range(250):
+            sink.add("runner_on_ok", f"task {i}", "ok", "ident-1")
+        sink.close()
+
+    session = Session()
+    logs = session.query(TaskLog).order_by(TaskLog.id).all()
+    session.close()
+    assert len(logs) == 250
+    assert logs[0].task == "task 0" and logs[-1].task == "task 249"
+    assert bulk.call_count == 3
+
+
+def test_flush_writes_pending_rows(tmp_path):
+    Session = make_session(tmp_path)
+    sink = TaskLogSink(Session, batch_size=1000, flush_interval=10)
+    sink.add("runner_on_ok", "task", "ok", "ident-1")
+    sink.flush()
+
+    session = Session()
+    assert session.query(TaskLog).count() == 1
+    session.close()
+    sink.close()
+
+
+def test_full_queue_blocks_until_the_writer_catches_up(tmp_path):
+    Session = make_session(tmp_path)
+    database_free = threading.Event()
+
+    def slow_bulk(rows, Session):
+        database_free.wait()
+        repository.add_task_logs_bulk(rows, Session)
+
+    with patch("task_log_sink.add_task_logs_bulk", side_effect=slow_bulk):
+        sink = TaskLogSink(
+            Session, batch_size=1, flush_interval=0, queue_size=1, put_timeout=0.01
+        )
+        producer = threading.Thread(
+            target=lambda: [
+                sink.add("runner_on_ok", f"task {i}", "ok", "ident-1")
+                for i in range(5)
+            ]
+        )
+        producer.start()
+        producer.join(0.2)
+        # The producer waits for room in the queue instead of writing itself
+        assert producer.is_alive()
+        database_free.set()
+        producer.join()
+        sink.close()
+
+    session = Session()
+    tasks = [log.task for log in session.query(TaskLog).order_by(TaskLog.id)]
+    session.close()
+    assert tasks == [f"task {i}" for i in range(5)]
+
+
+def test_stopped_writer_writes_the_queued_rows_first(tmp_path):
+    Session = make_session(tmp_path)
+    sink = TaskLogSink(Session, queue_size=1, put_timeout=0)
+    sink._queue.put(_STOP)
+    sink._thread.join()
+    sink._queue.put(
+        {"event": "runner_on_ok", "task": "queued", "stdout": "ok",
+         "runner_ident": "ident-1"}
+    )
+    sink.add("runner_on_ok", "new", "ok", "ident-1")
+
+    session = Session()
+    tasks = [log.task for log in session.query(TaskLog).order_by(TaskLog.id)]
+    session.close()
+    assert tasks == ["queued", "new"]
@@ -0,0 +1,89 @@
+"""
+Tests for the task log and ansible role listings: cursor pagination, filters,
+field projection and the (runner_ident, id) index.
+"""
+
+import os
+import tempfile
+from unittest.mock import patch
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, inspect
+
+import initial_db
+import repository
+
+# Importing the API opens its database, keep it out of the working directory
+with patch("initial_db.DATABASE_URL", os.path.join(tempfile.mkdtemp(), "api.db")):
+    import api
+
+
+@pytest.fixture
+def Session(tmp_path):
+    _, Session = initial_db.initialize_database(str(tmp_path / "app.db"))
+    for index in range(5):
+        event = "runner_on_failed" if index == 3 else "runner_on_ok"
+        repository.add_task_logs(event, f"task {index}", f"out {index}", "a", Session)
+        repository.add_task_logs("runner_on_ok", f"other {index}", "", "b", Session)
+    yield Session
+    initial_db.dispose_engines()
+
+
+def test_task_logs_cursor_and_filters(Session):
+    logs = repository.get_task_logs("a", Session)
+    assert [log.task for log in logs] == [f"task {index}" for index in range(5)]
+
+    page = repository.get_task_logs("a", Session, after_id=logs[1].id, limit=2)
+    assert [log.task for log in page] == ["task 2", "task 3"]
+    page = repository.get_task_logs("a", Session, after_id=page[-1].id, limit=2)
+    assert [log.task for log in page] == ["task 4"]
+    assert repository.get_task_logs("a", Session, after_id=logs[-1].id) == []
+
+    failed = repository.get_task_logs("a", Session, event="runner_on_failed")
+    assert [log.task for log in failed] == ["task 3"]
+    assert repository.get_task_logs(
+        "a", Session, after_id=logs[3].id, event="runner_on_failed"
+    ) == []
+
+
+def test_task_logs_field_projection(Session):
+    client = TestClient(api.app)
+    with patch("api.Session", Session):
+        response = client.get("/task-logs/a", params={"fields": "task", "limit": 2})
+        unknown = client.get("/task-logs/a", params={"fields": "task,secret"})
+    assert response.status_code == 200
+    rows = response.json()
+    assert [sorted(row) for row in rows] == [["id", "task"], ["id", "task"]]
+    assert [row["task"] for row in rows] == ["task 0", "task 1"]
+    assert unknown.status_code == 400
+
+
+def test_ansible_roles_paging(Session):
+    install_run = repository.start_install_run(Session)
+    for order, role in enumerate(["r1", "r2", "r3", "r4"], 1):
+        repository.add_ansible_role(role, order, Session, run_id=install_run.id)
+
+    page = repository.get_ansible_roles(Session, limit=2)
+    assert [role.role_name for role in page] == ["r1", "r2"]
+    page = repository.get_ansible_roles(Session, after_order=page[-1].order, limit=2)
+    assert [role.role_name for role in page] == ["r3", "r4"]
+    assert repository.get_ansible_roles(Session, after_order=4) == []
+
+
+def test_upgrade_schema_creates_the_task_log_index(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    with engine.begin() as connection:
+        connection.exec_driver_sql(
+            "CREATE TABLE task_logs (id INTEGER PRIMARY KEY, event VARCHAR, "
+            "task VARCHAR, stdout VARCHAR, runner_ident VARCHAR)"
+        )
+    assert inspect(engine).get_indexes("task_logs") == []
+
+    initial_db.upgrade_schema(engine)
+    indexes = {
+        index["name"]: index["column_names"]
+        for index in inspect(engine).get_indexes("task_logs")
+    }
+    engine.dispose()
+    assert indexes["ix_task_logs_runner_ident_id"] == ["runner_ident", "id"]
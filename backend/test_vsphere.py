@@ -0,0 +1,191 @@
+"""
+Tests for the vCenter client (vsphere.py) and test_vmware_esxi_configuration.
+HTTP calls go to a fake requests.Session.
+"""
+
+import threading
+import time
+from unittest.mock import patch
+
+import pytest
+
+import initial_db
+import repository
+import vsphere
+
+INVENTORY = {
+    "host": [{"name": "esx1", "host": "host-1"}],
+    "cluster": [{"name": "cl1", "cluster": "domain-c1"}],
+    "datastore": [{"name": "ds1", "datastore": "datastore-1"}],
+    "datacenter": [{"name": "dc1", "datacenter": "datacenter-1"}],
+    "resource-pool": [{"name": "pool1", "resource_pool": "resgroup-1"}],
+}
+
+
+class FakeResponse:
+    def __init__(self, status_code, value=None):
+        self.status_code = status_code
+        self._value = value
+
+    def json(self):
+        return {"value": self._value}
+
+
+class FakeHttp:
+    def __init__(self, password="secret"):
+        self.password = password
+        self.logins = 0
+        self.gets = []
+        self.valid_tokens = set()
+
+    def post(self, url, auth=None, timeout=None):
+        if auth[1] != self.password:
+            return FakeResponse(401)
+        self.logins += 1
+        token = f"token-{self.logins}"
+        self.valid_tokens.add(token)
+        return FakeResponse(200, token)
+
+    def get(self, url, headers=None, params=None, timeout=None):
+        self.gets.append((url, params))
+        if headers["vmware-api-session-id"] not in self.valid_tokens:
+            return FakeResponse(401)
+        kind = url.rsplit("/", 1)[1]
+        if not params:
+            return FakeResponse(200, INVENTORY[kind])
+        names = set(params.values())
+        return FakeResponse(
+            200, [item for item in INVENTORY[kind] if item["name"] in names]
+        )
+
+
+@pytest.fixture
+def http():
+    fake = FakeHttp()
+    vsphere.clear_tokens()
+    with patch.dict(vsphere._http_sessions, {"vc.local": fake}), patch(
+        "repository.socket.gethostbyname"
+    ):
+        yield fake
+    vsphere.clear_tokens()
+
+
+def check(password="secret", datastore="ds1"):
+    return repository.test_vmware_esxi_configuration(
+        "admin", password, "vc.local", "dc1/esx1", "host", "dc1", datastore, "pool1"
+    )
+
+
+def test_valid_configuration_uses_filters(http):
+    assert check() == []
+    assert len(http.gets) == 4
+    assert ("https://vc.local/rest/vcenter/host", {"filter.names.1": "esx1"}) in http.gets
+
+
+def test_missing_objects_are_reported(http):
+    assert check(datastore="other") == ["Datastore introuvable"]
+
+
+def test_token_is_reused_and_refreshed(http):
+    check()
+    check()
+    assert http.logins == 1
+
+    # vCenter expired the session
+    http.valid_tokens.clear()
+    assert check() == []
+    assert http.logins == 2
+
+
+def test_invalid_credentials(http):
+    assert check(password="wrong") == ["Informations d’identification non valides"]
+
+
+def test_inventory_cache_refreshes_in_background(http):
+    cache = vsphere.InventoryCache(ttl=60)
+
+    def factory():
+        return vsphere.VSphereClient("vc.local", "admin", "secret")
+
+    entry = cache.get(1, factory)
+    assert entry["inventory"]["datastore"][0]["datastore"] == "datastore-1"
+    assert entry["stale"] is False
+    gets = len(http.gets)
+    cache._entries[1]["_expires"] = 0
+    # Expired: served from the cache while a thread fetches it again
+    assert cache.get(1, factory)["stale"] is True
+    for _ in range(100):
+        if len(http.gets) >= gets + len(vsphere.INVENTORY_KINDS):
+            break
+        time.sleep(0.01)
+    assert len(http.gets) == gets + len(vsphere.INVENTORY_KINDS)
+
+
+def saved_vmware(id, Session):
+    session = Session()
+    vmware = session.get(repository.VMwareEsxi, id)
+    session.close()
+    return vmware
+
+
+def test_add_configuration_resolves_ids_in_background(http, tmp_path):
+    _, Session = initial_db.initialize_database(str(tmp_path / "app.db"))
+    warmers = []
+    warm = repository._warm_vmware_inventory
+    vcenter_answers = threading.Event()
+    login = http.post
+
+    def slow_post(*args, **kwargs):
+        vcenter_answers.wait(5)
+        return login(*args, **kwargs)
+
+    with patch.object(http, "post", slow_post), patch(
+        "repository._warm_vmware_inventory",
+        lambda *args: warmers.append(warm(*args)),
+    ):
+        vmware = repository.add_vmware_esxi_configuration(
+            "vc", "admin", "secret", "vc.local", 30, True,
+            "dc1", "", "dc1/esx1", "", "host", "ds1", "", "pool1", "given-id",
+            True, Session,
+        )
+        # Saved without waiting for vCenter
+        assert vmware.datacenter_id == ""
+        vcenter_answers.set()
+        warmers[0].join(5)
+
+    vmware = saved_vmware(vmware.id, Session)
+    assert vmware.datacenter_id == "datacenter-1"
+    assert vmware.target_id == "host-1"
+    assert vmware.datastore_id == "datastore-1"
+    assert vmware.pool_ressource_id == "given-id"
+
+    gets = len(http.gets)
+    inventory = repository.get_vmware_inventory(vmware.id, Session)
+    assert inventory["stale"] is False
+    assert inventory["inventory"]["cluster"][0]["cluster"] == "domain-c1"
+    assert len(http.gets) == gets
+    vsphere.inventory_cache.invalidate(vmware.id)
+    initial_db.dispose_engines()
+
+
+def test_update_commits_before_fetching_the_inventory(http, tmp_path):
+    _, Session = initial_db.initialize_database(str(tmp_path / "app.db"))
+    with patch("repository._warm_vmware_inventory") as warm:
+        vmware = repository.add_vmware_esxi_configuration(
+            "vc", "admin", "secret", "vc.local", 30, True,
+            "dc1", "", "dc1/esx1", "", "host", "ds1", "", "pool1", "",
+            True, Session,
+        )
+
+        def check_saved(id, *args):
+            # Called once the update is committed and its session closed
+            assert saved_vmware(id, Session).alias == "renamed"
+
+        warm.side_effect = check_saved
+        repository.update_vmware_esxi_configuration(
+            vmware.id, "renamed", "admin", "secret", "vc.local", 30, True,
+            "dc1", "", "dc1/esx1", "", "host", "ds1", "", "pool1", "",
+            Session,
+        )
+    assert warm.call_count == 2
+    initial_db.dispose_engines()
@@ -0,0 +1,289 @@
+"""_summary_
+vCenter REST client.
+
+One requests.Session (keep-alive) per vCenter and one API session token per
+(api_url, login), reused until it expires: validating a configuration, then
+provisioning from it, only authenticates once. Inventory lookups use the
+server-side name filters and independent lookups run concurrently.
+"""
+
+import hashlib
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+
+# vCenter usually runs with a self-signed certificate
+urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+VSPHERE_TIMEOUT = float(os.getenv("VSPHERE_TIMEOUT", "15"))
+# vCenter drops idle API sessions after 30 minutes by default
+VSPHERE_TOKEN_TTL = float(os.getenv("VSPHERE_TOKEN_TTL", "1500"))
+
+INVENTORY_KINDS = ("host", "cluster", "datastore", "datacenter", "resource-pool")
+
+_lock = threading.Lock()
+_http_sessions = {}
+# (api_url, login) -> (token, password digest, expiry)
+_tokens = {}
+
+
+class VSphereError(Exception):
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class VSphereAuthError(VSphereError):
+    pass
+
+
+def get_http_session(api_url):
+    with _lock:
+        http = _http_sessions.get(api_url)
+        if http is None:
+            http = requests.Session()
+            http.verify = False
+            http.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=10))
+            _http_sessions[api_url] = http
+        return http
+
+
+def clear_tokens(api_url=None):
+    with _lock:
+        for key in list(_tokens):
+            if api_url is None or key[0] == api_url:
+                del _tokens[key]
+
+
+def _digest(password):
+    return hashlib.sha256((password or "").encode()).hexdigest()
+
+
+class VSphereClient:
+    """Authenticated access to the vCenter REST API of api_url."""
+
+    def __init__(self, api_url, login, password, timeout=VSPHERE_TIMEOUT):
+        self.api_url = api_url
+        self.login = login
+        self.password = password
+        self.timeout = timeout
+        self.http = get_http_session(api_url)
+
+    def token(self, refresh=False):
+        """Return the cached API session token, authenticating when needed."""
+        key = (self.api_url, self.login)
+        digest = _digest(self.password)
+        if not refresh:
+            with _lock:
+                cached = _tokens.get(key)
+            # A token obtained with another password is not reused
+            if cached and cached[1] == digest and cached[2] > time.monotonic():
+                return cached[0]
+
+        response = self.http.post(
+            f"https://{self.api_url}/rest/com/vmware/cis/session",
+            auth=(self.login, self.password),
+            timeout=self.timeout,
+        )
+        if response.status_code == 401:
+            raise VSphereAuthError("Invalid credentials", 401)
+        if response.status_code != 200:
+            raise VSphereError("Session service unavailable", response.status_code)
+        token = response.json()["value"]
+        with _lock:
+            _tokens[key] = (token, digest, time.monotonic() + VSPHERE_TOKEN_TTL)
+        return token
+
+    def get(self, path, params=None):
+        """GET path, authenticating again once if the token expired."""
+        for refresh in (False, True):
+            response = self.http.get(
+                f"https://{self.api_url}{path}",
+                headers={"vmware-api-session-id": self.token(refresh=refresh)},
+                params=params,
+                timeout=self.timeout,
+            )
+            if response.status_code != 401:
+                break
+        return response
+
+    def list(self, kind, names=None):
+        """
+        List the inventory objects of kind (host, cluster, datastore...),
+        only those named in names when given.
+        """
+        params = None
+        if names:
+            params = {f"filter.names.{i}": name for i, name in enumerate(names, 1)}
+        response = self.get(f"/rest/vcenter/{kind}", params=params)
+        if response.status_code != 200:
+            raise VSphereError(f"{kind} service unavailable", response.status_code)
+        return response.json()["value"]
+
+    def find(self, kind, name):
+        # The filter is also applied here, in case the server ignored it
+        return [item for item in self.list(kind, [name]) if item.get("name") == name]
+
+    def map_concurrently(self, function, arguments):
+        """
+        Call function(*args) for each args tuple in parallel. Returns the
+        results in order; a call that raised returns its exception.
+        """
+
+        def call(args):
+            try:
+                return function(*args)
+            except Exception as e:
+                return e
+
+        if not arguments:
+            return []
+        with ThreadPoolExecutor(max_workers=len(arguments)) as executor:
+            return list(executor.map(call, arguments))
+
+    def find_many(self, queries):
+        """find() for each (kind, name) of queries, in parallel."""
+        return self.map_concurrently(self.find, queries)
+
+
+# Seconds before a cached inventory is refreshed
+VSPHERE_INVENTORY_TTL = float(os.getenv("VSPHERE_INVENTORY_TTL", "300"))
+
+# Field holding the object ID in each inventory list
+INVENTORY_ID_FIELDS = {
+    "host": "host",
+    "cluster": "cluster",
+    "datastore": "datastore",
+    "datacenter": "datacenter",
+    "resource-pool": "resource_pool",
+}
+
+
+def fetch_inventory(client):
+    """
+    List every inventory kind concurrently. Returns (inventory, errors):
+    kind -> objects, and kind -> error message for the lists that failed.
+    Raises the error when every list failed.
+    """
+    results = client.map_concurrently(
+        client.list, [(kind,) for kind in INVENTORY_KINDS]
+    )
+    inventory, errors = {}, {}
+    for kind, result in zip(INVENTORY_KINDS, results):
+        if isinstance(result, Exception):
+            errors[kind] = str(result)
+            inventory[kind] = []
+        else:
+            inventory[kind] = result
+    if len(errors) == len(INVENTORY_KINDS):
+        # Nothing worth caching, e.g. vCenter unreachable or invalid credentials
+        raise results[0]
+    return inventory, errors
+
+
+def find_inventory_id(inventory, kind, name):
+    id_field = INVENTORY_ID_FIELDS[kind]
+    for item in inventory.get(kind, []):
+        if item.get("name") == name:
+            return item.get(id_field)
+    return None
+
+
+def resolve_inventory_ids(
+    inventory,
+    datacenter_name,
+    target_name,
+    target_type,
+    datastore_name,
+    pool_ressource_name,
+):
+    """IDs of the objects named in a VMwareEsxi configuration (None if unknown)."""
+    if target_type == "host":
+        target_id = find_inventory_id(inventory, "host", target_name.split("/")[-1])
+    else:
+        target_id = find_inventory_id(inventory, "cluster", target_name)
+    return {
+        "datacenter_id": find_inventory_id(inventory, "datacenter", datacenter_name),
+        "target_id": target_id,
+        "datastore_id": find_inventory_id(inventory, "datastore", datastore_name),
+        "pool_ressource_id": find_inventory_id(
+            inventory, "resource-pool", pool_ressource_name
+        ),
+    }
+
+
+class InventoryCache:
+    """
+    vCenter inventory per hypervisor ID. An entry older than ttl is still
+    returned while a background thread fetches the new one.
+    """
+
+    def __init__(self, ttl=VSPHERE_INVENTORY_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._refreshing = set()
+
+    def put(self, hypervisor_id, inventory, errors=None):
+        entry = {
+            "hypervisor_id": hypervisor_id,
+            "inventory": inventory,
+            "errors": errors or {},
+            "fetched_at": time.time(),
+            "_expires": time.monotonic() + self.ttl,
+        }
+        with self._lock:
+            self._entries[hypervisor_id] = entry
+        return entry
+
+    def refresh(self, hypervisor_id, client_factory):
+        """Fetch the inventory now. client_factory() returns a VSphereClient."""
+        inventory, errors = fetch_inventory(client_factory())
+        return self.put(hypervisor_id, inventory, errors)
+
+    def _refresh_in_background(self, hypervisor_id, client_factory):
+        try:
+            self.refresh(hypervisor_id, client_factory)
+        except Exception as e:
+            print(f"Error: inventory refresh of hypervisor {hypervisor_id}: {e}")
+        finally:
+            with self._lock:
+                self._refreshing.discard(hypervisor_id)
+
+    def get(self, hypervisor_id, client_factory):
+        """
+        Return the cached entry (with a "stale" flag), fetching it when
+        missing and starting a background refresh when expired.
+        """
+        with self._lock:
+            entry = self._entries.get(hypervisor_id)
+        if entry is None:
+            entry = self.refresh(hypervisor_id, client_factory)
+
+        stale = entry["_expires"] <= time.monotonic()
+        if stale:
+            with self._lock:
+                start = hypervisor_id not in self._refreshing
+                self._refreshing.add(hypervisor_id)
+            if start:
+                threading.Thread(
+                    target=self._refresh_in_background,
+                    args=(hypervisor_id, client_factory),
+                    name=f"vsphere-inventory-{hypervisor_id}",
+                    daemon=True,
+                ).start()
+        result = {k: v for k, v in entry.items() if not k.startswith("_")}
+        result["stale"] = stale
+        return result
+
+    def invalidate(self, hypervisor_id):
+        with self._lock:
+            self._entries.pop(hypervisor_id, None)
+
+
+inventory_cache = InventoryCache()